@@ -0,0 +1,205 @@
+"""
+Benchmarks of the scanpy-scripts wrappers on synthetic datasets of 10k, 100k
+and 1M cells, see `datasets.py`
+
+Each benchmark class starts from the pipeline stage its step expects, and is
+parameterised by the number of cells.
+"""
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from . import datasets
+
+
+class _StageBenchmark:
+    """Read the dataset of the required stage before each timing
+    """
+    params = datasets.N_OBS
+    param_names = ['n_obs']
+    timeout = 4 * 3600
+    number = 1
+    repeat = 1
+    stage = 'raw'
+
+    def setup_cache(self):
+        datasets.prepare()
+
+    def setup(self, n_obs):
+        self.adata = datasets.load(n_obs, self.stage)
+
+
+class Filter(_StageBenchmark):
+    stage = 'raw'
+
+    def time_filter_anndata(self, n_obs):
+        from scanpy_scripts.lib import filter_anndata
+        filter_anndata(
+            self.adata,
+            param=[('n_genes', 10, np.inf), ('n_cells', 3, np.inf),
+                   ('pct_counts_mito', 0, 0.2)],
+        )
+
+    def peakmem_filter_anndata(self, n_obs):
+        self.time_filter_anndata(n_obs)
+
+
+class Normalize(_StageBenchmark):
+    stage = 'filter'
+
+    def time_normalize(self, n_obs):
+        from scanpy_scripts.lib import normalize
+        normalize(self.adata, save_raw='yes')
+
+    def peakmem_normalize(self, n_obs):
+        self.time_normalize(n_obs)
+
+
+class Hvg(_StageBenchmark):
+    stage = 'norm'
+
+    def time_hvg(self, n_obs):
+        from scanpy_scripts.lib import hvg
+        hvg(self.adata)
+
+
+class Pca(_StageBenchmark):
+    stage = 'hvg'
+
+    def time_pca(self, n_obs):
+        from scanpy_scripts.lib._pca import pca
+        pca(self.adata, n_comps=50, use_highly_variable=True)
+
+    def peakmem_pca(self, n_obs):
+        self.time_pca(n_obs)
+
+
+class Neighbors(_StageBenchmark):
+    stage = 'pca'
+
+    def time_neighbors(self, n_obs):
+        from scanpy_scripts.lib import neighbors
+        neighbors(self.adata, n_neighbors=15, n_pcs=50)
+
+
+class Umap(_StageBenchmark):
+    stage = 'neighbors'
+
+    def time_umap(self, n_obs):
+        from scanpy_scripts.lib import umap
+        umap(self.adata, random_state=0)
+
+
+class Leiden(_StageBenchmark):
+    stage = 'neighbors'
+
+    def time_leiden(self, n_obs):
+        from scanpy_scripts.lib import leiden
+        leiden(self.adata, resolution=1.0)
+
+
+class Diffexp(_StageBenchmark):
+    stage = 'leiden'
+
+    def time_diffexp_t_test(self, n_obs):
+        from scanpy_scripts.lib import diffexp
+        diffexp(self.adata, groupby='leiden', method='t-test')
+
+    def time_diffexp_wilcoxon(self, n_obs):
+        from scanpy_scripts.lib import diffexp
+        diffexp(self.adata, groupby='leiden', method='wilcoxon')
+
+    def time_diffexp_t_test_native(self, n_obs):
+        from scanpy_scripts.lib import diffexp
+        diffexp(self.adata, groupby='leiden', method='t-test', engine='native')
+
+    def time_diffexp_wilcoxon_native(self, n_obs):
+        from scanpy_scripts.lib import diffexp
+        diffexp(self.adata, groupby='leiden', method='wilcoxon', engine='native')
+
+
+class Float32Accuracy(_StageBenchmark):
+    """Agreement of PCA and clustering under `--dtype float32` with float64
+    runs from the same variable genes
+    """
+    stage = 'hvg'
+
+    def setup_cache(self):
+        datasets.prepare()
+        return {n_obs: _dtype_agreement(n_obs) for n_obs in self.params}
+
+    def setup(self, agreement, n_obs):
+        pass
+
+    def track_pca_variance_ratio_max_rel_diff(self, agreement, n_obs):
+        return agreement[n_obs]['pca_variance_ratio_max_rel_diff']
+    track_pca_variance_ratio_max_rel_diff.unit = 'relative difference'
+
+    def track_leiden_adjusted_rand_index(self, agreement, n_obs):
+        return agreement[n_obs]['leiden_adjusted_rand_index']
+    track_leiden_adjusted_rand_index.unit = 'adjusted Rand index'
+
+
+def _dtype_agreement(n_obs):
+    """Run PCA, neighbors and leiden under the float64 and float32 policies
+    and compare the results
+    """
+    from sklearn.metrics import adjusted_rand_score
+    from scanpy_scripts.dtype_utils import enforce_dtype, set_dtype_policy
+    from scanpy_scripts.lib import neighbors, leiden
+    from scanpy_scripts.lib._pca import pca
+
+    runs = {}
+    try:
+        for dtype in ('float64', 'float32'):
+            set_dtype_policy(dtype)
+            adata = enforce_dtype(datasets.load(n_obs, 'hvg'))
+            pca(adata, n_comps=50, use_highly_variable=True, dtype=dtype)
+            neighbors(adata, n_neighbors=15, n_pcs=50)
+            leiden(adata, resolution=1.0)
+            runs[dtype] = adata
+    finally:
+        set_dtype_policy(None)
+
+    ratio64 = runs['float64'].uns['pca']['variance_ratio']
+    ratio32 = runs['float32'].uns['pca']['variance_ratio']
+    return {
+        'pca_variance_ratio_max_rel_diff': float(
+            np.max(np.abs(ratio32 - ratio64) / ratio64)),
+        'leiden_adjusted_rand_index': float(adjusted_rand_score(
+            runs['float64'].obs['leiden'], runs['float32'].obs['leiden'])),
+    }
+
+
+class _OutputBenchmark(_StageBenchmark):
+    """Write into a temporary directory removed after each timing
+    """
+    stage = 'leiden'
+
+    def setup(self, n_obs):
+        super().setup(n_obs)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self, n_obs):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+class WriteMtx(_OutputBenchmark):
+    stage = 'norm'
+
+    def time_write_mtx(self, n_obs):
+        from scanpy_scripts.cmd_utils import write_mtx
+        write_mtx(self.adata, fname_prefix=os.path.join(self.tmpdir, 'norm_'))
+
+
+class LoomRoundTrip(_OutputBenchmark):
+    stage = 'leiden'
+
+    def time_write_read_exchangeable_loom(self, n_obs):
+        from scanpy_scripts.exchangeable_loom import (
+            read_exchangeable_loom, write_exchangeable_loom)
+        fname = os.path.join(self.tmpdir, 'leiden.loom')
+        write_exchangeable_loom(self.adata, fname)
+        read_exchangeable_loom(fname)
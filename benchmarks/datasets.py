@@ -0,0 +1,125 @@
+"""
+Synthetic datasets for benchmarks
+
+Count matrices are simulated block by block from Poisson distributions with
+gene means drawn from a log-normal distribution, and with a set of marker
+genes up-regulated in each of a number of cell groups, so that clustering and
+differential expression have something to find.
+
+Each dataset is prepared once per machine at successive stages of the standard
+pipeline and kept as h5ad files under `DATA_DIR`, so that every benchmark
+starts from the object its step expects.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+DATA_DIR = os.environ.get(
+    'SCANPY_SCRIPTS_BENCH_DATA',
+    os.path.join(os.path.expanduser('~'), '.cache', 'scanpy-scripts', 'benchmarks'),
+)
+
+N_OBS = [10_000, 100_000, 1_000_000]
+
+N_VARS = 2000
+
+N_GROUPS = 8
+
+N_MITO = 13
+
+_BLOCK_SIZE = 10_000
+
+# Stages of the pipeline kept on disk, in order
+STAGES = ('raw', 'filter', 'norm', 'hvg', 'pca', 'neighbors', 'leiden')
+
+
+def synthetic_counts(n_obs, n_vars=N_VARS, n_groups=N_GROUPS, seed=0):
+    """Simulate a sparse count matrix
+
+    * Parameters
+        + n_obs : int
+        Number of cells
+        + n_vars : int
+        Number of genes, the first `N_MITO` are named as mitochondrial genes
+        + n_groups : int
+        Number of cell groups, each with its own marker genes
+        + seed : int
+        Seed of the random number generator
+
+    * Returns
+        + adata : AnnData
+        An AnnData object with a CSR float32 `.X` and the true group of each
+        cell in `.obs['group']`
+    """
+    import anndata
+
+    rng = np.random.RandomState(seed)
+    base = rng.lognormal(mean=-2.5, sigma=1.5, size=n_vars)
+    fold = np.ones((n_groups, n_vars))
+    for g in range(n_groups):
+        markers = rng.choice(n_vars, size=n_vars // 50, replace=False)
+        fold[g, markers] = rng.uniform(3, 10, size=len(markers))
+    groups = rng.randint(n_groups, size=n_obs)
+    depth = rng.lognormal(mean=0, sigma=0.3, size=n_obs)
+
+    blocks = []
+    for start in range(0, n_obs, _BLOCK_SIZE):
+        end = min(start + _BLOCK_SIZE, n_obs)
+        lam = depth[start:end, None] * base[None, :] * fold[groups[start:end]]
+        blocks.append(sp.csr_matrix(rng.poisson(lam).astype(np.float32)))
+    X = sp.vstack(blocks, format='csr')
+
+    var_names = [f'MT-{i}' for i in range(N_MITO)] + [
+        f'gene{i}' for i in range(N_MITO, n_vars)]
+    obs = pd.DataFrame(
+        {'group': pd.Categorical(groups.astype(str))},
+        index=[f'cell{i}' for i in range(n_obs)])
+    return anndata.AnnData(X=X, obs=obs, var=pd.DataFrame(index=var_names))
+
+
+def stage_path(n_obs, stage):
+    return os.path.join(DATA_DIR, f'{n_obs}_{stage}.h5ad')
+
+
+def prepare(n_obs_list=N_OBS):
+    """Simulate the datasets and run the pipeline on them, skipping stages
+    already on disk
+    """
+    import anndata
+    from scanpy_scripts.lib import (
+        filter_anndata, normalize, hvg, neighbors, leiden)
+    from scanpy_scripts.lib._pca import pca
+
+    steps = {
+        'filter': lambda ad: filter_anndata(
+            ad, param=[('n_genes', 10, np.inf), ('n_cells', 3, np.inf)]),
+        'norm': lambda ad: normalize(ad, save_raw='yes'),
+        'hvg': lambda ad: hvg(ad),
+        'pca': lambda ad: pca(ad, n_comps=50, use_highly_variable=True),
+        'neighbors': lambda ad: neighbors(ad, n_neighbors=15, n_pcs=50),
+        'leiden': lambda ad: leiden(ad, resolution=1.0),
+    }
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    for n_obs in n_obs_list:
+        adata = None
+        for i, stage in enumerate(STAGES):
+            fname = stage_path(n_obs, stage)
+            if os.path.exists(fname):
+                adata = None
+                continue
+            if adata is None:
+                adata = (synthetic_counts(n_obs) if i == 0 else
+                         anndata.read_h5ad(stage_path(n_obs, STAGES[i - 1])))
+            if stage != 'raw':
+                steps[stage](adata)
+            adata.write(fname)
+
+
+def load(n_obs, stage):
+    """Read the dataset of `n_obs` cells as of after `stage`
+    """
+    import anndata
+    return anndata.read_h5ad(stage_path(n_obs, stage))
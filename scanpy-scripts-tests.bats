@@ -6,16 +6,32 @@ setup() {
     test_dir="post_install_tests"
     data_dir="${test_dir}/data"
     output_dir="${test_dir}/outputs"
+    importtime_log="${output_dir}/cli_importtime.log"
     test_data_url='https://s3-us-west-2.amazonaws.com/10x.files/samples/cell/pbmc3k/pbmc3k_filtered_gene_bc_matrices.tar.gz'
     test_data_archive="${test_dir}/$(basename $test_data_url)"
     raw_matrix="${data_dir}/matrix.mtx"
     read_opt="-x $data_dir --show-obj stdout"
     read_obj="${output_dir}/read.h5ad"
+    read_manifest="${output_dir}/manifest.tsv"
+    read_manifest_opt="-M $read_manifest -J 2 --mtx-cache-dir ${output_dir}/mtx_cache --show-obj stdout"
+    read_manifest_obj="${output_dir}/read_manifest.h5ad"
+    annotate_var="${output_dir}/extra_var.tsv"
+    annotate_opt="--extra-var $annotate_var --extra-var-columns ensembl_id --show-obj stdout"
+    annotate_obj="${output_dir}/annotate.h5ad"
     filter_opt="-p n_genes 200 2500 -p c:n_counts 0 50000 -p n_cells 3 inf -p pct_counts_mito 0 0.2 -c mito '!True' --show-obj stdout"
     filter_obj="${output_dir}/filter.h5ad"
+    filter_zarr_opt="-F zarr --zarr-threads 2 --zarr-compressor blosc-zstd"
+    filter_zarr="${output_dir}/filter.zarr"
+    refilter_opt="-f zarr -p n_genes 200 2500 --show-obj stdout"
+    refilter_obj="${output_dir}/refilter.h5ad"
+    serve_socket="${output_dir}/serve.sock"
+    serve_filter_obj="${output_dir}/filter_served.h5ad"
     norm_mtx="${output_dir}/norm"
     norm_opt="-r yes -t 10000 -X ${norm_mtx} --show-obj stdout"
     norm_obj="${output_dir}/norm.h5ad"
+    batch_manifest="${output_dir}/batch_manifest.tsv"
+    batch_norm_opt="-r yes -t 10000 --jobs 2"
+    batch_norm_obj="${output_dir}/norm_batch_{sample}.h5ad"
     hvg_opt="-m 0.0125 3 -d 0.5 inf -s --show-obj stdout"
     hvg_obj="${output_dir}/hvg.h5ad"
     regress_opt="-k n_counts --show-obj stdout"
@@ -25,6 +41,12 @@ setup() {
     pca_embed="${output_dir}/pca.tsv"
     pca_opt="--n-comps 50 -V auto --show-obj stdout -E ${pca_embed}"
     pca_obj="${output_dir}/pca.h5ad"
+    pca_float32_opt="--n-comps 50 -V auto --show-obj stdout"
+    pca_float32_obj="${output_dir}/pca_float32.h5ad"
+    neighbor_float32_opt="-k 10 -n 25 --show-obj stdout"
+    neighbor_float32_obj="${output_dir}/neighbor_float32.h5ad"
+    pca_budget_opt="--n-comps 50 -V auto"
+    pca_budget_obj="${output_dir}/pca_budget.h5ad"
     neighbor_opt="-k 5,10,20 -n 25 -m umap --show-obj stdout"
     neighbor_obj="${output_dir}/neighbor.h5ad"
     tsne_embed="${output_dir}/tsne.tsv"
@@ -33,6 +55,8 @@ setup() {
     umap_embed="${output_dir}/umap.tsv"
     umap_opt="--use-graph neighbors_k10 --min-dist 0.75 --alpha 1 --gamma 1 -E ${umap_embed}"
     umap_obj="${output_dir}/umap.h5ad"
+    umap_slim_opt="--use-graph neighbors_k10 --keep-slots obs,var,obsm:X_umap --drop-slots obs:n_genes --export-lite ${output_dir}/umap_lite.parquet"
+    umap_slim_obj="${output_dir}/umap_slim.h5ad"
     fdg_embed="${output_dir}/fdg.tsv"
     fdg_opt="--use-graph neighbors_k10 --layout fr -E ${fdg_embed}"
     fdg_obj="${output_dir}/fdg.h5ad"
@@ -44,6 +68,12 @@ setup() {
     diffexp_tsv="${output_dir}/diffexp.tsv"
     diffexp_opt="-g leiden_k10_r0_7 --reference rest --filter-params min_in_group_fraction:0.25,min_fold_change:1.5 --save ${diffexp_tsv} -f loom"
     diffexp_obj="${output_dir}/diffexp.h5ad"
+    diffexp_native_tsv="${output_dir}/diffexp_native.tsv"
+    diffexp_native_opt="-g leiden_k10_r0_7 --reference rest --method wilcoxon --engine native --save ${diffexp_native_tsv} -f loom"
+    diffexp_native_obj="${output_dir}/diffexp_native.h5ad"
+    diffexp_pairs_tsv="${output_dir}/diffexp_pairs.tsv"
+    diffexp_pairs_opt="-g leiden_k10_r0_7 --all-pairs --method wilcoxon -n 50 --save ${diffexp_pairs_tsv} -f loom"
+    diffexp_pairs_obj="${output_dir}/diffexp_pairs.h5ad"
     paga_opt="--use-graph neighbors_k10 --key-added k10_r0_7 --groups leiden_k10_r0_7 --model v1.2 -f loom"
     paga_obj="${output_dir}/paga.h5ad"
     diffmap_embed="${output_dir}/diffmap.tsv"
@@ -51,6 +81,10 @@ setup() {
     diffmap_obj="${output_dir}/diffmap.h5ad"
     dpt_opt="--use-graph neighbors_k10 --key-added k10 --n-dcs 10 --root leiden_k10_r0_7 0"
     dpt_obj="${output_dir}/dpt.h5ad"
+    pipeline_steps="${output_dir}/pipeline.json"
+    pipeline_opt="-s ${pipeline_steps} -J 3 --checkpoint-dir ${output_dir}/pipeline_checkpoints --show-obj stdout"
+    pipeline_obj="${output_dir}/pipeline.h5ad"
+    pipeline_resumed_obj="${output_dir}/pipeline_resumed.h5ad"
     plt_embed_opt="--color leiden_k10_r0_7 -f loom --title test"
     plt_embed_pdf="${output_dir}/umap_leiden_k10_r0_7.pdf"
     plt_paga_opt="--use-key paga_k10_r0_7 --node-size-scale 2 --edge-width-scale 0.5 --basis diffmap --color dpt_pseudotime_k10 --frameoff"
@@ -89,6 +123,20 @@ setup() {
     [ -f "$raw_matrix" ]
 }
 
+# CLI startup
+
+@test "CLI startup does not import analysis libraries" {
+    run bash -c "python -X importtime -c 'import scanpy_scripts.cli' 2> $importtime_log"
+
+    [ "$status" -eq 0 ]
+
+    # the last line holds the cumulative import time of scanpy_scripts.cli
+    tail -n 1 $importtime_log
+    run grep -E '\| +(scanpy|anndata|matplotlib|loompy|igraph)$' $importtime_log
+
+    [ "$status" -eq 1 ]
+}
+
 # Read 10x dataset
 
 @test "Scanpy object creation from 10x" {
@@ -102,6 +150,32 @@ setup() {
     [ -f  "$read_obj" ]
 }
 
+@test "Scanpy object creation from a manifest of 10x samples" {
+    if [ "$resume" = 'true' ] && [ -f "$read_manifest_obj" ]; then
+        skip "$read_manifest_obj exists and resume is set to 'true'"
+    fi
+
+    printf "s1\t$(pwd)/${data_dir}\ns2\t$(pwd)/${data_dir}\n" > $read_manifest
+    run rm -f $read_manifest_obj && eval "$scanpy read $read_manifest_opt $read_manifest_obj"
+
+    [ "$status" -eq 0 ]
+    [ -f  "$read_manifest_obj" ]
+}
+
+# Annotate
+
+@test "Attach extra gene metadata to an existing object" {
+    if [ "$resume" = 'true' ] && [ -f "$annotate_obj" ]; then
+        skip "$annotate_obj exists and resume is set to 'true'"
+    fi
+
+    awk 'BEGIN {print "gene\tensembl_id"} !seen[$2]++ {print $2"\t"$1}' ${data_dir}/genes.tsv > $annotate_var
+    run rm -f $annotate_obj && eval "$scanpy annotate $annotate_opt $read_obj $annotate_obj"
+
+    [ "$status" -eq 0 ]
+    [ -f  "$annotate_obj" ]
+}
+
 # Filter
 
 @test "Filter cells and genes from a raw object" {
@@ -115,6 +189,47 @@ setup() {
     [ -f  "$filter_obj" ]
 }
 
+# Write zarr output
+
+@test "Filter cells and genes and write zarr output" {
+    if [ "$resume" = 'true' ] && [ -d "$filter_zarr" ]; then
+        skip "$filter_zarr exists and resume is set to 'true'"
+    fi
+
+    run rm -rf $filter_zarr && eval "$scanpy filter $filter_opt $filter_zarr_opt $read_obj $filter_zarr"
+
+    [ "$status" -eq 0 ]
+    [ -d  "$filter_zarr" ]
+}
+
+# Read zarr input
+
+@test "Filter cells and genes from lazily loaded zarr input" {
+    if [ "$resume" = 'true' ] && [ -f "$refilter_obj" ]; then
+        skip "$refilter_obj exists and resume is set to 'true'"
+    fi
+
+    run rm -f $refilter_obj && eval "$scanpy filter $refilter_opt $filter_zarr $refilter_obj"
+
+    [ "$status" -eq 0 ]
+    [ -f  "$refilter_obj" ]
+}
+
+@test "Filter cells and genes through a server" {
+    if [ "$resume" = 'true' ] && [ -f "$serve_filter_obj" ]; then
+        skip "$serve_filter_obj exists and resume is set to 'true'"
+    fi
+
+    $scanpy serve --socket $serve_socket 3>&- &
+    server_pid=$!
+    for i in $(seq 60); do [ -S "$serve_socket" ] && break; sleep 1; done
+    run rm -f $serve_filter_obj && eval "$scanpy --connect $serve_socket filter $filter_opt --no-cache $read_obj $serve_filter_obj"
+    kill $server_pid && wait $server_pid
+
+    [ "$status" -eq 0 ]
+    [ -f  "$serve_filter_obj" ] && [ ! -e "$serve_socket" ]
+}
+
 # Normalise
 
 @test "Normalise expression values per cell" {
@@ -128,6 +243,18 @@ setup() {
     [ -f  "$norm_obj" ] && [ -f "${norm_mtx}_matrix.mtx" ]
 }
 
+@test "Run normalisation over a batch of objects" {
+    if [ "$resume" = 'true' ] && [ -f "${output_dir}/norm_batch_b.h5ad" ]; then
+        skip "${output_dir}/norm_batch_b.h5ad exists and resume is set to 'true'"
+    fi
+
+    printf "a\t%s\nb\t%s\n" "$(basename $filter_obj)" "$(basename $filter_obj)" > $batch_manifest
+    run rm -f ${output_dir}/norm_batch_*.h5ad && eval "$scanpy norm $batch_norm_opt --batch $batch_manifest '$batch_norm_obj'"
+
+    [ "$status" -eq 0 ]
+    [ -f "${output_dir}/norm_batch_a.h5ad" ] && [ -f "${output_dir}/norm_batch_b.h5ad" ]
+}
+
 # Find variable genes
 
 @test "Find variable genes" {
@@ -180,6 +307,48 @@ setup() {
     [ -f  "$pca_obj" ]
 }
 
+@test "Run principal component analysis in single precision" {
+    if [ "$resume" = 'true' ] && [ -f "$neighbor_float32_obj" ]; then
+        skip "$neighbor_float32_obj exists and resume is set to 'true'"
+    fi
+
+    run rm -f $pca_float32_obj $neighbor_float32_obj && eval "$scanpy --dtype float32 pca $pca_float32_opt $scale_obj $pca_float32_obj" && eval "$scanpy --dtype float32 neighbor $neighbor_float32_opt $pca_float32_obj $neighbor_float32_obj"
+
+    [ "$status" -eq 0 ]
+    [ -f  "$pca_float32_obj" ]
+    [ -f  "$neighbor_float32_obj" ]
+
+    run python -c "import anndata; adata = anndata.read_h5ad('$neighbor_float32_obj'); graph = adata.uns['neighbors_k10']; print(adata.X.dtype, adata.obsm['X_pca'].dtype, graph['connectivities'].dtype, graph['distances'].dtype)"
+
+    [ "$status" -eq 0 ]
+    [ "$output" = 'float32 float32 float32 float32' ]
+}
+
+@test "Estimate the cost of principal component analysis" {
+    run eval "$scanpy pca --dry-run $pca_budget_opt $scale_obj ${output_dir}/pca_dry_run.h5ad"
+
+    [ "$status" -eq 0 ]
+    [ ! -f "${output_dir}/pca_dry_run.h5ad" ]
+}
+
+@test "Run principal component analysis within a memory budget" {
+    if [ "$resume" = 'true' ] && [ -f "$pca_budget_obj" ]; then
+        skip "$pca_budget_obj exists and resume is set to 'true'"
+    fi
+
+    run rm -f $pca_budget_obj && eval "$scanpy --max-memory 2G pca $pca_budget_opt $scale_obj $pca_budget_obj"
+
+    [ "$status" -eq 0 ]
+    [ -f  "$pca_budget_obj" ]
+}
+
+@test "Refuse principal component analysis beyond the memory budget" {
+    run eval "$scanpy --max-memory 1M pca $pca_budget_opt $scale_obj ${output_dir}/pca_refused.h5ad"
+
+    [ "$status" -ne 0 ]
+    [ ! -f "${output_dir}/pca_refused.h5ad" ]
+}
+
 # Compute graph
 
 @test "Run compute neighbor graph" {
@@ -219,6 +388,17 @@ setup() {
     [ -f  "$umap_obj" ] && [ -f "$umap_embed" ]
 }
 
+@test "Run UMAP analysis and write a slim object" {
+    if [ "$resume" = 'true' ] && [ -f "$umap_slim_obj" ]; then
+        skip "$umap_slim_obj exists and resume is set to 'true'"
+    fi
+
+    run rm -f $umap_slim_obj && eval "$scanpy embed umap $umap_slim_opt $neighbor_obj $umap_slim_obj"
+
+    [ "$status" -eq 0 ]
+    [ -f  "$umap_slim_obj" ] && [ -f "${output_dir}/umap_lite.parquet" ]
+}
+
 # Run FDG
 
 @test "Run FDG analysis" {
@@ -271,6 +451,28 @@ setup() {
     [ -f  "$diffexp_obj" ] && [ -f "$diffexp_tsv" ]
 }
 
+@test "Run find markers with the native engine" {
+    if [ "$resume" = 'true' ] && [ -f "$diffexp_native_obj" ]; then
+        skip "$diffexp_native_obj exists and resume is set to 'true'"
+    fi
+
+    run rm -f $diffexp_native_obj $diffexp_native_tsv && eval "$scanpy diffexp $diffexp_native_opt $leiden_obj $diffexp_native_obj"
+
+    [ "$status" -eq 0 ]
+    [ -f  "$diffexp_native_obj" ] && [ -f "$diffexp_native_tsv" ]
+}
+
+@test "Run find markers between all pairs of clusters" {
+    if [ "$resume" = 'true' ] && [ -f "$diffexp_pairs_tsv" ]; then
+        skip "$diffexp_pairs_tsv exists and resume is set to 'true'"
+    fi
+
+    run rm -f $diffexp_pairs_obj $diffexp_pairs_tsv && eval "$scanpy diffexp $diffexp_pairs_opt $leiden_obj $diffexp_pairs_obj"
+
+    [ "$status" -eq 0 ]
+    [ -f  "$diffexp_pairs_obj" ] && [ -f "$diffexp_pairs_tsv" ]
+}
+
 # Run PAGA
 
 @test "Run PAGA" {
@@ -310,6 +512,39 @@ setup() {
     [ -f  "$dpt_obj" ]
 }
 
+# Run a pipeline
+
+@test "Run independent steps after neighbors as a pipeline" {
+    if [ "$resume" = 'true' ] && [ -f "$pipeline_obj" ]; then
+        skip "$pipeline_obj exists and resume is set to 'true'"
+    fi
+
+    cat > $pipeline_steps <<EOF
+{"steps": [
+    {"name": "umap", "command": "embed umap", "args": "--use-graph neighbors_k10 --min-dist 0.75"},
+    {"name": "louvain", "command": "cluster louvain", "args": "-r 1 --use-graph neighbors_k10 --key-added k10"},
+    {"name": "leiden", "command": "cluster leiden", "args": "-r 0.7 --use-graph neighbors_k10 --key-added k10"},
+    {"name": "paga", "command": "paga", "args": "--use-graph neighbors_k10 --key-added k10_r0_7 --groups leiden_k10_r0_7", "after": ["leiden"]}
+]}
+EOF
+    run rm -f $pipeline_obj && eval "$scanpy pipeline $pipeline_opt $neighbor_obj $pipeline_obj"
+
+    [ "$status" -eq 0 ]
+    [ -f  "$pipeline_obj" ]
+}
+
+@test "Resume a pipeline from its checkpoints" {
+    if [ "$resume" = 'true' ] && [ -f "$pipeline_resumed_obj" ]; then
+        skip "$pipeline_resumed_obj exists and resume is set to 'true'"
+    fi
+
+    run rm -f $pipeline_resumed_obj && eval "$scanpy pipeline $pipeline_opt --resume $neighbor_obj $pipeline_resumed_obj"
+
+    [ "$status" -eq 0 ]
+    [ -f  "$pipeline_resumed_obj" ]
+    [[ "$output" == *'"paga" resumed from checkpoint'* ]]
+}
+
 # Run Plot embedding
 
 @test "Run Plot embedding" {
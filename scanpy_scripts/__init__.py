@@ -1,9 +1,15 @@
 """
 Provides version, author and exports
 """
-import pkg_resources
+try:
+    from importlib.metadata import version as _version
+except ImportError:
+    from pkg_resources import get_distribution
 
-__version__ = pkg_resources.get_distribution('scanpy-scripts').version
+    def _version(name):
+        return get_distribution(name).version
+
+__version__ = _version('scanpy-scripts')
 
 __author__ = ', '.join([
     'Ni Huang',
@@ -12,4 +18,10 @@ __author__ = ', '.join([
     'Philipp Angerer',
 ])
 
-from . import lib
+
+def __getattr__(name):
+    # `lib` imports scanpy, only load it when accessed
+    if name == 'lib':
+        import importlib
+        return importlib.import_module('.lib', __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,264 @@
+"""batch_utils
+
+Run a sub-command over many input objects, for `--batch`.
+
+With `--batch`, <input_obj> is either a glob pattern of input objects, quoted
+so that the shell leaves it alone, or a manifest of them, one per line in the
+form "<sample> <path>" as taken by `read --input-manifest`. Every "{sample}" in
+<output_obj> and in other options naming files is replaced by the sample
+name, which is the file name without extension for a glob. With more than
+one input, every output file given must contain "{sample}".
+
+Inputs are run in forked processes. Up to `--jobs` run at a time, within the
+thread budget. With `--max-memory`, only as many run as the budget holds at
+the estimated peak memory of the command on the largest input. Each process
+gets an equal share of the threads and memory. A failing input does not stop
+the others, and a summary of all of them is printed at the end.
+"""
+
+import glob
+import logging
+import os
+import time
+import traceback
+
+import click
+
+from .thread_utils import (
+    default_n_threads,
+    set_thread_budget,
+    worker_thread_budget,
+)
+
+SAMPLE_FIELD = '{sample}'
+
+
+def batch_inputs(input_obj):
+    """Return the (sample, path) pairs of a glob pattern or a manifest
+
+    Paths of a manifest are relative to it if not absolute.
+    """
+    if glob.has_magic(input_obj):
+        paths = sorted(glob.glob(input_obj))
+        samples = [_sample_name(path) for path in paths]
+    else:
+        import pandas as pd
+        manifest = pd.read_csv(
+            input_obj, sep='\t', header=None, names=['sample', 'path'],
+            comment='#', dtype=str)
+        manifest_dir = os.path.dirname(os.path.abspath(input_obj))
+        samples = list(manifest['sample'])
+        paths = [os.path.join(manifest_dir, path) for path in manifest['path']]
+    if not paths:
+        raise click.ClickException(f'No input objects found in {input_obj}')
+    duplicated = sorted({sample for sample in samples if samples.count(sample) > 1})
+    if duplicated:
+        raise click.ClickException(
+            f'Duplicated sample names in {input_obj}: {", ".join(duplicated)}')
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise click.ClickException(
+            f'Input objects not found: {", ".join(missing)}')
+    return list(zip(samples, paths))
+
+
+def _sample_name(path):
+    # zarr stores are directories, possibly given with a trailing slash
+    return os.path.splitext(os.path.basename(path.rstrip(os.sep)))[0]
+
+
+def _sample_params(params, sample, path):
+    """Parameters of the command for one input, with "{sample}" replaced in
+    every text option
+    """
+    sample_params = {
+        key: val.replace(SAMPLE_FIELD, sample) if isinstance(val, str) else val
+        for key, val in params.items()
+    }
+    sample_params.update(input_obj=path, batch=False, jobs=None)
+    return sample_params
+
+
+def run_batch(func, params, cmd_name, kwargs, n_jobs=None, max_memory=None,
+              lazy=False):
+    """Run a sub-command once per input of a batch and report on all of them
+
+    * Parameters
+        + func : callable
+        Callback of the sub-command
+        + params : dict
+        Parameters of the sub-command, with the glob pattern or manifest as
+        `input_obj`, and "{sample}" standing for the sample name in text
+        options
+        + cmd_name : str
+        Name of the command, as keyed in the cost models of `cost_utils`
+        + kwargs : dict
+        Options passed to the function of the command, for its cost model
+        + n_jobs : int
+        Number of inputs run at the same time, by default as many as the
+        thread budget allows
+        + max_memory : int
+        Memory budget in bytes shared by the inputs run at the same time
+        + lazy : bool
+        Whether `.X` of zarr input is left on disk by the command
+    """
+    import multiprocessing
+    from multiprocessing.connection import wait
+
+    inputs = batch_inputs(params['input_obj'])
+    if len(inputs) > 1:
+        shared = _shared_outputs(click.get_current_context().command, params)
+        if shared:
+            raise click.ClickException(
+                f'{", ".join(shared)} must contain "{SAMPLE_FIELD}" with '
+                '--batch, or inputs would overwrite each other\'s files')
+
+    n_jobs = min(default_n_threads(n_jobs), len(inputs))
+    if max_memory:
+        n_jobs = min(n_jobs, _jobs_within_memory(
+            inputs, max_memory, cmd_name, params.get('input_format'), kwargs,
+            lazy))
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        n_jobs = 1
+    logging.info('Running %s on %d inputs, %d at a time',
+                 cmd_name, len(inputs), n_jobs)
+
+    reports = []
+    if n_jobs == 1:
+        for sample, path in inputs:
+            start = time.perf_counter()
+            status, message = _run_input(
+                func, _sample_params(params, sample, path))
+            reports.append((sample, status, time.perf_counter() - start, message))
+        return _summarise(reports, params)
+
+    mp_context = multiprocessing.get_context('fork')
+    n_threads = worker_thread_budget(n_jobs)
+    memory_share = max_memory // n_jobs if max_memory else None
+    pending = list(inputs)
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < n_jobs:
+                sample, path = pending.pop(0)
+                conn, child_conn = mp_context.Pipe(duplex=False)
+                proc = mp_context.Process(
+                    target=_run_child,
+                    args=(child_conn, func, _sample_params(params, sample, path),
+                          n_threads, memory_share),
+                    name=f'scanpy-batch-{sample}',
+                )
+                proc.start()
+                child_conn.close()
+                running[conn] = (sample, proc, time.perf_counter())
+            for conn in wait(list(running)):
+                sample, proc, start = running.pop(conn)
+                try:
+                    status, message = conn.recv()
+                except EOFError:
+                    status, message = 'failed', None
+                conn.close()
+                proc.join()
+                if message is None:
+                    message = f'exited with code {proc.exitcode}'
+                reports.append(
+                    (sample, status, time.perf_counter() - start, message))
+    finally:
+        for _, proc, _ in running.values():
+            proc.terminate()
+    return _summarise(reports, params)
+
+
+def _shared_outputs(command, params):
+    """Names of the output file options that are set without "{sample}"
+    """
+    shared = []
+    for param in command.params:
+        value = params.get(param.name)
+        if (isinstance(param.type, click.Path) and param.type.writable and
+                isinstance(value, str) and SAMPLE_FIELD not in value):
+            shared.append(param.opts[0] if isinstance(param, click.Option)
+                          else param.metavar)
+    return shared
+
+
+def _jobs_within_memory(inputs, max_memory, cmd_name, input_format, kwargs,
+                        lazy):
+    """Number of inputs that can run at the same time within `max_memory`,
+    from the estimated peak memory of the command on the largest input
+    """
+    from .estimate_utils import calibrate, estimate_cost
+    from .memory_utils import format_size
+
+    rates = calibrate()[0]
+    peak = 0
+    for _, path in inputs:
+        try:
+            estimate = estimate_cost(
+                cmd_name, path, input_format=input_format, kwargs=kwargs,
+                lazy=lazy, rates=rates)
+        except (OSError, KeyError, ValueError) as e:
+            # reported when the command runs on it
+            logging.warning('Cannot estimate the cost of %s: %s', path, e)
+            continue
+        if estimate is None:
+            # no cost model, leave it to --jobs
+            return len(inputs)
+        peak = max(peak, estimate.resident + estimate.needed)
+    n_jobs = max(1, int(max_memory // max(peak, 1)))
+    logging.info('Estimated peak memory per input %s, %d fit within '
+                 '--max-memory %s', format_size(peak), n_jobs,
+                 format_size(max_memory))
+    return n_jobs
+
+
+def _run_input(func, params):
+    """Run the command on one input, returning its status and error message
+    """
+    try:
+        func(**params)
+    except click.ClickException as e:
+        return 'failed', e.format_message()
+    except Exception as e:
+        logging.error('Failed on %s:\n%s', params['input_obj'],
+                      traceback.format_exc())
+        return 'failed', f'{type(e).__name__}: {e}'
+    return 'ok', ''
+
+
+def _run_child(conn, func, params, n_threads, max_memory):
+    """Run the command on one input in a forked process and send back its
+    status
+    """
+    try:
+        # read again by the command from the options of the top-level group
+        root_params = click.get_current_context().find_root().params
+        root_params['threads'] = n_threads
+        if max_memory:
+            root_params['max_memory'] = max_memory
+        set_thread_budget(n_threads)
+        conn.send(_run_input(func, params))
+    except BaseException as e:
+        conn.send(('failed', f'{type(e).__name__}: {e}'))
+    finally:
+        conn.close()
+
+
+def _summarise(reports, params):
+    """Print a line per input and fail if any of them did
+    """
+    n_failed = sum(status != 'ok' for _, status, _, _ in reports)
+    click.echo(f'Batch of {len(reports)} inputs: '
+               f'{len(reports) - n_failed} done, {n_failed} failed', err=True)
+    width = max(len(sample) for sample, _, _, _ in reports)
+    output_obj = params.get('output_obj')
+    for sample, status, seconds, message in sorted(reports):
+        if status == 'ok' and output_obj and not params.get('dry_run'):
+            message = output_obj.replace(SAMPLE_FIELD, sample)
+        click.echo(f'  {sample:<{width}}  {status:<6}  {seconds:8.1f}s  '
+                   f'{message.strip().splitlines()[-1] if message else ""}',
+                   err=True)
+    if n_failed:
+        raise click.ClickException(
+            f'{n_failed} of {len(reports)} inputs failed')
+    return 0
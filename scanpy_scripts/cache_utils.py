@@ -0,0 +1,174 @@
+"""cache_utils
+
+Content-addressed cache of sub-command results.
+
+A result is keyed by a hash of the input object's content together with the
+command name, its normalised parameters, the content of any input files
+passed as parameters and the versions of scanpy-scripts and scanpy. Results
+are stored as h5ad files named after the key in a local cache directory, which
+is kept under a size limit by evicting the least recently used entries.
+
+Caching is opt-in, with `--cache`, `--cache-dir` or `$SCANPY_SCRIPTS_CACHE_DIR`
+as decided by `cache_enabled`.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+_HASH_BLOCK_SIZE = 16 * 1024 * 1024
+
+CACHE_DIR_ENV = 'SCANPY_SCRIPTS_CACHE_DIR'
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    CACHE_DIR_ENV,
+    os.path.join(os.path.expanduser('~'), '.cache', 'scanpy-scripts'),
+)
+
+DEFAULT_CACHE_SIZE = 20.0
+
+
+def cache_enabled(use_cache=False, cache_dir=None, no_cache=False):
+    """Whether results are cached, which is only when asked for with
+    `--cache` or `--cache-dir`, or with the cache directory set in the
+    environment, and never with `--no-cache`
+
+    Hashing inputs and copying outputs costs time and disk on every run, so
+    it is left to workflows that expect to rerun the same steps.
+    """
+    if no_cache:
+        return False
+    return bool(use_cache or cache_dir or os.environ.get(CACHE_DIR_ENV))
+
+
+def hash_path(path, digest=None):
+    """Update `digest` with the content of a file, or of all files under a
+    directory in sorted order, and return it
+    """
+    if digest is None:
+        digest = hashlib.blake2b(digest_size=20)
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for fname in sorted(files):
+                fpath = os.path.join(root, fname)
+                digest.update(os.path.relpath(fpath, path).encode())
+                hash_path(fpath, digest)
+        return digest
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(_HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest
+
+
+def cache_key(input_obj, cmd_name, params):
+    """Return the cache key of running `cmd_name` with `params` on `input_obj`
+
+    * Parameters
+        + input_obj : str
+        Path of the input object file or directory
+        + cmd_name : str
+        Name of the sub-command
+        + params : dict
+        Keyword arguments passed to the sub-command function
+
+    * Returns
+        + key : str
+        Hex digest
+    """
+    import scanpy as sc
+    from . import __version__
+
+    digest = hash_path(input_obj)
+    normalised = {}
+    for name, value in sorted(params.items()):
+        if isinstance(value, str) and os.path.exists(value):
+            normalised[name] = hash_path(value).hexdigest()
+        else:
+            normalised[name] = value
+    digest.update(json.dumps(
+        [cmd_name, normalised, __version__, sc.__version__],
+        sort_keys=True, default=repr).encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Directory of cached results with least-recently-used eviction
+
+    * Parameters
+        + cache_dir : str
+        Cache directory, created on first store
+        + max_size : float
+        Maximum total size in GB, older entries are evicted beyond it
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR,
+                 max_size=DEFAULT_CACHE_SIZE):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.max_bytes = int(max_size * 1024 ** 3)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.h5ad')
+
+    def load(self, key):
+        """Return the cached AnnData object of `key`, or None on a miss
+        """
+        import anndata
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            adata = anndata.read_h5ad(path)
+        except (OSError, KeyError, ValueError) as e:
+            logging.warning('discarding unreadable cache entry %s: %s',
+                            path, e)
+            os.remove(path)
+            return None
+        # mtime marks the last use for eviction
+        os.utime(path)
+        logging.info('loaded cached result %s', path)
+        return adata
+
+    def store(self, key, adata=None, h5ad_file=None):
+        """Store a result, either an AnnData object or an existing h5ad file
+        which is copied, then evict entries beyond the size limit
+        """
+        if self.max_bytes <= 0:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            if h5ad_file is not None:
+                shutil.copyfile(h5ad_file, tmp_path)
+            else:
+                from .link_utils import write_h5ad
+                write_h5ad(adata, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning('failed to cache result %s: %s', path, e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        logging.debug('cached result %s', path)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until within the size limit
+        """
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith('.h5ad'):
+                continue
+            path = os.path.join(self.cache_dir, fname)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logging.debug('evicting cached result %s', path)
+            os.remove(path)
+            total -= size
@@ -3,11 +3,15 @@ scanpy
 """
 
 import logging
+import sys
 import click
-import scanpy as sc
-from .click_utils import NaturalOrderGroup
+from . import serve_utils
+from .click_utils import MemorySize, NaturalOrderGroup
+from .dtype_utils import DTYPES, set_dtype_policy
+from .thread_utils import set_thread_budget
 from .cmds import (
     READ_CMD,
+    ANNOTATE_CMD,
     FILTER_CMD,
     NORM_CMD,
     HVG_CMD,
@@ -24,6 +28,7 @@ from .cmds import (
     PAGA_CMD,
     DIFFMAP_CMD,
     DPT_CMD,
+    PIPELINE_CMD,
     PLOT_EMBED_CMD,
     PLOT_PAGA_CMD,
     PLOT_STACKED_VIOLIN_CMD,
@@ -46,14 +51,63 @@ from .cmds import (
     default=3,
     help='Set scanpy verbosity',
 )
+@click.option(
+    '--threads', '-t',
+    type=click.IntRange(min=1),
+    default=None,
+    help='Limit every step to this many CPU threads: BLAS/OpenMP, numba, '
+    'scanpy\'s n_jobs and parallel readers/writers of scanpy-scripts. No '
+    'limit by default.',
+)
+@click.option(
+    '--profile',
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help='Record wall time, CPU time and peak memory of reading, running and '
+    'writing, as JSON lines appended to this file, or printed to standard '
+    'error if "stderr". Records are also kept in `.uns["scanpy_scripts_runs"]` '
+    'of the output object.',
+)
+@click.option(
+    '--dtype',
+    type=click.Choice(DTYPES),
+    default=None,
+    help='Cast floating point matrices to this precision when reading, after '
+    'each step and before writing: `.X`, `.raw.X`, layers, embeddings and '
+    'graphs. float32 halves their memory and file size. Kept as each step '
+    'produces them by default.',
+)
+@click.option(
+    '--max-memory',
+    type=MemorySize(),
+    default=None,
+    help='Keep every step within this much memory, e.g. 16G. Once the input '
+    'is read, the peak memory of the step is estimated from the shape, '
+    'density and dtype of the data. Steps with a chunked code path switch to '
+    'it if needed, others stop early if they would not fit. No limit by '
+    'default.',
+)
+@click.option(
+    '--connect',
+    type=click.Path(dir_okay=False),
+    default=None,
+    help='Run the command on the server listening on this socket, started '
+    'by `scanpy-cli serve`, instead of in this process.',
+)
 @click.version_option(
     version='0.2.0',
     prog_name='scanpy',
 )
-def cli(debug=False, verbosity=3):
+@click.pass_context
+def cli(ctx, debug=False, verbosity=3, threads=None, profile=None,
+        dtype=None, max_memory=None, connect=None):
     """
     Command line interface to [scanpy](https://github.com/theislab/scanpy)
     """
+    if connect and serve_utils.object_cache is None:
+        # a thin client, the server runs the same command line, where this
+        # option is ignored
+        ctx.exit(serve_utils.run_remote(connect, sys.argv[1:]))
     log_level = logging.DEBUG if debug else logging.INFO
     logging.basicConfig(
         level=log_level,
@@ -62,11 +116,17 @@ def cli(debug=False, verbosity=3):
         datefmt='%y-%m-%d %H:%M:%S',
     )
     logging.debug('debugging')
-    sc.settings.verbosity = verbosity
+    # before numpy, numba and scanpy are imported by the sub-command
+    set_thread_budget(threads)
+    # also reset between commands run by a server
+    set_dtype_policy(dtype)
+    # scanpy verbosity is set when a sub-command runs, to avoid importing
+    # scanpy here
     return 0
 
 
 cli.add_command(READ_CMD)
+cli.add_command(ANNOTATE_CMD)
 cli.add_command(FILTER_CMD)
 cli.add_command(NORM_CMD)
 cli.add_command(HVG_CMD)
@@ -99,6 +159,7 @@ cluster.add_command(LEIDEN_CMD)
 cli.add_command(DIFFEXP_CMD)
 cli.add_command(PAGA_CMD)
 cli.add_command(DPT_CMD)
+cli.add_command(PIPELINE_CMD)
 
 
 @cli.group(cls=NaturalOrderGroup)
@@ -112,3 +173,23 @@ plot.add_command(PLOT_STACKED_VIOLIN_CMD)
 plot.add_command(PLOT_DOT_CMD)
 plot.add_command(PLOT_MATRIX_CMD)
 plot.add_command(PLOT_HEATMAP_CMD)
+
+
+@cli.command()
+@click.option(
+    '--socket', 'socket_path',
+    type=click.Path(dir_okay=False),
+    default=serve_utils.DEFAULT_SOCKET,
+    show_default=True,
+    help='Unix socket to listen on.',
+)
+@click.option(
+    '--max-objects',
+    type=click.IntRange(min=0),
+    default=serve_utils.DEFAULT_MAX_OBJECTS,
+    show_default=True,
+    help='Number of objects kept in memory between commands.',
+)
+def serve(socket_path, max_objects):
+    """Serve commands sent with --connect until interrupted."""
+    return serve_utils.serve(cli, socket_path, max_objects)
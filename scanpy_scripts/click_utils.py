@@ -2,7 +2,10 @@
 Provide helper functions for command line parsing with click
 """
 
+import glob
 import click
+from .memory_utils import parse_size
+from .slot_utils import parse_slots
 
 
 class NaturalOrderGroup(click.Group):
@@ -101,6 +104,31 @@ class Dictionary(click.ParamType):
             )
 
 
+class InputPath(click.Path):
+    """
+    Path of an input, or a glob pattern of inputs left to the command
+    """
+    def convert(self, value, param, ctx):
+        if isinstance(value, str) and glob.has_magic(value):
+            return value
+        return super().convert(value, param, ctx)
+
+
+class MemorySize(click.ParamType):
+    """
+    Amount of memory, in bytes or with a K, M, G or T suffix
+    """
+    name = 'SIZE'
+
+    def convert(self, value, param, ctx):
+        if value is None or isinstance(value, int):
+            return value
+        try:
+            return parse_size(value)
+        except ValueError as e:
+            self.fail(str(e), param, ctx)
+
+
 def _get_type_name(obj):
     name = 'text'
     try:
@@ -125,17 +153,26 @@ def valid_parameter_limits(ctx, param, value):
     return value
 
 
-def mutually_exclusive_with(param_name):
-    internal_name = param_name.strip('-').replace('-', '_').lower()
+def valid_slots(ctx, param, value):
+    try:
+        return parse_slots(value)
+    except ValueError as e:
+        param.type.fail(str(e), param, ctx)
+
+
+def mutually_exclusive_with(*param_names):
+    internal_names = [
+        name.strip('-').replace('-', '_').lower() for name in param_names]
     def valid_mutually_exclusive(ctx, param, value):
         try:
-            other_value = ctx.params[internal_name]
+            other_values = [ctx.params[name] for name in internal_names]
         except KeyError:
             return value
-        if (value is None) == (other_value is None):
+        n_specified = sum(val is not None for val in [value] + other_values)
+        if n_specified != 1:
             param.type.fail(
                 'mutually exclusive with "{}", one and only one must be '
-                'specified.'.format(param_name),
+                'specified.'.format('", "'.join(param_names)),
                 param,
                 ctx,
             )
@@ -6,25 +6,57 @@ import click
 from .click_utils import (
     CommaSeparatedText,
     Dictionary,
+    InputPath,
     valid_limit,
     valid_parameter_limits,
+    valid_slots,
     mutually_exclusive_with,
     required_by,
 )
+from .cache_utils import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE
 
 COMMON_OPTIONS = {
     'input': [
         click.argument(
             'input_obj',
             metavar='<input_obj>',
-            type=click.Path(exists=True, dir_okay=False),
+            type=InputPath(exists=True),
         ),
         click.option(
             '--input-format', '-f',
-            type=click.Choice(['anndata', 'loom']),
+            type=click.Choice(['anndata', 'loom', 'zarr']),
             default='anndata',
             show_default=True,
-            help='Input object format.',
+            help='Input object format. With zarr, `pca --chunked` streams '
+            'over .X without loading it, and `filter` computes its metrics '
+            'that way but still loads .X to subset the object.',
+        ),
+        click.option(
+            '--dry-run',
+            is_flag=True,
+            default=False,
+            help='Print the estimated runtime, peak memory and output size '
+            'of the command for the options given, from the headers of the '
+            'input object, and exit without running it.',
+        ),
+        click.option(
+            '--batch',
+            is_flag=True,
+            default=False,
+            help='Run the command on every input object matching <input_obj> '
+            'as a quoted glob pattern, or listed in <input_obj> as a '
+            'tab-separated manifest without header, one per line in the form '
+            'of "<sample> <path>". "{sample}" in <output_obj> and other file '
+            'options is replaced by the sample name, the file name without '
+            'extension for a glob. Inputs that fail do not stop the others.',
+        ),
+        click.option(
+            '--jobs',
+            type=click.IntRange(min=1),
+            default=None,
+            help='Number of inputs of --batch run at the same time, also '
+            'limited by --max-memory. By default as many as the thread budget '
+            'allows.',
         ),
     ],
 
@@ -44,9 +76,25 @@ COMMON_OPTIONS = {
         click.option(
             '--zarr-chunk-size', '-z',
             type=click.INT,
-            default=1000,
+            default=None,
+            show_default=True,
+            help='Chunk size for writing output in zarr format. By default '
+            'chosen from the shape and dtype of the matrix.',
+        ),
+        click.option(
+            '--zarr-threads',
+            type=click.INT,
+            default=None,
             show_default=True,
-            help='Chunk size for writing output in zarr format.',
+            help='Number of threads writing zarr chunks concurrently. By default '
+            'the --threads budget, or all available CPUs without one.',
+        ),
+        click.option(
+            '--zarr-compressor',
+            type=click.Choice(['blosc-lz4', 'blosc-zstd', 'zstd', 'none']),
+            default='blosc-lz4',
+            show_default=True,
+            help='Compressor for writing output in zarr format.',
         ),
         click.option(
             '--export-mtx', '-X',
@@ -64,6 +112,73 @@ COMMON_OPTIONS = {
             show_default=True,
             help='Print output object summary info to specified stream.',
         ),
+        click.option(
+            '--no-compact',
+            is_flag=True,
+            default=False,
+            help='Write the object as is, without making sparse indices int32, '
+            'string columns with few distinct values categorical, and dropping '
+            'the copies of n_counts, n_genes and n_cells named after '
+            'sc.pp.calculate_qc_metrics.',
+        ),
+        click.option(
+            '--keep-slots',
+            type=CommaSeparatedText(),
+            callback=valid_slots,
+            default=None,
+            help='Write only these slots of the output object, among obs, var, '
+            'obsm, varm, uns, layers and raw, or only these keys of a slot, '
+            'given as slot:key, e.g. "obs,obsm:X_umap,uns:leiden_colors". '
+            '`.X` is always written.',
+        ),
+        click.option(
+            '--drop-slots',
+            type=CommaSeparatedText(),
+            callback=valid_slots,
+            default=None,
+            help='Do not write these slots or slot:key of the output object, '
+            'e.g. "raw,layers,uns:rank_genes_groups".',
+        ),
+        click.option(
+            '--export-lite',
+            type=click.Path(dir_okay=False, writable=True),
+            default=None,
+            help='Also export the cell metadata and embeddings of the output '
+            'object in a table, for quick loading. Format is chosen by file '
+            'extension: ".npy", ".parquet", ".feather", ".tsv.gz" '
+            '(gzip-compressed tab-separated text), otherwise tab-separated '
+            'text.',
+        ),
+        click.option(
+            '--cache', 'use_cache',
+            is_flag=True,
+            default=False,
+            help='Reuse the cached result of the same input and parameters if '
+            'any, otherwise cache the result. Also turned on by --cache-dir or '
+            'environment variable SCANPY_SCRIPTS_CACHE_DIR.',
+        ),
+        click.option(
+            '--no-cache',
+            is_flag=True,
+            default=False,
+            help='Always run the command and cache nothing, even if caching is '
+            'turned on by --cache-dir or SCANPY_SCRIPTS_CACHE_DIR.',
+        ),
+        click.option(
+            '--cache-dir',
+            type=click.Path(file_okay=False),
+            default=None,
+            help='Directory of cached results, also set by environment variable '
+            f'SCANPY_SCRIPTS_CACHE_DIR. [default: {DEFAULT_CACHE_DIR}]',
+        ),
+        click.option(
+            '--cache-size',
+            type=click.FLOAT,
+            default=DEFAULT_CACHE_SIZE,
+            show_default=True,
+            help='Maximum size of the result cache in GB, least recently used '
+            'results are evicted beyond it. 0 disables storing results.',
+        ),
     ],
 
     'plot': [
@@ -111,6 +226,43 @@ COMMON_OPTIONS = {
         ),
     ],
 
+    'extra_metadata': [
+        click.option(
+            '--extra-obs',
+            type=click.Path(exists=True, dir_okay=False),
+            default=None,
+            show_default=True,
+            help='Extra cell metadata table, must be tab-separated with a header '
+            'row and an index column. Rows are matched to cells by the index, '
+            'cells absent from the table get missing values.',
+        ),
+        click.option(
+            '--extra-obs-columns',
+            type=CommaSeparatedText(),
+            default=None,
+            show_default=True,
+            help='Only read these columns of "--extra-obs", all columns if not '
+            'specified.',
+        ),
+        click.option(
+            '--extra-var',
+            type=click.Path(exists=True, dir_okay=False),
+            default=None,
+            show_default=True,
+            help='Extra gene metadata table, must be tab-separated with a header '
+            'row and an index column. Rows are matched to genes by the index, '
+            'genes absent from the table get missing values.',
+        ),
+        click.option(
+            '--extra-var-columns',
+            type=CommaSeparatedText(),
+            default=None,
+            show_default=True,
+            help='Only read these columns of "--extra-var", all columns if not '
+            'specified.',
+        ),
+    ],
+
     'use_pc': [
         click.option(
             '--n-pcs', '-n',
@@ -181,6 +333,15 @@ COMMON_OPTIONS = {
         help='Seed for random number generator.',
     ),
 
+    'random_states': click.option(
+        '--random-state', '-S',
+        type=CommaSeparatedText(click.INT, simplify=True),
+        default=0,
+        show_default=True,
+        help='Seed(s) for random number generator. When multiple comma-separated '
+        'seeds are given, an embedding is computed for each of them.',
+    ),
+
     'use_raw': click.option(
         '--use-raw/--no-raw', 'use_raw',
         default=True,
@@ -219,7 +380,9 @@ COMMON_OPTIONS = {
         type=click.Path(dir_okay=False, writable=True),
         default=None,
         show_default=True,
-        help='Export embeddings in a tab-separated text table.',
+        help='Export embeddings in a table. Format is chosen by file '
+        'extension: ".npy", ".parquet", ".feather", ".tsv.gz" (gzip-compressed '
+        'tab-separated text), otherwise tab-separated text.',
     ),
 
     'export_cluster': click.option(
@@ -227,7 +390,9 @@ COMMON_OPTIONS = {
         type=click.Path(dir_okay=False, writable=True),
         default=None,
         show_default=True,
-        help='Export embeddings in a tab-separated text table.',
+        help='Export clusters in a table. Format is chosen by file extension: '
+        '".npy", ".parquet", ".feather", ".tsv.gz" (gzip-compressed '
+        'tab-separated text), otherwise tab-separated text.',
     ),
 
     'var_names': click.option(
@@ -464,16 +629,28 @@ CMD_OPTIONS = {
         click.option(
             '--input-10x-h5', '-i',
             type=click.Path(exists=True, dir_okay=False),
-            callback=mutually_exclusive_with('--input-10x-mtx'),
+            callback=mutually_exclusive_with('--input-10x-mtx', '--input-manifest'),
             help='Input 10x data in Cell-Ranger hdf5 format.',
         ),
         click.option(
             '--input-10x-mtx', '-x',
             type=click.Path(exists=True, file_okay=False),
-            callback=mutually_exclusive_with('--input-10x-h5'),
+            callback=mutually_exclusive_with('--input-10x-h5', '--input-manifest'),
             help='Path of input folder containing 10x data in mtx format.',
         ),
+        click.option(
+            '--input-manifest', '-M',
+            type=click.Path(exists=True, dir_okay=False),
+            callback=mutually_exclusive_with('--input-10x-h5', '--input-10x-mtx'),
+            help='Tab-separated table without header of multiple 10x inputs, one '
+            'sample per line in the form of "<sample> <path>", where <path> is a '
+            'Cell-Ranger hdf5 file or a folder of mtx files, relative to the '
+            'manifest if not absolute. Samples are read in parallel, labelled in '
+            'column "sample" of the cell table and have their barcodes suffixed '
+            'with "-<sample>".',
+        ),
         *COMMON_OPTIONS['output'],
+        COMMON_OPTIONS['n_jobs'],
         click.option(
             '--genome', '-g',
             callback=required_by('--input-10x-h5'),
@@ -492,21 +669,21 @@ CMD_OPTIONS = {
             'required by "--input-10x-mtx".',
         ),
         click.option(
-            '--extra-obs',
-            type=click.Path(exists=True, dir_okay=False),
-            default=None,
-            show_default=True,
-            help='Extra cell metadata table, must be tab-separated with a header '
-            'row and an index column, and with matched dimension.',
-        ),
-        click.option(
-            '--extra-var',
-            type=click.Path(exists=True, dir_okay=False),
+            '--mtx-cache-dir',
+            type=click.Path(file_okay=False),
             default=None,
             show_default=True,
-            help='Extra gene metadata table, must be tab-separated with a header '
-            'row and an index column, and with matched dimension.',
+            help='Cache mtx inputs converted to h5ad in this directory, keyed by a '
+            'hash of the input files, so that reading the same input again skips '
+            'parsing. No caching by default.',
         ),
+        *COMMON_OPTIONS['extra_metadata'],
+    ],
+
+    'annotate': [
+        *COMMON_OPTIONS['input'],
+        *COMMON_OPTIONS['output'],
+        *COMMON_OPTIONS['extra_metadata'],
     ],
 
     'filter': [
@@ -768,7 +945,7 @@ CMD_OPTIONS = {
         *COMMON_OPTIONS['input'],
         *COMMON_OPTIONS['output'],
         COMMON_OPTIONS['knn_graph'][0], # --use-graph
-        COMMON_OPTIONS['random_state'],
+        COMMON_OPTIONS['random_states'],
         COMMON_OPTIONS['key_added'],
         COMMON_OPTIONS['export_embedding'],
         click.option(
@@ -839,7 +1016,7 @@ CMD_OPTIONS = {
         *COMMON_OPTIONS['input'],
         *COMMON_OPTIONS['output'],
         *COMMON_OPTIONS['use_pc'],
-        COMMON_OPTIONS['random_state'],
+        COMMON_OPTIONS['random_states'],
         COMMON_OPTIONS['key_added'],
         COMMON_OPTIONS['n_jobs'],
         COMMON_OPTIONS['export_embedding'],
@@ -1020,6 +1197,26 @@ CMD_OPTIONS = {
             show_default=True,
             help='Method of performing differential expression analysis.',
         ),
+        click.option(
+            '--engine',
+            type=click.Choice(['scanpy', 'native']),
+            default='scanpy',
+            show_default=True,
+            help='Engine of the ranking. "native" computes group statistics in '
+            'one pass and Wilcoxon ranks by gene blocks in parallel, with the '
+            'same results as scanpy for "t-test", "t-test_overestim_var" and '
+            '"wilcoxon".',
+        ),
+        click.option(
+            '--all-pairs',
+            is_flag=True,
+            default=False,
+            show_default=True,
+            help='Compare every pair of groups from statistics computed once '
+            'per group, instead of each group with --reference. The results '
+            'are written to the table given by --save, and not stored in the '
+            'object. Not available with "logreg" or --filter-params.',
+        ),
         click.option(
             '--corr-method',
             type=click.Choice(['benjamini-hochberg', 'bonferroni']),
@@ -1059,10 +1256,13 @@ CMD_OPTIONS = {
         click.option(
             '--save',
             type=click.Path(dir_okay=False, writable=True),
+            callback=required_by('--all-pairs'),
             default=None,
             show_default=True,
-            help='Tab-separated table to store results of differential expression '
-            'analysis.',
+            help='Table to store results of differential expression analysis, '
+            'tab-separated, or parquet or feather by extension ".parquet" or '
+            '".feather". Gzip-compressed if ending with ".gz". Required by '
+            '--all-pairs.',
         ),
     ],
 
@@ -1134,6 +1334,47 @@ CMD_OPTIONS = {
         ),
     ],
 
+    'pipeline': [
+        *COMMON_OPTIONS['input'],
+        *COMMON_OPTIONS['output'],
+        click.option(
+            '--steps', '-s',
+            type=click.Path(exists=True, dir_okay=False),
+            required=True,
+            help='JSON file of the steps to run, as {"steps": [{"name": ..., '
+            '"command": ..., "args": ..., "after": [...]}, ...]}, where '
+            '"command" is a sub-command such as "cluster leiden", "args" its '
+            'options without the input and output objects, and "after" the '
+            'names of the steps it depends on.',
+        ),
+        click.option(
+            '--n-jobs', '-J',
+            type=click.IntRange(min=1),
+            default=None,
+            show_default=True,
+            help='Number of steps run at the same time, in processes sharing '
+            'the input object. By default as many as the thread budget '
+            'allows.',
+        ),
+        click.option(
+            '--checkpoint-dir',
+            type=click.Path(file_okay=False),
+            default=None,
+            show_default=True,
+            callback=required_by('--resume'),
+            help='Directory where the results of each step are appended as it '
+            'completes.',
+        ),
+        click.option(
+            '--resume',
+            is_flag=True,
+            default=False,
+            help='Reuse the results of steps found in --checkpoint-dir with the '
+            'same input object, options and dependencies instead of running '
+            'them again.',
+        ),
+    ],
+
     'embed': [
         *COMMON_OPTIONS['input'],
         *COMMON_OPTIONS['plot'],
@@ -1,17 +1,88 @@
 """
 Provide helper functions for constructing sub-commands
+
+Only click and the option definitions are imported at module load. scanpy,
+matplotlib, loompy and the `lib` wrappers are imported when a sub-command
+actually runs, so that building the command line interface and printing help
+stay fast.
 """
 
+import glob
+import importlib
 import click
-import pandas as pd
-import scanpy as sc
-from .exchangeable_loom import read_exchangeable_loom, write_exchangeable_loom
+from . import serve_utils
+from .cache_utils import ResultCache, cache_enabled, cache_key
+from .dtype_utils import enforce_dtype, get_dtype_policy
+from .memory_utils import plan_memory
+from .profile_utils import StepProfiler
+from .thread_utils import set_thread_budget
 from .cmd_options import CMD_OPTIONS
-from .lib._paga import plot_paga
 
-def make_subcmd(cmd_name, func, cmd_desc, arg_desc, opt_set = None):
+# Parameters naming files written by the command itself, which a cached
+# result would not reproduce
+_SIDE_OUTPUT_PARAMS = (
+    'export_embedding', 'export_cluster', 'save', 'checkpoint_dir')
+
+# Parameters handled by every sub-command rather than passed to its function
+_IO_PARAMS = (
+    'input_obj', 'output_obj', 'input_format', 'dry_run', 'batch', 'jobs',
+    'output_format',
+    'zarr_chunk_size', 'zarr_threads', 'zarr_compressor', 'export_mtx',
+    'show_obj', 'no_compact', 'keep_slots', 'drop_slots', 'export_lite',
+    'use_cache', 'no_cache', 'cache_dir', 'cache_size',
+)
+
+# Slots of the object whose keys pipeline steps may add or replace
+_PIPELINE_SLOTS = ('obs', 'obsm', 'uns')
+
+def lazy_function(module_name, func_name):
+    """Return a function that imports `module_name` on first call and calls
+    `func_name` from it, which may be a dotted path such as 'pp.scale'
+
+    `module_name` is relative to this package if it starts with '.'.
+    """
+    def func(*args, **kwargs):
+        obj = importlib.import_module(module_name, package=__package__)
+        for attr in func_name.split('.'):
+            obj = getattr(obj, attr)
+        return obj(*args, **kwargs)
+    func.__name__ = func_name.split('.')[-1]
+    return func
+
+
+def _apply_global_options(load_scanpy=True):
+    """Apply options of the top-level group that need scanpy, once a
+    sub-command runs, and return all of them
+
+    Without `load_scanpy`, scanpy settings are left for the processes that
+    run the command, so that estimating its cost does not import scanpy.
+    """
+    ctx = click.get_current_context(silent=True)
+    if ctx is None:
+        return {}
+    params = ctx.find_root().params
+    if load_scanpy and params.get('verbosity') is not None:
+        import scanpy as sc
+        sc.settings.verbosity = params['verbosity']
+    # limit thread pools loaded along with scanpy
+    set_thread_budget(params.get('threads'))
+    return params
+
+
+def make_subcmd(cmd_name, func, cmd_desc, arg_desc, opt_set = None,
+                lazy_x=False):
     """
     Factory function that returns a sub-command function
+
+    Set `lazy_x` if `func` can stream over a lazily loaded `.X`, in which case
+    zarr input is read without loading `.X` into memory.
+
+    With `--cache`, results of commands with both an input and an output
+    object are cached by the content of the input and the parameters.
+
+    With `--dry-run`, the cost of the command is estimated from the headers of
+    the input object and printed instead. With `--batch`, the command is run
+    on each input object of a glob pattern or manifest.
     """
     opt_set = opt_set if opt_set else cmd_name
     options = CMD_OPTIONS[opt_set]
@@ -31,30 +102,120 @@ def make_subcmd(cmd_name, func, cmd_desc, arg_desc, opt_set = None):
             input_obj=None,
             output_obj=None,
             input_format=None,
+            dry_run=False,
+            batch=False,
+            jobs=None,
             output_format=None,
             zarr_chunk_size=None,
+            zarr_threads=None,
+            zarr_compressor=None,
             export_mtx=None,
             show_obj=None,
+            no_compact=False,
+            keep_slots=None,
+            drop_slots=None,
+            export_lite=None,
+            use_cache=False,
+            no_cache=False,
+            cache_dir=None,
+            cache_size=None,
             **kwargs
     ):
         """{cmd_desc}\n\n\b\n{arg_desc}"""
-        if input_obj:
-            adata = _read_obj(input_obj, input_format=input_format)
-            func(adata, **kwargs)
+        global_params = _apply_global_options(
+            load_scanpy=not (batch or dry_run))
+        profile = global_params.get('profile')
+        if batch:
+            from .batch_utils import run_batch
+            return run_batch(
+                cmd.callback, click.get_current_context().params, opt_set,
+                kwargs, n_jobs=jobs, max_memory=global_params.get('max_memory'),
+                lazy=lazy_x and input_format == 'zarr')
+        if input_obj and glob.has_magic(input_obj):
+            raise click.BadParameter(
+                'glob patterns are only taken with --batch',
+                param_hint='<input_obj>')
+        if dry_run:
+            from .estimate_utils import print_estimate
+            print_estimate(
+                opt_set, input_obj, input_format=input_format, kwargs=kwargs,
+                lazy=lazy_x and input_format == 'zarr',
+                max_memory=global_params.get('max_memory'))
+            return 0
+        profiler = StepProfiler(cmd_name, enabled=bool(profile))
+
+        adata, cache, key = None, None, None
+        if (input_obj and output_obj and
+                cache_enabled(use_cache, cache_dir, no_cache) and not any(
+                    kwargs.get(param) for param in _SIDE_OUTPUT_PARAMS)):
+            cache = ResultCache(cache_dir, cache_size)
+            with profiler.step('cache'):
+                key = cache_key(
+                    input_obj, cmd_name, dict(
+                        kwargs, input_format=input_format,
+                        dtype=get_dtype_policy(), compact=not no_compact,
+                        keep_slots=keep_slots, drop_slots=drop_slots))
+                adata = cache.load(key)
+
+        if adata is not None:
+            # cache hit, nothing more to store
+            cache = None
+        elif input_obj:
+            read_kwargs = {}
+            if lazy_x and input_format == 'zarr':
+                read_kwargs['lazy'] = True
+            with profiler.step('read'):
+                adata = _read_obj_served(
+                    input_obj, input_format=input_format, **read_kwargs)
+            max_memory = global_params.get('max_memory')
+            if max_memory:
+                planned = plan_memory(opt_set, adata, kwargs, max_memory)
+                if planned != kwargs:
+                    # results of the switched code path are not those cached
+                    # for the options given
+                    kwargs, cache = planned, None
+            with profiler.step('func'):
+                func(adata, **kwargs)
         else:
-            adata = func(**kwargs)
+            with profiler.step('func'):
+                adata = func(**kwargs)
 
         if output_obj:
-            _write_obj(
-                adata,
-                output_obj,
-                output_format=output_format,
-                chunk_size=zarr_chunk_size,
-                export_mtx=export_mtx,
-                show_obj=show_obj,
-            )
+            # other writers may alter the object, and the records of this run
+            # must not come back with a later cache hit, so cache the object
+            # beforehand unless the written h5ad file can be copied as is
+            if cache is not None and (profile or output_format != 'anndata'):
+                from .zarr_utils import load_lazy_matrix
+                load_lazy_matrix(adata, n_threads=zarr_threads)
+                cache.store(key, adata=adata)
+                cache = None
+            # the write step can only be reported in the profile output
+            profiler.store(adata)
+            with profiler.step('write'):
+                _write_obj(
+                    adata,
+                    output_obj,
+                    output_format=output_format,
+                    chunk_size=zarr_chunk_size,
+                    n_threads=zarr_threads,
+                    compressor=zarr_compressor,
+                    export_mtx=export_mtx,
+                    show_obj=show_obj,
+                    compact=not no_compact,
+                    keep_slots=keep_slots,
+                    drop_slots=drop_slots,
+                    export_lite=export_lite,
+                )
+            if cache is not None:
+                cache.store(key, h5ad_file=output_obj)
+            if (serve_utils.object_cache is not None
+                    and output_format == 'anndata'):
+                serve_utils.object_cache.put(output_obj, 'anndata', adata)
+        profiler.emit(profile)
         return 0
 
+    # the function is also run directly on a shared object by run_pipeline
+    cmd.func = func
     return cmd
 
 
@@ -69,37 +230,495 @@ def add_options(options):
     return _add_options
 
 
+def run_pipeline(adata, steps, n_jobs=None, checkpoint_dir=None,
+                 resume=False):
+    """Run a graph of sub-commands on `adata` and merge the keys they add to
+    `.obs`, `.obsm` and `.uns`
+
+    Steps whose dependencies are done run in parallel, up to `n_jobs` at a
+    time within the thread budget, each in a forked process that shares the
+    object copy-on-write and sends back only the keys it changed. Without fork,
+    or with one job, steps run one after another in this process.
+
+    * Parameters
+        + adata : AnnData
+        The object, typically after `neighbor`, updated in place
+        + steps : str
+        JSON file of the steps, as {"steps": [{"name": ..., "command": ...,
+        "args": ..., "after": [...]}, ...]}. `command` is the sub-command path,
+        e.g. "cluster leiden", `args` its options as a string or a list,
+        without the input and output objects, and `after` the names of the
+        steps it depends on
+        + n_jobs : int
+        Number of steps run at the same time
+        + checkpoint_dir : str
+        Directory where the keys changed by each step are appended as the
+        step completes
+        + resume : bool
+        Take the keys of steps checkpointed in `checkpoint_dir` with the same
+        input object, parameters and dependencies instead of running them
+    """
+    import multiprocessing
+    from multiprocessing.connection import wait
+    from .cli import cli
+    from .thread_utils import default_n_threads, worker_thread_budget
+
+    plan = _read_pipeline(cli, steps)
+    ancestors = _pipeline_ancestors(plan)
+    n_jobs = min(default_n_threads(n_jobs), len(plan))
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        n_jobs = 1
+
+    checkpoints = None
+    if checkpoint_dir:
+        checkpoints = _PipelineCheckpoints(checkpoint_dir)
+        step_keys = checkpoints.step_keys(adata, plan)
+    elif resume:
+        raise click.ClickException('Resuming needs a checkpoint directory')
+
+    owners = {}
+    done = set()
+
+    def finish(name, changes, merge=True):
+        _check_pipeline_keys(changes, name, owners, ancestors)
+        if merge:
+            _merge_slot_changes(adata, changes)
+        if checkpoints is not None:
+            checkpoints.append(name, step_keys[name], changes)
+        done.add(name)
+
+    def try_resume(name):
+        if not resume:
+            return False
+        changes = checkpoints.load(step_keys[name])
+        if changes is None:
+            return False
+        click.echo(f'Pipeline step "{name}" resumed from checkpoint', err=True)
+        _check_pipeline_keys(changes, name, owners, ancestors)
+        _merge_slot_changes(adata, changes)
+        done.add(name)
+        return True
+
+    if n_jobs == 1:
+        for name, step in plan.items():
+            if try_resume(name):
+                continue
+            before = _slot_fingerprints(adata)
+            fixed = _fixed_fingerprint(adata)
+            step['func'](adata, **step['kwargs'])
+            if _fixed_fingerprint(adata) != fixed:
+                raise click.ClickException(_fixed_changed_message(name))
+            finish(name, _slot_changes(adata, before), merge=False)
+        return adata
+
+    mp_context = multiprocessing.get_context('fork')
+    n_threads = worker_thread_budget(n_jobs)
+    running = {}
+    try:
+        while len(done) < len(plan):
+            for name, step in plan.items():
+                if len(running) >= n_jobs:
+                    break
+                if (name in done or name in running.values() or
+                        not set(step['after']) <= done or try_resume(name)):
+                    continue
+                conn, child_conn = mp_context.Pipe(duplex=False)
+                proc = mp_context.Process(
+                    target=_run_pipeline_step,
+                    args=(child_conn, adata, step, n_threads),
+                    name=f'scanpy-pipeline-{name}',
+                )
+                proc.start()
+                child_conn.close()
+                running[conn] = name
+                step['process'] = proc
+            if not running:
+                # steps resumed, schedule the ones they unblocked
+                continue
+            for conn in wait(list(running)):
+                name = running.pop(conn)
+                proc = plan[name]['process']
+                try:
+                    status, payload = conn.recv()
+                except EOFError:
+                    status, payload = 'error', 'exited unexpectedly'
+                conn.close()
+                proc.join()
+                if status != 'ok':
+                    raise click.ClickException(
+                        f'Pipeline step "{name}" failed: {payload}')
+                finish(name, payload)
+    finally:
+        for name in running.values():
+            plan[name]['process'].terminate()
+    return adata
+
+
+class _PipelineCheckpoints:
+    """Append-only store of the keys changed by pipeline steps
+
+    Each completed step appends a pickle of its changes and then a line to
+    `log.jsonl`, keyed by a hash of the input object, the step's command and
+    parameters, and the keys of the steps it depends on. A step is only
+    found again if all of them are unchanged, and a step interrupted before
+    its log line is written is not found at all.
+    """
+
+    def __init__(self, checkpoint_dir):
+        import os
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.checkpoint_dir = checkpoint_dir
+        self.log_file = os.path.join(checkpoint_dir, 'log.jsonl')
+
+    def step_keys(self, adata, plan):
+        import hashlib
+        import json
+        from . import __version__
+
+        object_key = _object_fingerprint(adata).hex()
+        keys = {}
+        for name, step in plan.items():
+            keys[name] = hashlib.blake2b(json.dumps(
+                [object_key, __version__, get_dtype_policy(), step['command'],
+                 step['kwargs'], [keys[dep] for dep in step['after']]],
+                sort_keys=True, default=repr).encode(),
+                digest_size=20).hexdigest()
+        return keys
+
+    def _records(self):
+        import json
+        import os
+        if not os.path.exists(self.log_file):
+            return {}
+        records = {}
+        with open(self.log_file) as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+                records[record['key']] = record
+        return records
+
+    def load(self, key):
+        import os
+        import pickle
+        record = self._records().get(key)
+        if record is None:
+            return None
+        with open(os.path.join(self.checkpoint_dir, record['file']), 'rb') as fh:
+            return pickle.load(fh)
+
+    def append(self, name, key, changes):
+        import json
+        import os
+        import pickle
+        fname = f'{key}.pkl'
+        path = os.path.join(self.checkpoint_dir, fname)
+        with open(path + '.tmp', 'wb') as fh:
+            pickle.dump(changes, fh, protocol=4)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(path + '.tmp', path)
+        with open(self.log_file, 'a') as fh:
+            fh.write(json.dumps({'step': name, 'key': key, 'file': fname}) + '\n')
+            fh.flush()
+            os.fsync(fh.fileno())
+
+
+def _object_fingerprint(adata):
+    """Hash of the matrices, names and annotation slots of an object
+    """
+    import hashlib
+
+    digest = hashlib.blake2b(digest_size=20)
+    matrices = [adata.X]
+    if adata.raw is not None:
+        matrices.append(adata.raw.X)
+    for X in matrices:
+        _update_matrix_digest(digest, X)
+    digest.update(_fingerprint(list(adata.obs_names)))
+    digest.update(_fingerprint(list(adata.var_names)))
+    for slot, fingerprints in _slot_fingerprints(adata).items():
+        for key in sorted(fingerprints):
+            digest.update(f'{slot}:{key}'.encode())
+            digest.update(fingerprints[key])
+    return digest.digest()
+
+
+def _fixed_fingerprint(adata):
+    """Hash of the parts of an object pipeline steps must leave unchanged:
+    its shape, matrices, `.var` and `.varm`
+    """
+    import hashlib
+
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(str(adata.shape).encode())
+    _update_matrix_digest(digest, adata.X)
+    for key in sorted(adata.layers.keys()):
+        digest.update(f'layers:{key}'.encode())
+        _update_matrix_digest(digest, adata.layers[key])
+    digest.update(_fingerprint(list(adata.var_names)))
+    for key in adata.var:
+        digest.update(f'var:{key}'.encode())
+        digest.update(_fingerprint(adata.var[key].values))
+    for key in sorted(adata.varm.keys()):
+        digest.update(f'varm:{key}'.encode())
+        digest.update(_fingerprint(adata.varm[key]))
+    return digest.digest()
+
+
+def _fixed_changed_message(name):
+    return (f'Pipeline step "{name}" changed the matrices, variables or shape '
+            'of the object, only commands adding keys to .obs, .obsm and '
+            '.uns can be pipeline steps')
+
+
+def _update_matrix_digest(digest, X):
+    import scipy.sparse as sp
+    if sp.issparse(X):
+        for arr in (X.data, X.indices, X.indptr):
+            digest.update(_fingerprint(arr))
+    else:
+        digest.update(_fingerprint(X))
+
+
+def _read_pipeline(cli, steps_file):
+    """Read the steps of a pipeline in dependency order, with the function
+    and parsed keyword arguments of each
+    """
+    import json
+    import os
+    import shlex
+
+    with open(steps_file) as fh:
+        spec = json.load(fh)
+    plan = {}
+    for step in spec['steps']:
+        name = step['name']
+        if name in plan:
+            raise click.ClickException(f'Duplicated pipeline step: {name}')
+        ctx = click.Context(cli)
+        command = cli
+        for word in step['command'].split():
+            command = (command.get_command(ctx, word)
+                       if isinstance(command, click.MultiCommand) else None)
+            if command is None:
+                raise click.ClickException(
+                    f'Unknown command for pipeline step "{name}": '
+                    f'{step["command"]}')
+        param_names = [param.name for param in command.params]
+        if 'input_obj' not in param_names or not hasattr(command, 'func'):
+            raise click.ClickException(
+                f'Pipeline step "{name}" does not take an input object')
+        args = step.get('args', [])
+        if isinstance(args, str):
+            args = shlex.split(args)
+        # placeholders for the input and output objects, never opened
+        placeholders = [os.curdir]
+        if 'output_obj' in param_names:
+            placeholders.append(os.devnull)
+        with command.make_context(
+                name, placeholders + list(args), parent=ctx) as step_ctx:
+            kwargs = {key: val for key, val in step_ctx.params.items()
+                      if key not in _IO_PARAMS}
+        plan[name] = {
+            'name': name,
+            'command': step['command'],
+            'func': command.func,
+            'kwargs': kwargs,
+            'after': list(step.get('after', [])),
+        }
+
+    ordered = {}
+    while len(ordered) < len(plan):
+        ready = [name for name, step in plan.items() if name not in ordered
+                 and set(step['after']) <= set(ordered)]
+        if not ready:
+            unknown = {dep for step in plan.values() for dep in step['after']
+                       if dep not in plan}
+            raise click.ClickException(
+                f'Unknown pipeline steps: {sorted(unknown)}' if unknown else
+                'Pipeline steps depend on each other in a cycle')
+        for name in ready:
+            ordered[name] = plan[name]
+    return ordered
+
+
+def _pipeline_ancestors(plan):
+    ancestors = {}
+    for name, step in plan.items():
+        ancestors[name] = set(step['after']).union(
+            *(ancestors[dep] for dep in step['after']))
+    return ancestors
+
+
+def _run_pipeline_step(conn, adata, step, n_threads):
+    """Run one step in a forked process and send back the keys it changed
+    """
+    import traceback
+    try:
+        set_thread_budget(n_threads)
+        before = _slot_fingerprints(adata)
+        fixed = _fixed_fingerprint(adata)
+        step['func'](adata, **step['kwargs'])
+        if _fixed_fingerprint(adata) != fixed:
+            conn.send(('error', _fixed_changed_message(step['name'])))
+        else:
+            conn.send(('ok', _slot_changes(adata, before)))
+    except BaseException:
+        conn.send(('error', traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def _fingerprint(value):
+    import hashlib
+    import pickle
+    import numpy as np
+
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(value, np.ndarray) and value.dtype.kind in 'biufc':
+        digest.update(str((value.dtype, value.shape)).encode())
+        digest.update(np.ascontiguousarray(value).view(np.uint8).ravel())
+    else:
+        digest.update(pickle.dumps(value, protocol=4))
+    return digest.digest()
+
+
+def _slot_fingerprints(adata):
+    return {
+        'obs': {key: _fingerprint(adata.obs[key].values) for key in adata.obs},
+        'obsm': {key: _fingerprint(adata.obsm[key])
+                 for key in adata.obsm.keys()},
+        'uns': {key: _fingerprint(val) for key, val in adata.uns.items()},
+    }
+
+
+def _slot_changes(adata, before):
+    """Keys of `.obs`, `.obsm` and `.uns` added or changed since `before`
+    """
+    after = _slot_fingerprints(adata)
+    changes = {}
+    for slot in _PIPELINE_SLOTS:
+        keys = [key for key, fp in after[slot].items()
+                if before[slot].get(key) != fp]
+        if slot == 'obs':
+            changes[slot] = adata.obs[keys].copy()
+        elif slot == 'obsm':
+            changes[slot] = {key: adata.obsm[key] for key in keys}
+        else:
+            changes[slot] = {key: adata.uns[key] for key in keys}
+    return changes
+
+
+def _check_pipeline_keys(changes, name, owners, ancestors):
+    """Fail if a step changes a key set by another step it does not depend on
+    """
+    for slot in _PIPELINE_SLOTS:
+        for key in changes[slot]:
+            owner = owners.get((slot, key))
+            if owner is not None and owner not in ancestors[name]:
+                raise click.ClickException(
+                    f'Pipeline steps "{owner}" and "{name}" both write '
+                    f'{slot}["{key}"], make one depend on the other')
+            owners[(slot, key)] = name
+
+
+def _merge_slot_changes(adata, changes):
+    for key in changes['obs']:
+        adata.obs[key] = changes['obs'][key]
+    for key, val in changes['obsm'].items():
+        adata.obsm[key] = val
+    for key, val in changes['uns'].items():
+        adata.uns[key] = val
+
+
 def _read_obj(input_obj, input_format='anndata', **kwargs):
+    return enforce_dtype(_read_file(input_obj, input_format, **kwargs))
+
+
+def _read_file(input_obj, input_format='anndata', **kwargs):
     if input_format == 'anndata':
+        import scanpy as sc
         adata = sc.read(input_obj, **kwargs)
     elif input_format == 'loom':
+        from .exchangeable_loom import read_exchangeable_loom
         adata = read_exchangeable_loom(input_obj, **kwargs)
+    elif input_format == 'zarr':
+        from .zarr_utils import read_zarr
+        adata = read_zarr(input_obj, **kwargs)
     else:
         raise NotImplementedError(
             'Unsupported input format: {}'.format(input_format))
     return adata
 
 
+def _read_obj_served(input_obj, input_format='anndata', **kwargs):
+    """Read an object through the memory cache of the server when running in
+    one, unless read lazily
+
+    The cache keeps objects as in their files, cast to the dtype policy of
+    each command once taken out.
+    """
+    object_cache = serve_utils.object_cache
+    if object_cache is None or kwargs:
+        return _read_obj(input_obj, input_format=input_format, **kwargs)
+    adata = object_cache.get(input_obj, input_format)
+    if adata is None:
+        adata = _read_file(input_obj, input_format=input_format)
+        object_cache.put(input_obj, input_format, adata.copy())
+    return enforce_dtype(adata)
+
+
 def _write_obj(
         adata,
         output_obj,
         output_format='anndata',
         chunk_size=None,
+        n_threads=None,
+        compressor='blosc-lz4',
         export_mtx=None,
         show_obj=None,
+        compact=True,
+        keep_slots=None,
+        drop_slots=None,
+        export_lite=None,
         **kwargs
 ):
+    from .zarr_utils import write_zarr, load_lazy_matrix
+    if keep_slots is not None or drop_slots is not None:
+        from .slot_utils import prune_slots
+        prune_slots(adata, keep=keep_slots, drop=drop_slots)
+    if output_format != 'zarr':
+        load_lazy_matrix(adata, n_threads=n_threads)
+    enforce_dtype(adata)
+    if compact:
+        from .compact_utils import compact_obj
+        compact_obj(adata)
     if output_format == 'anndata':
-        adata.write(output_obj, compression='gzip')
+        from .link_utils import write_h5ad
+        write_h5ad(adata, output_obj, compression='gzip')
     elif output_format == 'loom':
+        from .exchangeable_loom import write_exchangeable_loom
         write_exchangeable_loom(adata, output_obj, **kwargs)
     elif output_format == 'zarr':
-        adata.write_zarr(output_obj, chunk_size=chunk_size, **kwargs)
+        write_zarr(
+            adata,
+            output_obj,
+            chunks=chunk_size,
+            n_threads=n_threads,
+            compressor=compressor,
+        )
     else:
         raise NotImplementedError(
             'Unsupported output format: {}'.format(output_format))
     if export_mtx:
         write_mtx(adata, fname_prefix=export_mtx, **kwargs)
+    if export_lite:
+        from .obj_utils import write_lite
+        write_lite(adata, export_lite)
     if show_obj:
         click.echo(adata, err=show_obj == 'stderr')
     return 0
@@ -130,6 +749,7 @@ def write_mtx(adata, fname_prefix='', var=None, obs=None, use_raw=False):
     obs = list(set(obs) & set(adata.obs.columns))
     var = list(set(var) & set(adata.var.columns))
 
+    import pandas as pd
     import scipy.sparse as sp
     mat = sp.coo_matrix(adata.X)
     n_obs, n_var = mat.shape
@@ -156,20 +776,6 @@ def make_plot_function(func_name, kind=None):
     """Make plot function that handles common plotting parameters
     """
 
-    # Provide a function translation
-
-    plot_funcs = {
-        'scatter': sc.plotting._tools.scatterplots.plot_scatter,
-        'sviol': sc.pl.stacked_violin,
-        'rgg_sviol': sc.pl.rank_genes_groups_stacked_violin,
-        'dot': sc.pl.dotplot,
-        'rgg_dot': sc.pl.rank_genes_groups_dotplot,
-        'matrix': sc.pl.matrixplot,
-        'rgg_matrix': sc.pl.rank_genes_groups_matrixplot,
-        'heat': sc.pl.heatmap,
-        'rgg_heat': sc.pl.rank_genes_groups_heatmap,
-    }
-
     def plot_function(
             adata,
             output_fig=None,
@@ -178,6 +784,22 @@ def make_plot_function(func_name, kind=None):
             fig_fontsize=15,
             **kwargs,
     ):
+        import scanpy as sc
+
+        # Provide a function translation
+
+        plot_funcs = {
+            'scatter': sc.plotting._tools.scatterplots.plot_scatter,
+            'sviol': sc.pl.stacked_violin,
+            'rgg_sviol': sc.pl.rank_genes_groups_stacked_violin,
+            'dot': sc.pl.dotplot,
+            'rgg_dot': sc.pl.rank_genes_groups_dotplot,
+            'matrix': sc.pl.matrixplot,
+            'rgg_matrix': sc.pl.rank_genes_groups_matrixplot,
+            'heat': sc.pl.heatmap,
+            'rgg_heat': sc.pl.rank_genes_groups_heatmap,
+        }
+
         sc.settings.set_figure_params(dpi=fig_dpi, fontsize=fig_fontsize)
         if fig_size:
             from matplotlib import rcParams
@@ -202,7 +824,8 @@ def make_plot_function(func_name, kind=None):
             else:
                 func = plot_funcs[ func_name ]
         else:
-            func = globals()[func_name]
+            from .lib import _paga
+            func = getattr(_paga, func_name)
 
         # Generate the output file name
 
@@ -4,27 +4,33 @@ Provides sub-commands
 
 import os
 import sys
-import scanpy as sc
 
 from .cmd_utils import (
     make_subcmd,
     make_plot_function,
-)
-from .lib._read import read_10x
-from .lib._filter import filter_anndata
-from .lib._norm import normalize
-from .lib._hvg import hvg
-from .lib._pca import pca
-from .lib._neighbors import neighbors
-from .lib._umap import umap
-from .lib._tsne import tsne
-from .lib._fdg import fdg
-from .lib._louvain import louvain
-from .lib._leiden import leiden
-from .lib._diffexp import diffexp
-from .lib._paga import paga
-from .lib._diffmap import diffmap
-from .lib._dpt import dpt
+    lazy_function,
+    run_pipeline,
+)
+
+# Wrappers are imported only when their sub-command runs
+read_10x = lazy_function('.lib._read', 'read_10x')
+annotate = lazy_function('.lib._annotate', 'annotate')
+filter_anndata = lazy_function('.lib._filter', 'filter_anndata')
+normalize = lazy_function('.lib._norm', 'normalize')
+hvg = lazy_function('.lib._hvg', 'hvg')
+scale = lazy_function('scanpy', 'pp.scale')
+regress_out = lazy_function('scanpy', 'pp.regress_out')
+pca = lazy_function('.lib._pca', 'pca')
+neighbors = lazy_function('.lib._neighbors', 'neighbors')
+umap = lazy_function('.lib._umap', 'umap')
+tsne = lazy_function('.lib._tsne', 'tsne')
+fdg = lazy_function('.lib._fdg', 'fdg')
+louvain = lazy_function('.lib._louvain', 'louvain')
+leiden = lazy_function('.lib._leiden', 'leiden')
+diffexp = lazy_function('.lib._diffexp', 'diffexp')
+paga = lazy_function('.lib._paga', 'paga')
+diffmap = lazy_function('.lib._diffmap', 'diffmap')
+dpt = lazy_function('.lib._dpt', 'dpt')
 
 LANG = os.environ.get('LANG', None)
 
@@ -51,11 +57,20 @@ READ_CMD = make_subcmd(
 )
 
 
+ANNOTATE_CMD = make_subcmd(
+    'annotate',
+    annotate,
+    cmd_desc='Attach extra cell and gene metadata to an existing object.',
+    arg_desc=_IO_DESC,
+)
+
+
 FILTER_CMD = make_subcmd(
     'filter',
     filter_anndata,
     cmd_desc='Filter data based on specified conditions.',
     arg_desc=_IO_DESC,
+    lazy_x=True,
 )
 
 
@@ -77,7 +92,7 @@ HVG_CMD = make_subcmd(
 
 SCALE_CMD = make_subcmd(
     'scale',
-    sc.pp.scale,
+    scale,
     cmd_desc='Scale data per gene.',
     arg_desc=_IO_DESC,
 )
@@ -85,7 +100,7 @@ SCALE_CMD = make_subcmd(
 
 REGRESS_CMD = make_subcmd(
     'regress',
-    sc.pp.regress_out,
+    regress_out,
     cmd_desc='Regress-out observation variables.',
     arg_desc=_IO_DESC,
 )
@@ -96,6 +111,7 @@ PCA_CMD = make_subcmd(
     pca,
     cmd_desc='Dimensionality reduction by PCA.',
     arg_desc=_IO_DESC,
+    lazy_x=True,
 )
 
 NEIGHBOR_CMD = make_subcmd(
@@ -168,6 +184,13 @@ DPT_CMD = make_subcmd(
     arg_desc=_IO_DESC,
 )
 
+PIPELINE_CMD = make_subcmd(
+    'pipeline',
+    run_pipeline,
+    cmd_desc='Run independent commands in parallel and merge their results.',
+    arg_desc=_IO_DESC,
+)
+
 PLOT_EMBED_CMD = make_subcmd(
     'embed',
     make_plot_function('scatter'),
@@ -0,0 +1,105 @@
+"""compact_utils
+
+Shrink objects before they are written.
+
+Sparse matrices get int32 `indices` and `indptr` when their shape and number
+of stored values allow it, string columns of `.obs` and `.var` with few
+distinct values become categoricals, and quality metrics that
+`filter_anndata` stores under both its own names and those of
+`sc.pp.calculate_qc_metrics` are kept once, under its own names.
+"""
+
+import logging
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+# Pairs of columns of the same values, of which the second is dropped
+DUPLICATED_COLUMNS = {
+    'obs': (('n_counts', 'total_counts'), ('n_genes', 'n_genes_by_counts')),
+    'var': (('n_counts', 'total_counts'), ('n_cells', 'n_cells_by_counts')),
+}
+
+# String columns with at most this fraction of distinct values are made
+# categorical
+MAX_CATEGORY_FRACTION = 0.5
+
+_INT32_MAX = np.iinfo(np.int32).max
+
+
+def compact_obj(adata):
+    """Compact `adata` in place and return the number of bytes saved in
+    memory, roughly those saved in the written file
+    """
+    saved = 0
+    matrices = [adata.X]
+    if adata.raw is not None:
+        matrices.append(adata.raw.X)
+    matrices.extend(adata.layers[key] for key in adata.layers.keys())
+    matrices.extend(_nested_values(adata.uns))
+    seen = set()
+    for mat in matrices:
+        if id(mat) not in seen:
+            seen.add(id(mat))
+            saved += _downcast_sparse_index(mat)
+
+    frames = [('obs', adata.obs), ('var', adata.var)]
+    if adata.raw is not None:
+        frames.append(('var', adata.raw.var))
+    for slot, df in frames:
+        saved += _drop_duplicated_columns(df, DUPLICATED_COLUMNS[slot])
+        saved += _strings_to_categoricals(df)
+
+    logging.info('Compacted object before writing, %d bytes saved', saved)
+    return saved
+
+
+def _nested_values(mapping):
+    for value in mapping.values():
+        if isinstance(value, dict):
+            yield from _nested_values(value)
+        else:
+            yield value
+
+
+def _downcast_sparse_index(mat):
+    """Make the index arrays of a CSR or CSC matrix int32 in place if they
+    fit, and return the bytes saved
+    """
+    if not (sp.isspmatrix_csr(mat) or sp.isspmatrix_csc(mat)):
+        return 0
+    if mat.indices.dtype == np.int32 and mat.indptr.dtype == np.int32:
+        return 0
+    if max(mat.nnz, *mat.shape) > _INT32_MAX:
+        return 0
+    before = mat.indices.nbytes + mat.indptr.nbytes
+    mat.indices = mat.indices.astype(np.int32)
+    mat.indptr = mat.indptr.astype(np.int32)
+    return before - mat.indices.nbytes - mat.indptr.nbytes
+
+
+def _drop_duplicated_columns(df, pairs):
+    saved = 0
+    for keep, drop in pairs:
+        if keep in df.columns and drop in df.columns and np.array_equal(
+                df[keep].values, df[drop].values):
+            saved += int(df[drop].memory_usage(index=False, deep=True))
+            del df[drop]
+    return saved
+
+
+def _strings_to_categoricals(df):
+    saved = 0
+    for key in df.columns:
+        col = df[key]
+        if (isinstance(col.dtype, pd.api.types.CategoricalDtype) or
+                not pd.api.types.is_string_dtype(col.dtype) or len(col) == 0):
+            continue
+        if pd.api.types.infer_dtype(col.values, skipna=True) != 'string':
+            continue
+        if col.nunique() > MAX_CATEGORY_FRACTION * len(col):
+            continue
+        before = int(col.memory_usage(index=False, deep=True))
+        df[key] = col.astype('category')
+        saved += before - int(df[key].memory_usage(index=False, deep=True))
+    return saved
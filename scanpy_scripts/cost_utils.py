@@ -0,0 +1,442 @@
+"""cost_utils
+
+Cost models of the sub-commands, for `--max-memory`, `--dry-run` and
+`--batch`.
+
+Each model takes the `ObjectStats` of the input object and the keyword
+arguments of its command, and returns the estimated peak memory in bytes on
+top of the input object along with the keyword arguments to change. Given a
+`budget` of bytes, models of commands with a chunked or streaming code path
+switch to it when the default path would not fit.
+
+Estimates count the copies and temporary arrays the scanpy functions make on
+matrices of the given shape, density and dtype, and are meant to be on the
+safe side rather than exact.
+
+Runtime models return units of work of a command, e.g. stored values visited
+or graph edges times optimisation epochs, which `SECONDS_PER_UNIT` turns into
+seconds. Output models return the bytes a command adds to the object.
+
+This module imports neither scanpy nor the `lib` wrappers, so that estimates
+are cheap to get before deciding to run anything.
+"""
+
+import math
+
+# Methods of diffexp implemented by its native engine
+NATIVE_METHODS = ('t-test', 't-test_overestim_var', 'wilcoxon')
+
+# Upper bound of the number of genes ranked together by one diffexp task
+_GENE_BLOCK_SIZE = 1000
+
+# Assumed when the neighbour graph is not known yet
+DEFAULT_N_NEIGHBORS = 15
+
+# Assumed number of groups compared by diffexp
+DEFAULT_N_GROUPS = 32
+
+# Smallest chunk worth switching pca to
+MIN_CHUNK_SIZE = 500
+
+# Bytes per stored value of a CSR matrix, float64 data and int32 index
+_SPARSE_VALUE_BYTES = 12
+
+
+def _matrix_bytes(stats):
+    if stats.nnz < stats.n_obs * stats.n_vars:
+        return stats.nnz * (stats.itemsize + 4) + (stats.n_obs + 1) * 8
+    return stats.n_obs * stats.n_vars * stats.itemsize
+
+
+def _dense_bytes(stats, itemsize=None):
+    return stats.n_obs * stats.n_vars * (itemsize or stats.itemsize)
+
+
+def _is_sparse(stats):
+    return stats.nnz < stats.n_obs * stats.n_vars
+
+
+def _n_edges(stats):
+    if stats.n_edges is not None:
+        return stats.n_edges
+    return stats.n_obs * DEFAULT_N_NEIGHBORS
+
+
+def _as_list(value):
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def filter_memory(stats, budget=None, **kwargs):
+    # quality metrics and the subset copy of the kept cells and genes, after
+    # loading a lazy matrix to subset it
+    load = _matrix_bytes(stats) if stats.lazy else 0
+    return load + 2 * _matrix_bytes(stats), {}
+
+
+def norm_memory(stats, budget=None, save_raw='yes', **kwargs):
+    n_copies = 2 if save_raw in ('yes', 'counts') else 1
+    return n_copies * _matrix_bytes(stats), {}
+
+
+def hvg_memory(stats, budget=None, **kwargs):
+    # exponentiated copy and squared values for the dispersions
+    return 2 * _matrix_bytes(stats) + stats.n_vars * 8 * 10, {}
+
+
+def scale_memory(stats, budget=None, zero_center=True, **kwargs):
+    if zero_center and _is_sparse(stats):
+        # densified, then squared for the variances
+        needed = 2 * _dense_bytes(stats)
+    else:
+        needed = 2 * _matrix_bytes(stats)
+    return needed, {}
+
+
+def regress_memory(stats, budget=None, **kwargs):
+    # dense float64 matrix and residuals
+    return 2 * _dense_bytes(stats, itemsize=8), {}
+
+
+def pca_memory(
+        stats,
+        budget=None,
+        n_comps=50,
+        zero_center=True,
+        svd_solver='auto',
+        chunked=False,
+        chunk_size=None,
+        **kwargs,
+):
+    n_comps = n_comps or 50
+    result = stats.n_obs * n_comps * 4 + stats.n_vars * n_comps * 8
+    load = _matrix_bytes(stats) if stats.lazy else 0
+
+    def chunked_bytes(size):
+        # dense chunk, its centred copy and the stacked fit of IncrementalPCA
+        return 3 * size * stats.n_vars * 8 + result
+
+    if chunked:
+        needed = chunked_bytes(chunk_size or MIN_CHUNK_SIZE)
+    elif zero_center and _is_sparse(stats):
+        # densified, then copied by sklearn for centring
+        needed = load + 2 * _dense_bytes(stats) + result
+    elif zero_center:
+        needed = load + _dense_bytes(stats) + result
+    else:
+        needed = load + 2 * _matrix_bytes(stats) + result
+    changes = {}
+
+    # the chunked path always centres and has no solver to choose, so it only
+    # replaces centred runs leaving the solver to scanpy
+    if (budget is not None and needed > budget and not chunked and
+            zero_center and svd_solver in (None, 'auto')):
+        size = min(stats.n_obs, int((budget - result) // (3 * stats.n_vars * 8)))
+        if size >= min(MIN_CHUNK_SIZE, stats.n_obs):
+            needed = chunked_bytes(size)
+            changes = {'chunked': True, 'chunk_size': size}
+    return needed, changes
+
+
+def neighbor_memory(stats, budget=None, n_neighbors=15, **kwargs):
+    ks = _as_list(n_neighbors)
+    # distances and connectivities kept for every k, plus the search
+    kept = sum(stats.n_obs * k * _SPARSE_VALUE_BYTES * 2 for k in ks)
+    search = max(stats.n_obs * k * _SPARSE_VALUE_BYTES * 4 for k in ks)
+    if stats.n_obs < 4096:
+        # all pairwise distances are computed for small data
+        search += stats.n_obs * stats.n_obs * 8
+    return kept + search, {}
+
+
+def umap_memory(stats, budget=None, random_state=0, n_components=2, **kwargs):
+    n_seeds = len(_as_list(random_state))
+    needed = (_n_edges(stats) * _SPARSE_VALUE_BYTES * 4 +
+              stats.n_obs * n_components * 8 * n_seeds)
+    return needed, {}
+
+
+def tsne_memory(stats, budget=None, random_state=0, perplexity=30, **kwargs):
+    n_seeds = len(_as_list(random_state))
+    # affinities to three times perplexity neighbours, in a few copies
+    needed = (stats.n_obs * 3 * perplexity * _SPARSE_VALUE_BYTES * 3 +
+              stats.n_obs * 2 * 8 * n_seeds)
+    return needed, {}
+
+
+def fdg_memory(stats, budget=None, **kwargs):
+    return _n_edges(stats) * _SPARSE_VALUE_BYTES * 4 + stats.n_obs * 2 * 8, {}
+
+
+def diffmap_memory(stats, budget=None, n_comps=15, **kwargs):
+    needed = (_n_edges(stats) * _SPARSE_VALUE_BYTES * 4 +
+              stats.n_obs * n_comps * 8 * 3)
+    return needed, {}
+
+
+def cluster_memory(stats, budget=None, resolution=1, **kwargs):
+    n_res = len(_as_list(resolution))
+    # igraph copy of the graph and one label vector per resolution
+    needed = _n_edges(stats) * 48 + stats.n_obs * 8 * n_res
+    return needed, {}
+
+
+def paga_memory(stats, budget=None, **kwargs):
+    return _n_edges(stats) * _SPARSE_VALUE_BYTES * 2, {}
+
+
+def dpt_memory(stats, budget=None, n_dcs=10, **kwargs):
+    return stats.n_obs * n_dcs * 8 * 3, {}
+
+
+def diffexp_memory(
+        stats,
+        budget=None,
+        method='t-test_overestim_var',
+        engine='scanpy',
+        all_pairs=False,
+        **kwargs,
+):
+    group_stats = DEFAULT_N_GROUPS * stats.n_vars * 8 * 4
+
+    def native_bytes():
+        ranks = 0
+        if method == 'wilcoxon':
+            ranks = 2 * stats.n_obs * _GENE_BLOCK_SIZE * 8
+        if all_pairs:
+            group_stats_pairs = DEFAULT_N_GROUPS ** 2 * stats.n_vars * 8 * 2
+            return ranks + group_stats + group_stats_pairs
+        return ranks + group_stats
+
+    if engine == 'native' or all_pairs:
+        needed = native_bytes()
+    elif method == 'wilcoxon':
+        # group subsets, then dense blocks of genes being ranked
+        needed = (_matrix_bytes(stats) + 3 * stats.n_obs * 1000 * 8 +
+                  group_stats)
+    elif method == 'logreg':
+        needed = 2 * _dense_bytes(stats, itemsize=8)
+    else:
+        needed = _matrix_bytes(stats) + group_stats
+    changes = {}
+
+    if (budget is not None and needed > budget and engine == 'scanpy' and
+            method in NATIVE_METHODS and native_bytes() <= budget):
+        needed = native_bytes()
+        changes = {'engine': 'native'}
+    return needed, changes
+
+
+MEMORY_MODELS = {
+    'filter': filter_memory,
+    'norm': norm_memory,
+    'hvg': hvg_memory,
+    'scale': scale_memory,
+    'regress': regress_memory,
+    'pca': pca_memory,
+    'neighbor': neighbor_memory,
+    'umap': umap_memory,
+    'tsne': tsne_memory,
+    'fdg': fdg_memory,
+    'diffmap': diffmap_memory,
+    'louvain': cluster_memory,
+    'leiden': cluster_memory,
+    'diffexp': diffexp_memory,
+    'paga': paga_memory,
+    'dpt': dpt_memory,
+}
+
+
+# Seconds per unit of work on a single core, used when no benchmark results
+# are available to calibrate them
+SECONDS_PER_UNIT = {
+    'filter': 5e-8,
+    'norm': 3e-8,
+    'hvg': 5e-8,
+    'scale': 5e-9,
+    'regress': 2e-7,
+    'pca': 2e-10,
+    'neighbor': 1.5e-6,
+    'umap': 2e-7,
+    'tsne': 4e-6,
+    'fdg': 1.6e-6,
+    'diffmap': 5e-7,
+    'louvain': 2e-5,
+    'leiden': 1e-5,
+    'diffexp': 3e-7,
+    'paga': 2e-7,
+    'dpt': 1e-6,
+}
+
+# Relative cost of diffexp methods over the t-test
+_DIFFEXP_METHOD_COST = {'wilcoxon': 10, 'logreg': 20}
+
+
+def _umap_epochs(stats, maxiter=None):
+    return maxiter or (200 if stats.n_obs > 10000 else 500)
+
+
+def _stored_values_work(stats, **kwargs):
+    return stats.nnz
+
+
+def _dense_work(stats, **kwargs):
+    return stats.n_obs * stats.n_vars
+
+
+def _regress_work(stats, keys=None, **kwargs):
+    return stats.n_obs * stats.n_vars * max(len(_as_list(keys or [])), 1)
+
+
+def _pca_work(stats, n_comps=50, chunked=False, **kwargs):
+    work = stats.n_obs * stats.n_vars * (n_comps or 50)
+    # IncrementalPCA refits on every chunk
+    return 2 * work if chunked else work
+
+
+def _neighbor_work(stats, n_neighbors=15, **kwargs):
+    return sum(stats.n_obs * k * math.log2(max(stats.n_obs, 2))
+               for k in _as_list(n_neighbors))
+
+
+def _umap_work(stats, random_state=0, maxiter=None, **kwargs):
+    return (_n_edges(stats) * _umap_epochs(stats, maxiter) *
+            len(_as_list(random_state)))
+
+
+def _tsne_work(stats, random_state=0, perplexity=30, **kwargs):
+    return (stats.n_obs * math.log2(max(stats.n_obs, 2)) * 3 * perplexity *
+            len(_as_list(random_state)))
+
+
+def _fdg_work(stats, **kwargs):
+    # ForceAtlas2 runs 500 iterations over the edges
+    return _n_edges(stats) * 500
+
+
+def _diffmap_work(stats, n_comps=15, **kwargs):
+    return _n_edges(stats) * (n_comps or 15)
+
+
+def _cluster_work(stats, resolution=1, **kwargs):
+    return _n_edges(stats) * len(_as_list(resolution))
+
+
+def _diffexp_work(stats, method='t-test_overestim_var', engine='scanpy',
+                  all_pairs=False, **kwargs):
+    work = stats.nnz * _DIFFEXP_METHOD_COST.get(method, 1)
+    if engine == 'native' or all_pairs:
+        work /= 2
+    return work
+
+
+def _paga_work(stats, **kwargs):
+    return _n_edges(stats)
+
+
+def _dpt_work(stats, n_dcs=10, **kwargs):
+    return stats.n_obs * n_dcs
+
+
+RUNTIME_MODELS = {
+    'filter': _stored_values_work,
+    'norm': _stored_values_work,
+    'hvg': _stored_values_work,
+    'scale': _dense_work,
+    'regress': _regress_work,
+    'pca': _pca_work,
+    'neighbor': _neighbor_work,
+    'umap': _umap_work,
+    'tsne': _tsne_work,
+    'fdg': _fdg_work,
+    'diffmap': _diffmap_work,
+    'louvain': _cluster_work,
+    'leiden': _cluster_work,
+    'diffexp': _diffexp_work,
+    'paga': _paga_work,
+    'dpt': _dpt_work,
+}
+
+
+def _no_output(stats, **kwargs):
+    return 0
+
+
+def _norm_output(stats, save_raw='yes', **kwargs):
+    return _matrix_bytes(stats) if save_raw in ('yes', 'counts') else 0
+
+
+def _hvg_output(stats, **kwargs):
+    return stats.n_vars * 8 * 4
+
+
+def _scale_output(stats, zero_center=True, **kwargs):
+    if zero_center and _is_sparse(stats):
+        return _dense_bytes(stats) - _matrix_bytes(stats)
+    return 0
+
+
+def _regress_output(stats, **kwargs):
+    return max(_dense_bytes(stats, itemsize=8) - _matrix_bytes(stats), 0)
+
+
+def _pca_output(stats, n_comps=50, **kwargs):
+    n_comps = n_comps or 50
+    return stats.n_obs * n_comps * 4 + stats.n_vars * n_comps * 8
+
+
+def _neighbor_output(stats, n_neighbors=15, **kwargs):
+    return sum(stats.n_obs * k * _SPARSE_VALUE_BYTES * 2
+               for k in _as_list(n_neighbors))
+
+
+def _umap_output(stats, random_state=0, n_components=2, **kwargs):
+    return stats.n_obs * n_components * 8 * len(_as_list(random_state))
+
+
+def _tsne_output(stats, random_state=0, **kwargs):
+    return stats.n_obs * 2 * 8 * len(_as_list(random_state))
+
+
+def _fdg_output(stats, **kwargs):
+    return stats.n_obs * 2 * 8
+
+
+def _diffmap_output(stats, n_comps=15, **kwargs):
+    return stats.n_obs * (n_comps or 15) * 8
+
+
+def _cluster_output(stats, resolution=1, **kwargs):
+    return stats.n_obs * 8 * len(_as_list(resolution))
+
+
+def _diffexp_output(stats, **kwargs):
+    # names, scores, fold changes, p-values and adjusted p-values
+    return DEFAULT_N_GROUPS * stats.n_vars * 8 * 5
+
+
+def _paga_output(stats, **kwargs):
+    return DEFAULT_N_GROUPS ** 2 * 8 * 2
+
+
+def _dpt_output(stats, **kwargs):
+    return stats.n_obs * 8 * 2
+
+
+OUTPUT_MODELS = {
+    'filter': _no_output,
+    'norm': _norm_output,
+    'hvg': _hvg_output,
+    'scale': _scale_output,
+    'regress': _regress_output,
+    'pca': _pca_output,
+    'neighbor': _neighbor_output,
+    'umap': _umap_output,
+    'tsne': _tsne_output,
+    'fdg': _fdg_output,
+    'diffmap': _diffmap_output,
+    'louvain': _cluster_output,
+    'leiden': _cluster_output,
+    'diffexp': _diffexp_output,
+    'paga': _paga_output,
+    'dpt': _dpt_output,
+}
@@ -0,0 +1,90 @@
+"""dtype_utils
+
+Keep the floating point matrices of objects in one precision set by
+`scanpy-cli --dtype`.
+
+scanpy returns float64 for many matrices, e.g. the scaled `.X`, the PCA
+embedding and the neighbour graph, whatever the precision of its input. Once
+a policy is set, the matrices of an object are cast to it when read, by the
+`lib` wrappers after each scanpy call, and before writing: `.X`, `.raw.X`,
+`.layers`, `.obsm`, `.varm` and the 2-D arrays and sparse matrices nested in
+`.uns`. 1-D arrays, such as the PCA variance, and annotation columns are left
+as they are.
+"""
+
+DTYPES = ('float32', 'float64')
+
+_dtype_policy = None
+
+
+def set_dtype_policy(dtype):
+    """Cast floating point matrices to `dtype` from now on, or leave them as
+    each step produces them if None
+    """
+    global _dtype_policy
+    if dtype is not None and dtype not in DTYPES:
+        raise ValueError(f'Unsupported dtype: {dtype}')
+    _dtype_policy = dtype
+
+
+def get_dtype_policy():
+    """Return the dtype set by `set_dtype_policy`, None if unset
+    """
+    return _dtype_policy
+
+
+def enforce_dtype(adata, dtype=None):
+    """Cast the floating point matrices of `adata` in place to `dtype`, by
+    default the current policy, no-op if neither is set
+
+    A lazily loaded `.X` is left as it is until loaded.
+    """
+    import numpy as np
+
+    dtype = dtype or _dtype_policy
+    if dtype is None:
+        return adata
+    dtype = np.dtype(dtype)
+
+    X = _cast(adata.X, dtype)
+    if X is not adata.X:
+        adata.X = X
+    if adata.raw is not None and hasattr(adata.raw, '_X'):
+        adata.raw._X = _cast(adata.raw._X, dtype)
+    for key in list(adata.layers.keys()):
+        layer = _cast(adata.layers[key], dtype)
+        if layer is not adata.layers[key]:
+            adata.layers[key] = layer
+    for name in ('obsm', 'varm'):
+        for key in list(getattr(adata, name).keys()):
+            # setting a key of the record array of anndata rebinds the slot to
+            # a new array, so fetch it again for every key
+            slot = getattr(adata, name)
+            value = _cast(slot[key], dtype)
+            if value is not slot[key]:
+                slot[key] = value
+    _cast_nested(adata.uns, dtype)
+    return adata
+
+
+def _cast(value, dtype):
+    """Return `value` cast to `dtype` if it is a floating point matrix of
+    another precision, else `value` itself
+    """
+    import numpy as np
+    import scipy.sparse as sp
+
+    if sp.issparse(value) or (isinstance(value, np.ndarray) and value.ndim >= 2):
+        if value.dtype.kind == 'f' and value.dtype != dtype:
+            return value.astype(dtype)
+    return value
+
+
+def _cast_nested(mapping, dtype):
+    for key, value in mapping.items():
+        if isinstance(value, dict):
+            _cast_nested(value, dtype)
+        else:
+            cast = _cast(value, dtype)
+            if cast is not value:
+                mapping[key] = cast
@@ -0,0 +1,322 @@
+"""estimate_utils
+
+Estimate the runtime, peak memory and output size of a sub-command without
+running it, for `--dry-run`.
+
+The shape, density and dtype of the input matrices are taken from the HDF5 or
+zarr headers of the input object without reading it. Where the number of
+stored values is not recorded, as for loom and zarr matrices stored densely,
+it is sampled from one block of cells. The cost models of `cost_utils` then
+give the estimates for the options given, e.g. for every k, resolution or
+seed listed.
+
+Runtimes are units of work times seconds per unit, calibrated from the
+timings of the benchmark suite when its results are found in
+`$SCANPY_SCRIPTS_BENCH_RESULTS` (`.asv/results` by default). Commands that
+are not benchmarked are scaled by how the machine compares with the defaults
+on those that are.
+"""
+
+import glob
+import json
+import logging
+import os
+from collections import namedtuple
+
+import click
+import numpy as np
+
+from .memory_utils import ObjectStats, format_size
+
+BENCH_RESULTS_DIR = os.environ.get(
+    'SCANPY_SCRIPTS_BENCH_RESULTS', os.path.join('.asv', 'results'))
+
+# As in benchmarks/datasets.py
+BENCH_DATA_DIR = os.environ.get(
+    'SCANPY_SCRIPTS_BENCH_DATA',
+    os.path.join(os.path.expanduser('~'), '.cache', 'scanpy-scripts', 'benchmarks'),
+)
+
+# Shape of the synthetic benchmark counts, used when the datasets are not at
+# hand to read it from
+_BENCH_N_VARS = 2000
+_BENCH_DENSITY = 0.16
+
+# Benchmark timing each command, the dataset stage it starts from and the
+# options it runs with
+_BENCHMARKS = {
+    'filter': ('Filter.time_filter_anndata', 'raw', {}),
+    'norm': ('Normalize.time_normalize', 'filter', {'save_raw': 'yes'}),
+    'hvg': ('Hvg.time_hvg', 'norm', {}),
+    'pca': ('Pca.time_pca', 'hvg', {'n_comps': 50}),
+    'neighbor': ('Neighbors.time_neighbors', 'pca', {'n_neighbors': 15}),
+    'umap': ('Umap.time_umap', 'neighbors', {'random_state': 0}),
+    'leiden': ('Leiden.time_leiden', 'neighbors', {'resolution': 1.0}),
+    'diffexp': ('Diffexp.time_diffexp_t_test', 'leiden', {'method': 't-test'}),
+}
+
+# Number of cells sampled to estimate the density of dense stored matrices
+_SAMPLE_SIZE = 1000
+
+Estimate = namedtuple(
+    'Estimate', ['stats', 'resident', 'seconds', 'needed', 'output', 'changes'])
+
+
+def peek_input(input_obj, input_format='anndata', use_graph=None, lazy=False):
+    """Return the `ObjectStats` of an input object and the memory its
+    matrices would take once read, from its headers only
+
+    * Parameters
+        + input_obj : str
+        Path of the h5ad or loom file, or zarr directory store
+        + input_format : str
+        One of 'anndata', 'loom' or 'zarr'
+        + use_graph : str
+        Key of the neighbour graph in `.uns` to count edges of
+        + lazy : bool
+        Whether `.X` would be left on disk, as for zarr input of commands
+        streaming over it
+    """
+    if input_format == 'zarr':
+        import zarr
+        root = zarr.open(input_obj, mode='r')
+        return _peek_anndata(root, use_graph, lazy)
+    import h5py
+    with h5py.File(input_obj, mode='r') as fh:
+        if input_format == 'loom':
+            return _peek_loom(fh)
+        return _peek_anndata(fh, use_graph, lazy)
+
+
+def _peek_anndata(root, use_graph, lazy):
+    X = root['X']
+    shape, nnz, itemsize = _matrix_header(X)
+    n_edges = None
+    graph_path = f'uns/{use_graph or "neighbors"}/connectivities/data'
+    if graph_path in root:
+        n_edges = root[graph_path].shape[0]
+    stats = ObjectStats(shape[0], shape[1], nnz, itemsize, n_edges, lazy)
+
+    resident = 0 if lazy else _loaded_bytes(X)
+    for key in ('raw.X', 'raw/X', 'layers', 'obsm'):
+        if key in root:
+            resident += _loaded_bytes(root[key])
+    return stats, resident
+
+
+def _peek_loom(fh):
+    # genes by cells, read into a sparse matrix
+    matrix = fh['matrix']
+    n_vars, n_obs = matrix.shape
+    density = _sampled_density(matrix[:, :_SAMPLE_SIZE])
+    nnz = int(density * n_obs * n_vars)
+    itemsize = matrix.dtype.itemsize
+    stats = ObjectStats(n_obs, n_vars, nnz, itemsize, None, False)
+    n_matrices = 1 + len(fh['layers'].keys()) if 'layers' in fh else 1
+    return stats, n_matrices * _sparse_bytes(n_obs, nnz, itemsize)
+
+
+def _matrix_header(node):
+    """Shape, number of stored values and item size of a dense array or a
+    sparse matrix group
+    """
+    if _is_array(node):
+        shape = node.shape
+        if node.attrs.get('sparse_format'):
+            # zarr matrices of scanpy-scripts are stored densely
+            nnz = int(_sampled_density(node[:_SAMPLE_SIZE]) * np.prod(shape))
+        else:
+            nnz = int(np.prod(shape))
+        return shape, nnz, node.dtype.itemsize
+    shape = node.attrs.get('h5sparse_shape', node.attrs.get('shape'))
+    data = node['data']
+    return tuple(int(n) for n in shape), data.shape[0], data.dtype.itemsize
+
+
+def _loaded_bytes(node):
+    """Memory a dense array, a sparse matrix group or a group of them takes
+    once read
+    """
+    if _is_array(node):
+        if node.attrs.get('sparse_format'):
+            shape, nnz, itemsize = _matrix_header(node)
+            return _sparse_bytes(shape[0], nnz, itemsize)
+        return int(np.prod(node.shape)) * node.dtype.itemsize
+    return sum(_loaded_bytes(child) for child in node.values())
+
+
+def _is_array(node):
+    return hasattr(node, 'shape') and hasattr(node, 'dtype')
+
+
+def _sampled_density(block):
+    block = np.asarray(block)
+    return np.count_nonzero(block) / block.size if block.size else 1.0
+
+
+def _sparse_bytes(n_rows, nnz, itemsize):
+    return nnz * (itemsize + 4) + (n_rows + 1) * 8
+
+
+def calibrate(results_dir=None):
+    """Return seconds per unit of work of each command, calibrated from the
+    latest benchmark results in `results_dir`, and the results file used, or
+    the defaults and None if there are none
+    """
+    from .cost_utils import RUNTIME_MODELS, SECONDS_PER_UNIT
+
+    rates = dict(SECONDS_PER_UNIT)
+    results_file = _latest_results(results_dir or BENCH_RESULTS_DIR)
+    if results_file is None:
+        return rates, None
+    try:
+        with open(results_file) as fh:
+            results = json.load(fh)
+    except (OSError, ValueError) as e:
+        logging.warning('Ignoring benchmark results %s: %s', results_file, e)
+        return rates, None
+    columns = results.get('result_columns', [])
+
+    calibrated = {}
+    for cmd_name, (name, stage, kwargs) in _BENCHMARKS.items():
+        entry = results.get('results', {}).get(f'benchmarks.{name}')
+        timings = _bench_timings(entry, columns) if entry else []
+        if not timings:
+            continue
+        # the largest dataset is the closest to the asymptotic cost
+        n_obs, seconds = max(timings)
+        work = RUNTIME_MODELS[cmd_name](_bench_stats(n_obs, stage), **kwargs)
+        calibrated[cmd_name] = seconds / work
+    if not calibrated:
+        return rates, None
+
+    speed = float(np.median(
+        [calibrated[cmd] / rates[cmd] for cmd in calibrated]))
+    for cmd_name in rates:
+        rates[cmd_name] = calibrated.get(cmd_name, rates[cmd_name] * speed)
+    return rates, results_file
+
+
+def _latest_results(results_dir):
+    files = [fname for fname in glob.glob(os.path.join(results_dir, '*', '*.json'))
+             if os.path.basename(fname) != 'machine.json']
+    return max(files, key=os.path.getmtime) if files else None
+
+
+def _bench_timings(entry, columns):
+    """(n_obs, seconds) pairs of a benchmark entry of asv results, in the
+    formats of asv before and after 0.5
+    """
+    if isinstance(entry, dict):
+        result, params = entry.get('result'), entry.get('params')
+    elif 'result' in columns and 'params' in columns:
+        result = entry[columns.index('result')]
+        params = entry[columns.index('params')]
+    else:
+        return []
+    if not params or not isinstance(result, list):
+        return []
+    return [(int(str(param).strip('\'"')), seconds)
+            for param, seconds in zip(params[0], result)
+            if seconds is not None and not np.isnan(seconds)]
+
+
+def _bench_stats(n_obs, stage):
+    path = os.path.join(BENCH_DATA_DIR, f'{n_obs}_{stage}.h5ad')
+    if os.path.exists(path):
+        return peek_input(path)[0]
+    return ObjectStats(n_obs, _BENCH_N_VARS,
+                       int(n_obs * _BENCH_N_VARS * _BENCH_DENSITY), 4, None, False)
+
+
+def estimate_cost(cmd_name, input_obj, input_format='anndata', kwargs=None,
+                  lazy=False, max_memory=None, rates=None):
+    """Estimate the cost of running `cmd_name` on `input_obj` with `kwargs`
+
+    * Parameters
+        + cmd_name : str
+        Name of the command, as keyed in the models of `cost_utils`
+        + input_obj : str
+        Path of the input object
+        + input_format : str
+        One of 'anndata', 'loom' or 'zarr'
+        + kwargs : dict
+        Options of the command
+        + lazy : bool
+        Whether `.X` of zarr input would be left on disk
+        + max_memory : int
+        Memory budget in bytes under which the command would switch code
+        path, or None
+        + rates : dict
+        Seconds per unit of work of each command, as returned by `calibrate`
+
+    * Returns
+        + estimate : Estimate
+        The input stats and resident bytes, runtime in seconds, peak memory
+        needed on top of the input in bytes, output size in bytes and
+        options changed to fit `max_memory`, or None if `cmd_name` has no
+        cost model
+    """
+    from .cost_utils import MEMORY_MODELS, OUTPUT_MODELS, RUNTIME_MODELS
+
+    if cmd_name not in MEMORY_MODELS:
+        return None
+    kwargs = kwargs or {}
+    if rates is None:
+        rates = calibrate()[0]
+    stats, resident = peek_input(
+        input_obj, input_format, use_graph=kwargs.get('use_graph'), lazy=lazy)
+    budget = max_memory - resident if max_memory else None
+    needed, changes = MEMORY_MODELS[cmd_name](stats, budget=budget, **kwargs)
+    planned = dict(kwargs, **changes)
+    seconds = RUNTIME_MODELS[cmd_name](stats, **planned) * rates[cmd_name]
+    output = _path_size(input_obj) + OUTPUT_MODELS[cmd_name](stats, **planned)
+    return Estimate(stats, resident, seconds, needed, output, changes)
+
+
+def _path_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(dirpath, fname))
+                   for dirpath, _, fnames in os.walk(path) for fname in fnames)
+    return os.path.getsize(path)
+
+
+def format_duration(seconds):
+    """Format seconds as e.g. '4.5s', '12.5min' or '2.1h'
+    """
+    if seconds < 60:
+        return f'{seconds:.1f}s'
+    if seconds < 3600:
+        return f'{seconds / 60:.1f}min'
+    return f'{seconds / 3600:.1f}h'
+
+
+def print_estimate(cmd_name, input_obj, input_format='anndata', kwargs=None,
+                   lazy=False, max_memory=None):
+    """Print the estimated cost of a command to standard output
+    """
+    rates, results_file = calibrate()
+    estimate = estimate_cost(
+        cmd_name, input_obj, input_format=input_format, kwargs=kwargs,
+        lazy=lazy, max_memory=max_memory, rates=rates)
+    if estimate is None:
+        click.echo(f'{cmd_name}: no cost model, nothing to estimate')
+        return
+    stats = estimate.stats
+    density = stats.nnz / max(stats.n_obs * stats.n_vars, 1)
+    peak = estimate.resident + estimate.needed
+    click.echo(
+        f'{cmd_name} on {input_obj}: {stats.n_obs} cells x {stats.n_vars} '
+        f'genes, {density:.1%} stored, {stats.itemsize * 8}-bit values')
+    click.echo(f'  runtime:     {format_duration(estimate.seconds)} '
+               f'(seconds per unit of work '
+               f'{"from " + results_file if results_file else "by default"})')
+    click.echo(f'  peak memory: {format_size(peak)} '
+               f'({format_size(estimate.resident)} for the input)')
+    click.echo(f'  output size: {format_size(estimate.output)}')
+    if max_memory:
+        if peak > max_memory:
+            click.echo(f'  would stop: beyond --max-memory {format_size(max_memory)}')
+        for key, value in estimate.changes.items():
+            click.echo(f'  would set {key}={value} to stay within --max-memory '
+                       f'{format_size(max_memory)}')
@@ -32,6 +32,7 @@ import numpy as np
 import pandas as pd
 import scipy.sparse as sp
 from packaging import version
+from .link_utils import duplicated_matrices, link_duplicates
 
 
 EXCHANGEABLE_LOOM_VERSION = '3.0.0'
@@ -254,10 +255,27 @@ def write_exchangeable_loom(adata, filename, col_graphs=['neighbors']):
         An AnnData object
         + filename : str
         Path of the output exchangeable Loom file
+
+    Layers identical to `.X` or to one another are stored once, the others
+    being hard links to it.
     """
-    adata.write_loom(filename)
+    duplicates = duplicated_matrices(
+        [('matrix', adata.X)] +
+        [(f'layers/{key}', adata.layers[key]) for key in adata.layers.keys()])
+    layers = {}
+    try:
+        for path in duplicates:
+            key = path[len('layers/'):]
+            layers[key] = adata.layers[key]
+            del adata.layers[key]
+        adata.write_loom(filename)
+    finally:
+        for key, layer in layers.items():
+            adata.layers[key] = layer
     manifest = {'loom': [], 'dtype': [], 'anndata': [], 'sce': []}
     with h5py.File(filename, mode='r+') as lm:
+        link_duplicates(lm, duplicates)
+
         # Write modified LOOM_SPEC_VERSION
         lm.attrs['LOOM_SPEC_VERSION'] = EXCHANGEABLE_LOOM_VERSION.encode()
 
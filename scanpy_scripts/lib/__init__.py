@@ -3,6 +3,7 @@ Provides exported functions
 """
 
 from ._read import read_10x
+from ._annotate import annotate
 from ._filter import filter_anndata
 from ._norm import normalize
 from ._hvg import hvg
@@ -12,7 +13,8 @@ from ._fdg import fdg
 from ._tsne import tsne
 from ._louvain import louvain
 from ._leiden import leiden
-from ._diffexp import diffexp, diffexp_paired, extract_de_table
+from ._diffexp import (
+    diffexp, diffexp_paired, diffexp_all_pairs, extract_de_table)
 from ._diffmap import diffmap
 from ._dpt import dpt
 from ._paga import paga, plot_paga
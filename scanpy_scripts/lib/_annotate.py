@@ -0,0 +1,100 @@
+"""
+scanpy annotate
+"""
+
+import logging
+import pandas as pd
+
+# Rows used to infer column types before the full read
+_SNIFF_ROWS = 1000
+
+
+def annotate(
+        adata,
+        extra_obs=None,
+        extra_obs_columns=None,
+        extra_var=None,
+        extra_var_columns=None,
+):
+    """
+    Attach extra cell and gene metadata tables to an existing object
+    """
+    if extra_obs:
+        obs_tbl = read_metadata(extra_obs, columns=extra_obs_columns)
+        join_metadata(adata.obs, obs_tbl, name='cells')
+
+    if extra_var:
+        var_tbl = read_metadata(extra_var, columns=extra_var_columns)
+        join_metadata(adata.var, var_tbl, name='genes')
+    return adata
+
+
+def read_metadata(fname, columns=None):
+    """Read a tab-separated metadata table with a header row and an index
+    column
+
+    Only `columns` are parsed if specified. Column types are inferred from the
+    leading rows and string columns are parsed straight into categoricals.
+
+    * Parameters
+        + fname : str
+        Path of the input table
+        + columns : list of str
+        Names of columns to read, all if None
+
+    * Returns
+        + tbl : pandas.DataFrame
+        Metadata table indexed by its first column
+    """
+    head = pd.read_csv(fname, sep='\t', header=0, nrows=_SNIFF_ROWS)
+    index_col = head.columns[0]
+    if columns is None:
+        columns = list(head.columns[1:])
+    missing = [col for col in columns if col not in head.columns]
+    if missing:
+        raise KeyError(f'Columns not found in {fname}: {", ".join(missing)}')
+
+    dtype = {index_col: str}
+    for col in columns:
+        if pd.api.types.is_string_dtype(head[col]):
+            dtype[col] = 'category'
+    tbl = pd.read_csv(
+        fname, sep='\t', header=0, usecols=[index_col, *columns], dtype=dtype,
+        index_col=0)
+    return tbl[columns]
+
+
+def join_metadata(frame, tbl, name='rows'):
+    """Left-join a metadata table onto `frame` in place by index
+
+    `tbl` is reindexed onto `frame.index`, rows of `frame` absent from `tbl`
+    get missing values and `frame` keeps its order. Existing columns of the
+    same names are replaced.
+
+    * Parameters
+        + frame : pandas.DataFrame
+        Table to be annotated, e.g. `adata.obs`
+        + tbl : pandas.DataFrame
+        Metadata table indexed by the same names as `frame`
+        + name : str
+        What the rows are, used in log messages
+    """
+    if not tbl.index.is_unique:
+        dup = tbl.index[tbl.index.duplicated()].unique()
+        raise ValueError(f'Duplicated index in metadata table: {", ".join(dup[:5])}')
+    indexer = tbl.index.get_indexer(frame.index)
+    n_matched = int((indexer >= 0).sum())
+    if n_matched == 0:
+        logging.warning('none of the %d %s found in metadata table', len(frame), name)
+    else:
+        logging.info('%d of %d %s found in metadata table', n_matched, len(frame), name)
+
+    aligned = tbl.reindex(frame.index)
+    for col in aligned.columns:
+        if col in frame.columns:
+            logging.warning('replacing existing column "%s"', col)
+        values = aligned[col]
+        if isinstance(values.dtype, pd.api.types.CategoricalDtype):
+            values = values.cat.remove_unused_categories()
+        frame[col] = values.values
+    return frame
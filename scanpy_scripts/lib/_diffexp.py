@@ -2,8 +2,19 @@
 scanpy diffexp
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+from scipy import stats
 import scanpy as sc
+from ..cost_utils import NATIVE_METHODS, _GENE_BLOCK_SIZE
+from ..obj_utils import (
+    _export_format, _open_tsv, _write_arrow_batches, _write_dataframe,
+    _write_tsv, _write_tsv_rows)
+from ..thread_utils import default_n_threads
+
+ENGINES = ('scanpy', 'native')
 
 
 def diffexp(
@@ -14,11 +25,28 @@ def diffexp(
         logreg_param=None,
         filter_params=None,
         save=None,
+        engine='scanpy',
+        all_pairs=False,
         **kwargs,
 ):
     """
-    Wrapper function for sc.tl.rank_genes_groups.
+    Wrapper function for sc.tl.rank_genes_groups, or for
+    rank_genes_groups_native with engine='native'.
+
+    With all_pairs=True, compare every pair of groups with diffexp_all_pairs
+    instead, leaving adata.uns untouched.
     """
+    if engine not in ENGINES:
+        raise ValueError(f'Engine must be one of {ENGINES}: {engine}')
+
+    if all_pairs:
+        if filter_params:
+            raise ValueError('Filtering is not supported with all pairs')
+        if kwargs.pop('reference', 'rest') != 'rest':
+            raise ValueError('A reference cannot be set with all pairs')
+        return diffexp_all_pairs(
+            adata, use_raw=use_raw, n_genes=n_genes, save=save, **kwargs)
+
     if adata.raw is None:
         use_raw = False
 
@@ -29,7 +57,10 @@ def diffexp(
         for key, val in logreg_param:
             kwargs[key] = val
 
-    sc.tl.rank_genes_groups(
+    rank_genes_groups = (
+        rank_genes_groups_native if engine == 'native' else
+        sc.tl.rank_genes_groups)
+    rank_genes_groups(
         adata, use_raw=use_raw, n_genes=n_genes, key_added=key_added, **kwargs)
 
     key_added = key_added if key_added else 'rank_genes_groups'
@@ -49,7 +80,7 @@ def diffexp(
         de_tbl = de_tbl.loc[de_tbl.genes.astype(str) != 'nan', :]
 
     if save:
-        de_tbl.to_csv(save, sep='\t', header=True, index=False)
+        write_de_table(de_tbl, save)
 
     return de_tbl
 
@@ -81,26 +112,509 @@ def diffexp_paired(adata, groupby, pair, **kwargs):
     return up_de, down_de
 
 
+def diffexp_all_pairs(
+        adata,
+        groupby,
+        use_raw=True,
+        groups='all',
+        n_genes=None,
+        rankby_abs=False,
+        method='t-test_overestim_var',
+        corr_method='benjamini-hochberg',
+        save=None,
+        n_jobs=None,
+):
+    """
+    Compare every ordered pair of groups, as diffexp_paired would for each
+    pair, from statistics computed once per group.
+
+    Group sums and sums of squares give every pairwise t-test. For Wilcoxon
+    tests, each gene is sorted once and the Mann-Whitney U statistics of all
+    pairs are counted from the sorted values, which takes memory for
+    n_genes x n_groups^2 statistics. Pairs are then tested in parallel over
+    `n_jobs` threads.
+
+    The table has the columns of extract_de_table, with `ref` the group
+    tested against. It is streamed pair by pair to `save` if given, else
+    returned.
+    """
+    if method not in NATIVE_METHODS:
+        raise ValueError(
+            f'Method must be one of {NATIVE_METHODS} with all pairs: {method}')
+    if corr_method not in ('benjamini-hochberg', 'bonferroni'):
+        raise ValueError(f'Unknown correction method: {corr_method}')
+
+    sc.utils.sanitize_anndata(adata)
+    if isinstance(groups, str):
+        groups_order = (list(adata.obs[groupby].cat.categories)
+                        if groups == 'all' else [groups])
+    else:
+        groups_order = [str(g) for g in groups]
+    if len(groups_order) < 2:
+        raise ValueError('At least two groups are needed for pairs')
+    n_groups = len(groups_order)
+    labels = _group_labels(adata.obs[groupby], groups_order)
+
+    if adata.raw is None:
+        use_raw = False
+    adata_comp = adata.raw if use_raw else adata
+    X = adata_comp.X
+    n_vars = X.shape[1]
+    n_genes = n_vars if n_genes is None else min(n_genes, n_vars)
+    n_jobs = default_n_threads(n_jobs)
+
+    ns, sums, sumsq = _group_sums(X, labels, n_groups + 1)
+    group_stats = [_mean_var(sums[i], sumsq[i], ns[i]) for i in range(n_groups)]
+
+    u_stats = None
+    if method == 'wilcoxon':
+        if sp.issparse(X):
+            X = X.tocsc(copy=True)
+            X.eliminate_zeros()
+        u_stats = _pairwise_u_statistics(X, labels, n_groups + 1, n_jobs)
+
+    pairs = [(i, j) for i in range(n_groups) for j in range(n_groups) if i != j]
+    categories = [str(g) for g in groups_order]
+    var_names = np.asarray(adata_comp.var_names)
+
+    def compare_pair(pair):
+        i, j = pair
+        rank_sum = None
+        if u_stats is not None:
+            rank_sum = u_stats[:, i, j] + ns[i] * (ns[i] + 1) / 2
+        top, ranked = _compare_groups(
+            group_stats[i], ns[i], group_stats[j], ns[j],
+            method, corr_method, n_genes, rankby_abs, rank_sum=rank_sum)
+        de_tbl = pd.DataFrame({
+            'cluster': pd.Categorical.from_codes(
+                np.full(len(top), i), categories=categories),
+            'ref': pd.Categorical.from_codes(
+                np.full(len(top), j), categories=categories),
+            'rank': np.arange(len(top)),
+            'genes': var_names[top],
+        })
+        for field, values in ranked.items():
+            de_tbl[field] = values
+        return de_tbl
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        de_tbls = executor.map(compare_pair, pairs)
+        if save:
+            write_de_tables(de_tbls, save)
+            return None
+        return pd.concat(list(de_tbls), ignore_index=True)
+
+
 def extract_de_table(de_dict):
     """
-    Extract DE table from adata.uns
+    Extract DE table from adata.uns, one row per cluster and rank
     """
     if de_dict['params']['method'] == 'logreg':
         requested_fields = ('scores',)
     else:
         requested_fields = ('scores', 'logfoldchanges', 'pvals', 'pvals_adj',)
-    gene_df = _recarray_to_dataframe(de_dict['names'], 'genes')[
-        ['cluster', 'rank', 'genes']]
-    gene_df['ref'] = de_dict['params']['reference']
-    gene_df = gene_df[['cluster', 'ref', 'rank', 'genes']]
-    de_df = pd.DataFrame({
-        field: _recarray_to_dataframe(de_dict[field], field)[field]
-        for field in requested_fields if field in de_dict
+    names = de_dict['names']
+    clusters = list(names.dtype.names)
+    n_rank = len(names)
+    de_tbl = pd.DataFrame({
+        'cluster': pd.Categorical.from_codes(
+            np.repeat(np.arange(len(clusters)), n_rank), categories=clusters),
+        'ref': de_dict['params']['reference'],
+        'rank': np.tile(np.arange(n_rank), len(clusters)),
+        'genes': _recarray_to_column(names),
     })
-    return gene_df.merge(de_df, left_index=True, right_index=True)
+    for field in requested_fields:
+        if field in de_dict:
+            de_tbl[field] = _recarray_to_column(de_dict[field])
+    return de_tbl
+
+
+def _recarray_to_column(array):
+    """Flatten a record array of one field per cluster into a single column,
+    cluster by cluster
+    """
+    return np.stack([array[name] for name in array.dtype.names]).ravel()
+
+
+def write_de_tables(de_tbls, fname):
+    """
+    Write DE tables with the same columns one after the other into a single
+    table as they come, in the formats of write_de_table
+    """
+    fmt = _export_format(fname)
+    if fmt in ('parquet', 'feather'):
+        import pyarrow as pa
+        _write_arrow_batches(
+            fname,
+            (batch for de_tbl in de_tbls for batch in
+             pa.Table.from_pandas(de_tbl, preserve_index=False).to_batches()),
+            fmt,
+        )
+    else:
+        fh = None
+        try:
+            for de_tbl in de_tbls:
+                if fh is None:
+                    fh = _open_tsv(fname, header=list(de_tbl.columns))
+                _write_tsv_rows(fh, [de_tbl[col].values for col in de_tbl.columns])
+        finally:
+            if fh is not None:
+                fh.close()
+
+
+def write_de_table(de_tbl, fname):
+    """
+    Write DE table as parquet or feather by extension, otherwise as
+    tab-separated text, gzip-compressed if `fname` ends with '.gz'
+    """
+    fmt = _export_format(fname)
+    if fmt in ('parquet', 'feather'):
+        _write_dataframe(de_tbl, fname, fmt)
+    else:
+        _write_tsv(
+            fname,
+            [de_tbl[col].values for col in de_tbl.columns],
+            header=list(de_tbl.columns),
+        )
+
+
+def rank_genes_groups_native(
+        adata,
+        groupby,
+        use_raw=True,
+        groups='all',
+        reference='rest',
+        n_genes=100,
+        rankby_abs=False,
+        key_added=None,
+        method='t-test_overestim_var',
+        corr_method='benjamini-hochberg',
+        n_jobs=None,
+):
+    """
+    Rank genes for each group like sc.tl.rank_genes_groups, and store the
+    results in the same structure of adata.uns.
+
+    Group means and variances come from a single sparse product of the
+    matrix with the group indicators. For Wilcoxon tests, genes are ranked by
+    blocks of a CSC copy of the matrix, in parallel over `n_jobs` threads,
+    with ties given their average rank and zeros ranked without being
+    expanded. Against 'rest', one ranking per gene serves all groups.
+
+    Only t-test, t-test_overestim_var and wilcoxon are supported.
+    """
+    if method not in NATIVE_METHODS:
+        raise ValueError(
+            f'Method must be one of {NATIVE_METHODS} with the native engine: '
+            f'{method}')
+    if corr_method not in ('benjamini-hochberg', 'bonferroni'):
+        raise ValueError(f'Unknown correction method: {corr_method}')
+
+    sc.utils.sanitize_anndata(adata)
+    categories = adata.obs[groupby].cat.categories
+    if isinstance(groups, str):
+        groups_order = list(categories) if groups == 'all' else [groups]
+    else:
+        groups_order = [str(g) for g in groups]
+    if reference != 'rest':
+        if reference not in set(categories):
+            raise ValueError(
+                f'reference = {reference} needs to be one of groupby = '
+                f'{categories.tolist()}.')
+        if reference not in groups_order:
+            groups_order.append(reference)
+    n_groups = len(groups_order)
+    labels = _group_labels(adata.obs[groupby], groups_order)
+
+    adata_comp = adata.raw if use_raw and adata.raw is not None else adata
+    X = adata_comp.X
+    n_cells, n_vars = X.shape
+    n_genes_user = min(n_genes, n_vars)
+
+    ns, sums, sumsq = _group_sums(X, labels, n_groups + 1)
+    total_sum, total_sumsq = sums.sum(axis=0), sumsq.sum(axis=0)
+
+    if reference == 'rest':
+        compared = list(range(n_groups))
+    else:
+        ireference = groups_order.index(reference)
+        compared = [i for i in range(n_groups) if i != ireference]
+
+    if method == 'wilcoxon':
+        if sp.issparse(X):
+            X = X.tocsc(copy=True)
+            X.eliminate_zeros()
+        n_jobs = default_n_threads(n_jobs)
+        if reference == 'rest':
+            rank_sums = _rank_sums(X, labels, n_groups + 1, n_jobs)
+        else:
+            rank_sums = np.empty((n_groups, n_vars))
+            for igroup in compared:
+                rows = np.flatnonzero(
+                    (labels == igroup) | (labels == ireference))
+                pair_labels = (labels[rows] != igroup).astype(np.intp)
+                rank_sums[igroup] = _rank_sums(
+                    X[rows], pair_labels, 2, n_jobs)[0]
+
+    stats_out = {
+        'scores': [], 'names': [], 'logfoldchanges': [], 'pvals': [],
+        'pvals_adj': [],
+    }
+    for igroup in compared:
+        n_group = ns[igroup]
+        if reference == 'rest':
+            n_rest = n_cells - n_group
+            rest_sum = total_sum - sums[igroup]
+            rest_sumsq = total_sumsq - sumsq[igroup]
+        else:
+            n_rest = ns[ireference]
+            rest_sum, rest_sumsq = sums[ireference], sumsq[ireference]
+        top, ranked = _compare_groups(
+            _mean_var(sums[igroup], sumsq[igroup], n_group), n_group,
+            _mean_var(rest_sum, rest_sumsq, n_rest), n_rest,
+            method, corr_method, n_genes_user, rankby_abs,
+            rank_sum=rank_sums[igroup] if method == 'wilcoxon' else None,
+        )
+        stats_out['names'].append(adata_comp.var_names[top])
+        for field, values in ranked.items():
+            stats_out[field].append(values)
+
+    key_added = key_added if key_added else 'rank_genes_groups'
+    groups_order_save = [str(groups_order[i]) for i in compared]
+    adata.uns[key_added] = {
+        'params': {
+            'groupby': groupby,
+            'reference': reference,
+            'method': method,
+            'use_raw': use_raw,
+            'corr_method': corr_method,
+        },
+    }
+    for field, dtype in (('scores', 'float32'), ('names', 'U50'),
+                         ('logfoldchanges', 'float32'), ('pvals', 'float64'),
+                         ('pvals_adj', 'float64')):
+        adata.uns[key_added][field] = np.rec.fromarrays(
+            stats_out[field], dtype=[(g, dtype) for g in groups_order_save])
+    return adata
+
+
+def _group_labels(groupby_col, groups_order):
+    """Label each cell with the position of its group in `groups_order`,
+    cells of other groups get the extra label len(groups_order)
+    """
+    categories = groupby_col.cat.categories
+    unknown = [g for g in groups_order if g not in set(categories)]
+    if unknown:
+        raise ValueError(
+            f'Groups not found in "{groupby_col.name}": {unknown}')
+    n_groups = len(groups_order)
+    lookup = np.full(len(categories) + 1, n_groups)
+    lookup[categories.get_indexer(groups_order)] = np.arange(n_groups)
+    return lookup[groupby_col.cat.codes.values]
+
+
+def _compare_groups(
+        group_stats, n_group, rest_stats, n_rest, method, corr_method,
+        n_genes, rankby_abs, rank_sum=None,
+):
+    """Test a group against the rest or a reference group for every gene
+
+    Return the indices of the `n_genes` top ranked genes, and their scores,
+    log2 fold changes, p-values and adjusted p-values.
+    """
+    (mean_group, var_group), (mean_rest, var_rest) = group_stats, rest_stats
+    if method == 'wilcoxon':
+        n_total = n_group + n_rest
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = (rank_sum - n_group * (n_total + 1) / 2) / np.sqrt(
+                n_group * n_rest * (n_total + 1) / 12)
+        scores[np.isnan(scores)] = 0
+        pvals = 2 * stats.norm.sf(np.abs(scores))
+    else:
+        if method == 't-test_overestim_var':
+            n_rest = n_group
+        scores, pvals = _welch_t_test(
+            mean_group, var_group, n_group, mean_rest, var_rest, n_rest)
+        scores[np.isnan(scores)] = 0
+    pvals[np.isnan(pvals)] = 1
+
+    if corr_method == 'benjamini-hochberg':
+        pvals_adj = _benjamini_hochberg(pvals)
+    else:
+        pvals_adj = np.minimum(pvals * len(pvals), 1.0)
+
+    foldchanges = (np.expm1(mean_group) + 1e-9) / (np.expm1(mean_rest) + 1e-9)
+
+    scores_sort = np.abs(scores) if rankby_abs else scores
+    partition = np.argpartition(scores_sort, -n_genes)[-n_genes:]
+    top = partition[np.argsort(scores_sort[partition])[::-1]]
+    return top, {
+        'scores': scores[top],
+        'logfoldchanges': np.log2(foldchanges[top]),
+        'pvals': pvals[top],
+        'pvals_adj': pvals_adj[top],
+    }
+
+
+def _group_sums(X, labels, n_labels):
+    """Number of cells, and per-gene sums and sums of squares for each label
+    """
+    n_cells = X.shape[0]
+    indicator = sp.csr_matrix(
+        (np.ones(n_cells), (labels, np.arange(n_cells))),
+        shape=(n_labels, n_cells),
+    )
+    if sp.issparse(X):
+        sums = (indicator @ X).toarray()
+        sumsq = (indicator @ X.multiply(X)).toarray()
+    else:
+        X = np.asarray(X)
+        sums = indicator @ X
+        sumsq = indicator @ np.square(X, dtype=np.float64)
+    return (np.bincount(labels, minlength=n_labels),
+            sums.astype(np.float64), sumsq.astype(np.float64))
+
+
+def _mean_var(sums, sumsq, n):
+    """Mean and unbiased variance from sums and sums of squares of `n` cells
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums / n
+        var = (sumsq / n - mean ** 2) * (n / (n - 1))
+    return mean, var
+
+
+def _welch_t_test(mean1, var1, n1, mean2, var2, n2):
+    """Welch's t-test from summary statistics, as
+    scipy.stats.ttest_ind_from_stats(..., equal_var=False)
+    """
+    vn1 = var1 / n1
+    vn2 = var2 / n2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df = (vn1 + vn2) ** 2 / (vn1 ** 2 / (n1 - 1) + vn2 ** 2 / (n2 - 1))
+        df = np.where(np.isnan(df), 1, df)
+        t = (mean1 - mean2) / np.sqrt(vn1 + vn2)
+    return t, 2 * stats.t.sf(np.abs(t), df)
+
+
+def _benjamini_hochberg(pvals):
+    """Benjamini-Hochberg adjusted p-values, as statsmodels'
+    multipletests(..., method='fdr_bh')
+    """
+    n = len(pvals)
+    order = np.argsort(pvals)
+    adjusted = pvals[order] * n / np.arange(1, n + 1)
+    adjusted = np.minimum.accumulate(adjusted[::-1])[::-1]
+    pvals_adj = np.empty_like(adjusted)
+    pvals_adj[order] = np.minimum(adjusted, 1)
+    return pvals_adj
+
+
+def _rank_sums(X, labels, n_labels, n_jobs):
+    """Per-gene sums of the ranks of the cells of each label, ranking among
+    all cells of `X` by gene blocks over `n_jobs` threads
+    """
+    n_vars = X.shape[1]
+    block_size = max(1, min(_GENE_BLOCK_SIZE, -(-n_vars // (4 * n_jobs))))
+    starts = range(0, n_vars, block_size)
+    n_per_label = np.bincount(labels, minlength=n_labels)
+
+    def rank_block(start):
+        stop = min(start + block_size, n_vars)
+        if sp.issparse(X):
+            block = X[:, start:stop]
+        else:
+            block = sp.csc_matrix(np.asarray(X[:, start:stop]))
+        return _block_rank_sums(block, labels, n_labels, n_per_label)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return np.hstack(list(executor.map(rank_block, starts)))
+
+
+def _pairwise_u_statistics(X, labels, n_labels, n_jobs):
+    """Mann-Whitney U statistics of every label against every other label
+    for each gene, by gene blocks over `n_jobs` threads
+
+    Element [g, a, b] counts the pairs of cells of labels a and b in which
+    the value of gene g is greater in the cell of label a, ties counting one
+    half.
+    """
+    n_vars = X.shape[1]
+    block_size = max(1, min(_GENE_BLOCK_SIZE, -(-n_vars // (4 * n_jobs))))
+    n_per_label = np.bincount(labels, minlength=n_labels)
+
+    def u_block(start):
+        stop = min(start + block_size, n_vars)
+        if sp.issparse(X):
+            block = X[:, start:stop]
+        else:
+            block = sp.csc_matrix(np.asarray(X[:, start:stop]))
+        return np.stack([
+            _gene_u_statistics(
+                block.data[block.indptr[k]:block.indptr[k + 1]],
+                labels[block.indices[block.indptr[k]:block.indptr[k + 1]]],
+                n_per_label,
+            ) for k in range(stop - start)])
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return np.concatenate(
+            list(executor.map(u_block, range(0, n_vars, block_size))))
+
+
+def _gene_u_statistics(values, labels, n_per_label):
+    """Pairwise U statistics of one gene from its nonzero values and their
+    labels, counting values of each label per run of ties in sorted order
+    """
+    n_labels = len(n_per_label)
+    order = np.argsort(values, kind='mergesort')
+    values, labels = values[order], labels[order]
+    new_run = np.ones(len(values), dtype=bool)
+    new_run[1:] = values[1:] != values[:-1]
+    run = np.cumsum(new_run) - 1
+    # Leave a run for the zeros, after the negative values
+    n_neg_runs = np.count_nonzero(new_run & (values < 0))
+    run[run >= n_neg_runs] += 1
+    n_runs = np.count_nonzero(new_run) + 1
+
+    counts = np.bincount(
+        run * n_labels + labels, minlength=n_runs * n_labels,
+    ).reshape(n_runs, n_labels).astype(np.float64)
+    counts[n_neg_runs] = n_per_label - counts.sum(axis=0)
+    below = np.cumsum(counts, axis=0) - counts
+    return sp.csr_matrix(counts).T @ (below + counts / 2)
+
+
+def _block_rank_sums(block, labels, n_labels, n_per_label):
+    """Rank sums for the genes of a CSC block without explicit zeros
+
+    Nonzero values are sorted per gene, zeros are counted rather than
+    expanded, and each run of ties gets its average rank.
+    """
+    n_cells, n_block = block.shape
+    nnz = np.diff(block.indptr)
+    gene = np.repeat(np.arange(n_block), nnz)
+    order = np.lexsort((block.data, gene))
+    data, gene, rows = block.data[order], gene[order], block.indices[order]
 
+    # Ranks of the nonzero values among the nonzero values of their gene,
+    # then shifted past the zeros if positive
+    position = np.arange(len(data)) - np.repeat(block.indptr[:-1], nnz)
+    new_run = np.ones(len(data), dtype=bool)
+    new_run[1:] = (data[1:] != data[:-1]) | (gene[1:] != gene[:-1])
+    run_start = np.flatnonzero(new_run)
+    run_last = np.append(run_start[1:], len(data)) - 1
+    ranks = ((position[run_start] + position[run_last]) / 2 + 1)[
+        np.cumsum(new_run) - 1]
+    n_zero = n_cells - nnz
+    ranks += np.where(data > 0, n_zero[gene], 0)
+    n_neg = np.bincount(gene[data < 0], minlength=n_block)
+    zero_rank = n_neg + (n_zero + 1) / 2
 
-def _recarray_to_dataframe(array, field_name):
-    return pd.DataFrame(array).reset_index().rename(
-        columns={'index': 'rank'}).melt(
-            id_vars='rank', var_name='cluster', value_name=field_name)
+    flat = labels[rows] * n_block + gene
+    rank_sums = np.bincount(
+        flat, weights=ranks, minlength=n_labels * n_block,
+    ).reshape(n_labels, n_block)
+    nnz_per_label = np.bincount(
+        flat, minlength=n_labels * n_block).reshape(n_labels, n_block)
+    rank_sums += (n_per_label[:, None] - nnz_per_label) * zero_rank[None, :]
+    return rank_sums
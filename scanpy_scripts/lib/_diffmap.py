@@ -3,6 +3,7 @@ scanpy diffmap
 """
 
 import scanpy as sc
+from ..dtype_utils import enforce_dtype
 from ..obj_utils import (
     _set_default_key,
     _restore_default_key,
@@ -27,6 +28,7 @@ def diffmap(
     _backup_obsm_key(adata, 'X_diffmap')
 
     sc.tl.diffmap(adata, **kwargs)
+    enforce_dtype(adata)
 
     _restore_default_key(adata.uns, 'neighbors', use_graph)
 
@@ -3,6 +3,7 @@ scanpy fdg
 """
 
 import scanpy as sc
+from ..dtype_utils import enforce_dtype
 from ..obj_utils import (
     _backup_obsm_key,
     _delete_obsm_backup_key,
@@ -39,6 +40,7 @@ def fdg(
         adjacency=adj_mat,
         **kwargs,
     )
+    enforce_dtype(adata)
 
     fdg_key = f'X_draw_graph_{layout}'
     if key_added:
@@ -7,6 +7,7 @@ import re
 import click
 import numpy as np
 import scanpy as sc
+from ..zarr_utils import is_lazy_matrix, iter_row_chunks, load_lazy_matrix
 
 
 def filter_anndata(
@@ -66,8 +67,13 @@ def filter_anndata(
             logging.warning('`pct_counts_%s` exists, not overwriting '
                             'without --force-recalc', pt)
             pct_top.remove(pt)
-    sc.pp.calculate_qc_metrics(
-        adata, layer=layer, qc_vars=qc_vars, percent_top=pct_top, inplace=True)
+    if layer is None and is_lazy_matrix(adata.X):
+        _calculate_qc_metrics_chunked(adata, qc_vars=qc_vars, percent_top=pct_top)
+    else:
+        load_lazy_matrix(adata)
+        sc.pp.calculate_qc_metrics(
+            adata, layer=layer, qc_vars=qc_vars, percent_top=pct_top,
+            inplace=True)
     adata.obs['n_counts'] = adata.obs['total_counts']
     adata.obs['n_genes'] = adata.obs['n_genes_by_counts']
     adata.var['n_counts'] = adata.var['total_counts']
@@ -103,12 +109,66 @@ def filter_anndata(
         else:
             k_gene = k_gene & attr.isin(values)
 
+    # subsetting goes through anndata, which needs `.X` in memory
+    load_lazy_matrix(adata)
     adata._inplace_subset_obs(k_cell)
     adata._inplace_subset_var(k_gene)
 
     return adata
 
 
+def _calculate_qc_metrics_chunked(adata, qc_vars=(), percent_top=()):
+    """
+    Same metrics as sc.pp.calculate_qc_metrics(), accumulated over row chunks
+    of a lazily loaded `.X` without loading it. The matrix is still loaded
+    afterwards to subset the object.
+    """
+    n_obs, n_var = adata.shape
+    qc_masks = {qv: adata.var[qv].values.astype(bool) for qv in qc_vars}
+    percent_top = [n for n in percent_top if n <= n_var]
+    n_top = max(percent_top) if percent_top else 0
+
+    obs_n_genes = np.zeros(n_obs, dtype=np.int64)
+    obs_total = np.zeros(n_obs)
+    obs_top = np.zeros((n_obs, len(percent_top)))
+    obs_qv = {qv: np.zeros(n_obs) for qv in qc_vars}
+    var_n_cells = np.zeros(n_var, dtype=np.int64)
+    var_total = np.zeros(n_var)
+
+    for chunk, start, end in iter_row_chunks(adata.X):
+        is_expressed = chunk > 0
+        obs_n_genes[start:end] = is_expressed.sum(axis=1)
+        obs_total[start:end] = chunk.sum(axis=1)
+        var_n_cells += is_expressed.sum(axis=0)
+        var_total += chunk.sum(axis=0)
+        for qv, mask in qc_masks.items():
+            obs_qv[qv][start:end] = chunk[:, mask].sum(axis=1)
+        if n_top:
+            top = -np.partition(-chunk, n_top - 1, axis=1)[:, :n_top]
+            top = np.cumsum(-np.sort(-top, axis=1), axis=1)
+            obs_top[start:end] = top[:, np.array(percent_top) - 1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        adata.obs['n_genes_by_counts'] = obs_n_genes
+        adata.obs['log1p_n_genes_by_counts'] = np.log1p(obs_n_genes)
+        adata.obs['total_counts'] = obs_total
+        adata.obs['log1p_total_counts'] = np.log1p(obs_total)
+        for i, n in enumerate(percent_top):
+            adata.obs[f'pct_counts_in_top_{n}_genes'] = (
+                obs_top[:, i] / obs_total * 100)
+        for qv in qc_vars:
+            adata.obs[f'total_counts_{qv}'] = obs_qv[qv]
+            adata.obs[f'log1p_total_counts_{qv}'] = np.log1p(obs_qv[qv])
+            adata.obs[f'pct_counts_{qv}'] = obs_qv[qv] / obs_total * 100
+
+    adata.var['n_cells_by_counts'] = var_n_cells
+    adata.var['mean_counts'] = var_total / n_obs
+    adata.var['log1p_mean_counts'] = np.log1p(var_total / n_obs)
+    adata.var['pct_dropout_by_counts'] = (1 - var_n_cells / n_obs) * 100
+    adata.var['total_counts'] = var_total
+    adata.var['log1p_total_counts'] = np.log1p(var_total)
+
+
 def _get_attributes(adata):
     attributes = {
         'c': {
@@ -3,6 +3,7 @@ scanpy neighbors
 """
 
 import scanpy as sc
+from ..dtype_utils import enforce_dtype
 from ..obj_utils import (
     _backup_default_key,
     _delete_backup_key,
@@ -18,6 +19,7 @@ def neighbors(adata, n_neighbors=15, key_added=None, **kwargs):
         _backup_default_key(adata.uns, 'neighbors')
 
         sc.pp.neighbors(adata, n_neighbors=n_neighbors, **kwargs)
+        enforce_dtype(adata)
 
         if key_added:
             nb_key = f'neighbors_{key_added}'
@@ -3,6 +3,7 @@ scanpy norm
 """
 
 import scanpy as sc
+from ..dtype_utils import enforce_dtype
 
 
 def normalize(adata, save_raw='yes', log_transform=True, **kwargs):
@@ -15,6 +16,7 @@ def normalize(adata, save_raw='yes', log_transform=True, **kwargs):
     sc.pp.normalize_total(adata, **kwargs)
     if log_transform:
         sc.pp.log1p(adata)
+    enforce_dtype(adata)
     if save_raw == 'yes':
         adata.raw = adata
 
@@ -4,6 +4,7 @@ scanpy paga
 
 import numpy as np
 import scanpy as sc
+from ..dtype_utils import enforce_dtype
 from ..obj_utils import (
     _backup_default_key,
     _delete_backup_key,
@@ -26,6 +27,7 @@ def paga(
     _backup_default_key(adata.uns, 'paga')
 
     sc.tl.paga(adata, **kwargs)
+    enforce_dtype(adata)
 
     _restore_default_key(adata.uns, 'neighbors', use_graph)
 
@@ -3,8 +3,11 @@ scanpy pca
 """
 
 import logging
+import numpy as np
 import scanpy as sc
+from ..dtype_utils import enforce_dtype
 from ..obj_utils import write_embedding
+from ..zarr_utils import is_lazy_matrix, iter_row_chunks, load_lazy_matrix
 
 def pca(adata, key_added=None, export_embedding=None, **kwargs):
     """
@@ -24,10 +27,18 @@ def pca(adata, key_added=None, export_embedding=None, **kwargs):
     if 'svd_solver' in kwargs and kwargs['svd_solver'] == 'auto':
         del kwargs['svd_solver']
 
+    # a lazily loaded `.X` is streamed over when chunked, loaded otherwise
+    pca_func = sc.pp.pca
+    if is_lazy_matrix(adata.X):
+        if kwargs.get('chunked', False):
+            pca_func = _pca_lazy
+        else:
+            load_lazy_matrix(adata)
+
     if key_added:
         if 'X_pca' in adata.obsm.keys():
             adata.obsm['X_pca_bkup'] = adata.obsm['X_pca']
-        sc.pp.pca(adata, **kwargs)
+        pca_func(adata, **kwargs)
         pca_key = f'X_pca_{key_added}'
         adata.obsm[pca_key] = adata.obsm['X_pca']
         del adata.obsm['X_pca']
@@ -35,9 +46,81 @@ def pca(adata, key_added=None, export_embedding=None, **kwargs):
             adata.obsm['X_pca'] = adata.obsm['X_pca_bkup']
             del adata.obsm['X_pca_bkup']
     else:
-        sc.pp.pca(adata, **kwargs)
+        pca_func(adata, **kwargs)
         pca_key = 'X_pca'
+    enforce_dtype(adata)
 
     if export_embedding is not None:
         write_embedding(adata, pca_key, export_embedding, key_added=key_added)
     return adata
+
+
+def _pca_lazy(
+        adata,
+        n_comps=50,
+        zero_center=True,
+        svd_solver=None,
+        random_state=None,
+        use_highly_variable=True,
+        chunked=True,
+        chunk_size=None,
+        **kwargs,
+):
+    """
+    Incremental PCA as sc.pp.pca(chunked=True) does, reading row chunks of a
+    lazily loaded `.X` directly instead of going through an AnnData view
+
+    Incremental PCA always zero centers and has no solver to choose, so
+    options asking otherwise are refused rather than ignored. It is also
+    deterministic, so `random_state` has no effect.
+    """
+    from sklearn.decomposition import IncrementalPCA
+
+    if not zero_center:
+        raise ValueError(
+            'chunked PCA always zero centers, zero_center=False is not '
+            'supported')
+    if svd_solver is not None:
+        raise ValueError(
+            f'chunked PCA has no SVD solver to choose, svd_solver={svd_solver} '
+            'is not supported')
+    if kwargs:
+        raise ValueError(
+            'chunked PCA of a lazily loaded .X does not support '
+            f'{", ".join(sorted(kwargs))}')
+
+    if n_comps is None:
+        n_comps = 50
+    k_var = slice(None)
+    if use_highly_variable and 'highly_variable' in adata.var.keys():
+        k_var = adata.var['highly_variable'].values.astype(bool)
+    else:
+        use_highly_variable = False
+
+    pca_ = IncrementalPCA(n_components=n_comps)
+    # sklearn refuses to fit fewer rows than components at a time, so short
+    # chunks, such as the last one, are fitted along with their neighbours
+    batch = []
+    for chunk, _, end in iter_row_chunks(adata.X, chunk_size=chunk_size):
+        batch.append(chunk[:, k_var])
+        n_rows = sum(part.shape[0] for part in batch)
+        if end == adata.n_obs or (
+                n_rows >= n_comps and adata.n_obs - end >= n_comps):
+            pca_.partial_fit(np.vstack(batch))
+            batch = []
+
+    X_pca = np.zeros((adata.n_obs, n_comps), dtype=adata.X.dtype)
+    for chunk, start, end in iter_row_chunks(adata.X, chunk_size=chunk_size):
+        X_pca[start:end] = pca_.transform(chunk[:, k_var])
+
+    adata.obsm['X_pca'] = X_pca
+    if use_highly_variable:
+        adata.varm['PCs'] = np.zeros(shape=(adata.n_vars, n_comps))
+        adata.varm['PCs'][k_var] = pca_.components_.T
+    else:
+        adata.varm['PCs'] = pca_.components_.T
+    adata.uns['pca'] = {
+        'variance': pca_.explained_variance_,
+        'variance_ratio': pca_.explained_variance_ratio_,
+    }
+    return adata
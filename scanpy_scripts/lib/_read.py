@@ -2,44 +2,141 @@
 Provides read_10x()
 """
 
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import anndata
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 import scanpy as sc
+from ..mtx_utils import read_10x_mtx
+from ..thread_utils import (
+    default_n_threads,
+    set_thread_budget,
+    worker_thread_budget,
+)
+from ._annotate import annotate
 
 
 def read_10x(
         input_10x_h5,
         input_10x_mtx,
+        input_manifest=None,
         genome='hg19',
         var_names='gene_symbols',
         extra_obs=None,
-        extra_var=None
+        extra_obs_columns=None,
+        extra_var=None,
+        extra_var_columns=None,
+        mtx_cache_dir=None,
+        n_jobs=None,
 ):
     """
-    Wrapper function for sc.read_10x_h5() and sc.read_10x_mtx(), mainly to
-    support adding extra metadata
+    Wrapper function for sc.read_10x_h5() and read_10x_mtx(), mainly to
+    support adding extra metadata and reading multiple samples
     """
     if input_10x_h5 is not None:
         adata = sc.read_10x_h5(input_10x_h5, genome=genome)
     elif input_10x_mtx is not None:
-        adata = sc.read_10x_mtx(input_10x_mtx, var_names=var_names)
-
-    if extra_obs:
-        obs_tbl = pd.read_csv(extra_obs, sep='\t', header=0, index_col=0)
-        adata.obs = adata.obs.merge(
-            obs_tbl,
-            how='left',
-            left_index=True,
-            right_index=True,
-            suffixes=(False, False),
-        )
-
-    if extra_var:
-        var_tbl = pd.read_csv(extra_var, sep='\t', header=0, index_col=0)
-        adata.var = adata.var.merge(
-            var_tbl,
-            how='left',
-            left_index=True,
-            right_index=True,
-            suffixes=(False, False),
-        )
-    return adata
+        adata = read_10x_mtx(
+            input_10x_mtx, var_names=var_names, cache_dir=mtx_cache_dir,
+            n_threads=n_jobs)
+    elif input_manifest is not None:
+        adata = read_10x_manifest(
+            input_manifest, genome=genome, var_names=var_names,
+            mtx_cache_dir=mtx_cache_dir, n_jobs=n_jobs)
+
+    return annotate(
+        adata,
+        extra_obs=extra_obs,
+        extra_obs_columns=extra_obs_columns,
+        extra_var=extra_var,
+        extra_var_columns=extra_var_columns,
+    )
+
+
+def read_10x_manifest(
+        manifest,
+        genome='hg19',
+        var_names='gene_symbols',
+        mtx_cache_dir=None,
+        n_jobs=None,
+):
+    """
+    Read the 10x samples listed in a manifest in a process pool and concatenate
+    them into a single AnnData object
+    """
+    samples = pd.read_csv(
+        manifest, sep='\t', header=None, names=['sample', 'path'],
+        comment='#', dtype=str)
+    if samples['sample'].duplicated().any():
+        raise ValueError(f'Duplicated sample labels in {manifest}')
+    manifest_dir = os.path.dirname(os.path.abspath(manifest))
+    paths = [os.path.join(manifest_dir, path) for path in samples['path']]
+
+    n_jobs = min(default_n_threads(n_jobs), len(paths))
+    logging.debug('reading %d samples with %s processes', len(paths), n_jobs)
+    # share the thread budget among worker processes
+    with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=set_thread_budget,
+            initargs=(worker_thread_budget(n_jobs),),
+    ) as pool:
+        results = list(pool.map(
+            _read_10x_sample, paths, repeat(genome), repeat(var_names),
+            repeat(mtx_cache_dir)))
+
+    var = results[0][2]
+    for (_, _, sample_var), sample in zip(results[1:], samples['sample'][1:]):
+        if not sample_var.index.equals(var.index):
+            raise ValueError(f'Genes of sample "{sample}" differ from those of '
+                             f'sample "{samples["sample"][0]}"')
+
+    obs_names = np.concatenate([
+        pd.Index(barcodes).astype(str) + f'-{sample}'
+        for (_, barcodes, _), sample in zip(results, samples['sample'])])
+    obs = pd.DataFrame(
+        {'sample': pd.Categorical(
+            np.repeat(samples['sample'].values, [x.shape[0] for x, _, _ in results]),
+            categories=samples['sample'].values)},
+        index=obs_names)
+    X = _concatenate_csr([x for x, _, _ in results])
+    return anndata.AnnData(X=X, obs=obs, var=var)
+
+
+def _read_10x_sample(path, genome, var_names, mtx_cache_dir):
+    if os.path.isdir(path):
+        # samples are already read in parallel, parse each one in one thread
+        adata = read_10x_mtx(
+            path, var_names=var_names, cache_dir=mtx_cache_dir, n_threads=1)
+    else:
+        adata = sc.read_10x_h5(path, genome=genome)
+    return sp.csr_matrix(adata.X), adata.obs_names.values, adata.var
+
+
+def _concatenate_csr(mats):
+    """
+    Stack CSR matrices vertically into buffers allocated once, instead of
+    copying the growing matrix for every sample
+    """
+    n_obs = sum(mat.shape[0] for mat in mats)
+    nnz = sum(mat.nnz for mat in mats)
+    index_dtype = np.int32 if nnz < np.iinfo(np.int32).max else np.int64
+    indptr = np.empty(n_obs + 1, dtype=index_dtype)
+    indices = np.empty(nnz, dtype=index_dtype)
+    data = np.empty(nnz, dtype=np.result_type(*[mat.dtype for mat in mats]))
+
+    indptr[0] = 0
+    row, offset = 0, 0
+    for mat in mats:
+        n_row, n_nz = mat.shape[0], mat.nnz
+        indptr[row + 1:row + n_row + 1] = mat.indptr[1:]
+        indptr[row + 1:row + n_row + 1] += offset
+        indices[offset:offset + n_nz] = mat.indices
+        data[offset:offset + n_nz] = mat.data
+        row += n_row
+        offset += n_nz
+    return sp.csr_matrix(
+        (data, indices, indptr), shape=(n_obs, mats[0].shape[1]), copy=False)
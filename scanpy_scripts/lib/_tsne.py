@@ -3,6 +3,7 @@ scanpy tsne
 """
 
 import scanpy as sc
+from ..dtype_utils import enforce_dtype
 from ..obj_utils import (
     _backup_obsm_key,
     _rename_obsm_key,
@@ -25,6 +26,7 @@ def tsne(
         _backup_obsm_key(adata, 'X_tsne')
 
         sc.tl.tsne(adata, random_state=random_state, **kwargs)
+        enforce_dtype(adata)
 
         tsne_key = 'X_tsne'
         if key_added:
@@ -36,6 +38,7 @@ def tsne(
         if export_embedding is not None:
             write_embedding(adata, tsne_key, export_embedding, key_added=key_added)
     else:
+        embed_keys = []
         for i, rseed in enumerate(random_state):
             if key_added is None:
                 tsne_key = f'r{rseed}'
@@ -53,4 +56,8 @@ def tsne(
                 random_state=rseed,
                 **kwargs,
             )
+            embed_keys.append(f'X_tsne_{tsne_key}')
+
+        if export_embedding is not None:
+            write_embedding(adata, embed_keys, export_embedding)
     return adata
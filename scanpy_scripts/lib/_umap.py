@@ -3,6 +3,7 @@ scanpy umap
 """
 
 import scanpy as sc
+from ..dtype_utils import enforce_dtype
 from ..obj_utils import (
     _set_default_key,
     _restore_default_key,
@@ -28,6 +29,7 @@ def umap(
         _backup_obsm_key(adata, 'X_umap')
 
         sc.tl.umap(adata, random_state=random_state, **kwargs)
+        enforce_dtype(adata)
 
         umap_key = 'X_umap'
         if key_added:
@@ -39,6 +41,7 @@ def umap(
         if export_embedding is not None:
             write_embedding(adata, umap_key, export_embedding, key_added=key_added)
     else:
+        embed_keys = []
         for i, rseed in enumerate(random_state):
             if key_added is None:
                 umap_key = f'r{rseed}'
@@ -56,5 +59,9 @@ def umap(
                 random_state=rseed,
                 **kwargs,
             )
+            embed_keys.append(f'X_umap_{umap_key}')
+
+        if export_embedding is not None:
+            write_embedding(adata, embed_keys, export_embedding)
     _restore_default_key(adata.uns, 'neighbors', use_graph)
     return adata
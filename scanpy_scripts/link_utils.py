@@ -0,0 +1,116 @@
+"""link_utils
+
+Store matrices that an object holds more than once only once in HDF5 files.
+
+`normalize()` keeps `.raw` as a snapshot of the object, so `.raw.X` is often
+the same matrix as `.X` or as a `counts` layer. Before writing, matrices are
+compared by identity, then by a checksum of their content, and duplicates
+are left out or swapped for empty placeholders. Once written, each duplicate
+location is made an HDF5 hard link to the first copy, so that readers still
+find every matrix where they expect it.
+"""
+
+import hashlib
+import logging
+import h5py
+import numpy as np
+import scipy.sparse as sp
+
+
+def duplicated_matrices(matrices):
+    """Find matrices identical to an earlier one
+
+    * Parameters
+        + matrices : list
+        (path, matrix) pairs of dense arrays or sparse matrices, in the order
+        they are stored
+
+    * Returns
+        + duplicates : dict
+        Paths of duplicates mapped to the paths of their first copies
+    """
+    checksums = {}
+
+    def checksum(path, mat):
+        if path not in checksums:
+            checksums[path] = _checksum(mat)
+        return checksums[path]
+
+    firsts = []
+    duplicates = {}
+    for path, mat in matrices:
+        for first_path, first in firsts:
+            if mat is first or (
+                    _same_layout(mat, first) and
+                    checksum(path, mat) == checksum(first_path, first)):
+                duplicates[path] = first_path
+                break
+        else:
+            firsts.append((path, mat))
+    return duplicates
+
+
+def link_duplicates(root, duplicates):
+    """Make each duplicate path under `root` a hard link to its first copy,
+    replacing whatever was written there
+    """
+    for path, first_path in duplicates.items():
+        if path in root:
+            del root[path]
+        root[path] = root[first_path]
+        logging.info('Stored %s as a link to %s', path, first_path)
+
+
+def write_h5ad(adata, filename, **kwargs):
+    """Write `adata` as h5ad with `.raw.X` and layers identical to `.X` or to
+    one another stored once
+
+    Keyword arguments are passed to `AnnData.write`.
+    """
+    matrices = [('X', adata.X)]
+    if adata.raw is not None:
+        matrices.append(('raw.X', adata.raw.X))
+    matrices.extend(
+        (f'layers/{key}', adata.layers[key]) for key in adata.layers.keys())
+    duplicates = duplicated_matrices(matrices)
+
+    raw_X = None
+    layers = {}
+    try:
+        for path in duplicates:
+            if path == 'raw.X':
+                # `.raw` cannot go without its matrix, keep a small one
+                raw_X = adata.raw._X
+                adata.raw._X = sp.csr_matrix(raw_X.shape, dtype=raw_X.dtype)
+            else:
+                key = path[len('layers/'):]
+                layers[key] = adata.layers[key]
+                del adata.layers[key]
+        adata.write(filename, **kwargs)
+    finally:
+        if raw_X is not None:
+            adata.raw._X = raw_X
+        for key, layer in layers.items():
+            adata.layers[key] = layer
+
+    if duplicates:
+        with h5py.File(filename, mode='r+') as fh:
+            link_duplicates(fh, duplicates)
+
+
+def _same_layout(a, b):
+    if sp.issparse(a) and sp.issparse(b):
+        return (a.format in ('csr', 'csc') and a.format == b.format and
+                a.shape == b.shape and a.dtype == b.dtype and a.nnz == b.nnz)
+    if isinstance(a, np.ndarray) and isinstance(b, np.ndarray):
+        return a.shape == b.shape and a.dtype == b.dtype
+    return False
+
+
+def _checksum(mat):
+    digest = hashlib.blake2b(digest_size=20)
+    arrays = [mat.data, mat.indices, mat.indptr] if sp.issparse(mat) else [mat]
+    for arr in arrays:
+        digest.update(str(arr.dtype).encode())
+        digest.update(np.ascontiguousarray(arr).view(np.uint8).ravel())
+    return digest.digest()
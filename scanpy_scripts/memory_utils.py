@@ -0,0 +1,111 @@
+"""memory_utils
+
+Keep sub-commands within a memory budget set by `scanpy-cli --max-memory`.
+
+Each wrapper has a cost model in `cost_utils` estimating the memory it
+needs on top of the input object, from the shape, density and dtype of the
+matrix. Once the input is read, the estimate of the command is checked
+against what the budget leaves. Models of commands with a chunked or
+streaming code path switch to it when the default one would not fit, and a
+command that cannot fit stops with an explanation before it starts rather
+than being killed halfway through.
+"""
+
+import logging
+import re
+from collections import namedtuple
+
+import click
+
+# Shape and density of the matrix, and number of edges of the graph used
+ObjectStats = namedtuple(
+    'ObjectStats', ['n_obs', 'n_vars', 'nnz', 'itemsize', 'n_edges', 'lazy'])
+
+_SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(text):
+    """Parse a size such as '512M', '16G' or '1.5T' into bytes
+    """
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?)i?B?\s*', str(text).upper())
+    if match is None:
+        raise ValueError(f'{text} is not a valid size, e.g. 16G')
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2)])
+
+
+def format_size(n_bytes):
+    """Format bytes with the largest unit giving at least one, e.g. '1.5G'
+    """
+    for unit in ('T', 'G', 'M', 'K'):
+        if n_bytes >= _SIZE_UNITS[unit]:
+            return f'{n_bytes / _SIZE_UNITS[unit]:.1f}{unit}'
+    return f'{int(n_bytes)}B'
+
+
+def object_stats(adata, use_graph='neighbors'):
+    """Return the `ObjectStats` of an object in memory
+    """
+    import scipy.sparse as sp
+    from .zarr_utils import is_lazy_matrix
+
+    n_obs, n_vars = adata.shape
+    X = adata.X
+    nnz = X.nnz if sp.issparse(X) else n_obs * n_vars
+    itemsize = X.dtype.itemsize if hasattr(X, 'dtype') else 4
+    graph = adata.uns.get(use_graph or 'neighbors')
+    n_edges = None
+    if isinstance(graph, dict) and sp.issparse(graph.get('connectivities')):
+        n_edges = graph['connectivities'].nnz
+    return ObjectStats(n_obs, n_vars, nnz, itemsize, n_edges, is_lazy_matrix(X))
+
+
+def object_bytes(adata):
+    """Memory held by the matrices of an object, `.X` unless lazily loaded,
+    `.raw.X`, layers and `.obsm`
+    """
+    import numpy as np
+    import scipy.sparse as sp
+
+    def nbytes(mat):
+        if sp.issparse(mat):
+            return sum(arr.nbytes for arr in (mat.data, mat.indices, mat.indptr)
+                       if arr is not None)
+        return mat.nbytes if isinstance(mat, np.ndarray) else 0
+
+    matrices = [adata.X]
+    if adata.raw is not None:
+        matrices.append(adata.raw.X)
+    matrices.extend(adata.layers[key] for key in adata.layers.keys())
+    matrices.extend(adata.obsm[key] for key in adata.obsm.keys())
+    return sum(nbytes(mat) for mat in matrices)
+
+
+def plan_memory(cmd_name, adata, kwargs, max_memory):
+    """Return the keyword arguments to run `cmd_name` on `adata` within
+    `max_memory` bytes, switching to a chunked or streaming code path if
+    needed, or raise a ClickException if it cannot fit
+
+    Commands without a cost model are run as they are.
+    """
+    from .cost_utils import MEMORY_MODELS
+
+    model = MEMORY_MODELS.get(cmd_name)
+    if model is None:
+        logging.debug('No memory model for %s', cmd_name)
+        return kwargs
+    resident = object_bytes(adata)
+    available = max_memory - resident
+    stats = object_stats(adata, kwargs.get('use_graph'))
+    needed, changes = model(stats, budget=available, **kwargs)
+    logging.info('%s is estimated to need %s on top of the %s of its input',
+                 cmd_name, format_size(needed), format_size(resident))
+    if needed > available:
+        raise click.ClickException(
+            f'{cmd_name} is estimated to need {format_size(needed)} on top of '
+            f'the {format_size(resident)} of its input, beyond --max-memory '
+            f'{format_size(max_memory)}, and has no code path within it for '
+            'these options.')
+    for key, value in changes.items():
+        logging.warning('Setting %s=%s to stay within --max-memory %s',
+                        key, value, format_size(max_memory))
+    return dict(kwargs, **changes)
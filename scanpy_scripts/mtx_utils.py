@@ -0,0 +1,204 @@
+"""mtx_utils
+
+Read 10x-Genomics mtx folders without going through scipy.io.mmread.
+
+The MatrixMarket body is memory-mapped (or decompressed once if gzipped), cut
+into blocks at line boundaries and the blocks are parsed concurrently by the C
+tokenizer of pandas into row, column and value arrays. The CSR matrix of the
+transposed (cells by genes) matrix is then built directly from them, without
+an intermediate COO matrix.
+
+Parsed folders can be cached as h5ad files named after a hash of the input
+files, so that reading the same folder again only reads the cache.
+"""
+
+import gzip
+import hashlib
+import io
+import logging
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+import anndata
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from .thread_utils import default_n_threads
+
+
+_BLOCKS_PER_THREAD = 4
+
+_HASH_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def read_mtx(filename, n_threads=None):
+    """Read a MatrixMarket coordinate file, optionally gzipped, and return the
+    CSR matrix of its transpose
+
+    * Parameters
+        + filename : str
+        Path of the input `.mtx` or `.mtx.gz` file
+        + n_threads : int
+        Number of threads parsing blocks concurrently, the --threads budget or
+        all available CPUs when None
+
+    * Returns
+        + mat : scipy.sparse.csr_matrix
+        Transposed matrix in float32
+    """
+    n_threads = default_n_threads(n_threads)
+    if filename.endswith('.gz'):
+        with gzip.open(filename, 'rb') as fh:
+            return _parse_mtx(fh.read(), n_threads)
+    with open(filename, 'rb') as fh, \
+            mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        return _parse_mtx(buf, n_threads)
+
+
+def _parse_mtx(buf, n_threads):
+    eol = buf.find(b'\n')
+    banner = bytes(buf[:eol]).decode().lower().split()
+    if len(banner) < 5 or banner[2] != 'coordinate' or banner[4] != 'general':
+        raise NotImplementedError(
+            'Only general coordinate MatrixMarket is supported: {}'.format(
+                ' '.join(banner)))
+    is_pattern = banner[3] == 'pattern'
+
+    # skip comments, then read the size line
+    pos = eol + 1
+    while buf[pos:pos + 1] in (b'%', b'\n'):
+        pos = buf.find(b'\n', pos) + 1
+    eol = buf.find(b'\n', pos)
+    n_row, n_col, nnz = map(int, bytes(buf[pos:eol]).split())
+    body_start = eol + 1
+
+    # block boundaries moved forward to the next line end
+    n_block = n_threads * _BLOCKS_PER_THREAD
+    bounds = [body_start]
+    for i in range(1, n_block):
+        target = body_start + (len(buf) - body_start) * i // n_block
+        end = buf.find(b'\n', max(target, bounds[-1]))
+        bounds.append(len(buf) if end < 0 else end + 1)
+    bounds.append(len(buf))
+
+    names = ['row', 'col'] if is_pattern else ['row', 'col', 'val']
+    dtype = {'row': np.int64, 'col': np.int64, 'val': np.float32}
+
+    def parse_block(block):
+        start, end = block
+        if end <= start:
+            return pd.DataFrame({name: np.array([], dtype=dtype[name])
+                                 for name in names})
+        return pd.read_csv(
+            io.BytesIO(buf[start:end]), sep=r'\s+', header=None,
+            names=names, dtype=dtype, engine='c')
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        parsed = list(pool.map(parse_block, zip(bounds[:-1], bounds[1:])))
+
+    rows = np.concatenate([df['row'].values for df in parsed]) - 1
+    cols = np.concatenate([df['col'].values for df in parsed]) - 1
+    if is_pattern:
+        vals = np.ones(len(rows), dtype=np.float32)
+    else:
+        vals = np.concatenate([df['val'].values for df in parsed])
+    del parsed
+    if len(vals) != nnz:
+        raise ValueError(f'Expected {nnz} entries, found {len(vals)}')
+
+    # rows of the transposed matrix are the columns of the file, which 10x
+    # writes in sorted order
+    if np.any(cols[1:] < cols[:-1]):
+        order = np.argsort(cols, kind='stable')
+        cols, rows, vals = cols[order], rows[order], vals[order]
+    index_dtype = np.int32 if max(nnz, n_row) < np.iinfo(np.int32).max else np.int64
+    indptr = np.zeros(n_col + 1, dtype=index_dtype)
+    np.cumsum(np.bincount(cols, minlength=n_col), out=indptr[1:])
+    return sp.csr_matrix(
+        (vals, rows.astype(index_dtype), indptr), shape=(n_col, n_row),
+        copy=False)
+
+
+def read_10x_mtx(
+        path,
+        var_names='gene_symbols',
+        make_unique=True,
+        gex_only=True,
+        cache_dir=None,
+        n_threads=None,
+):
+    """Read a 10x-Genomics mtx folder, same as `sc.read_10x_mtx()`
+
+    * Parameters
+        + path : str
+        Folder containing matrix, genes/features and barcodes files
+        + var_names : str
+        'gene_symbols' or 'gene_ids', used as the variables index
+        + make_unique : bool
+        Make the variables index unique by appending '-1', '-2' etc.
+        + gex_only : bool
+        Only keep 'Gene Expression' features of Cell Ranger v3 folders
+        + cache_dir : str
+        When specified, cache the parsed folder as h5ad under this directory,
+        keyed by a hash of the input files and parameters
+        + n_threads : int
+        Number of threads parsing the matrix
+
+    * Returns
+        + adata : AnnData
+        An AnnData object
+    """
+    if var_names not in ('gene_symbols', 'gene_ids'):
+        raise ValueError('`var_names` needs to be \'gene_symbols\' or \'gene_ids\'')
+    legacy = os.path.isfile(os.path.join(path, 'genes.tsv'))
+    if legacy:
+        fnames = ('matrix.mtx', 'genes.tsv', 'barcodes.tsv')
+    else:
+        fnames = ('matrix.mtx.gz', 'features.tsv.gz', 'barcodes.tsv.gz')
+    matrix_fn, genes_fn, barcodes_fn = [os.path.join(path, fn) for fn in fnames]
+
+    cache_fn = None
+    if cache_dir:
+        digest = _hash_files(
+            [matrix_fn, genes_fn, barcodes_fn],
+            salt=f'{var_names},{make_unique},{gex_only}')
+        cache_fn = os.path.join(cache_dir, f'{digest}.h5ad')
+        if os.path.isfile(cache_fn):
+            logging.info('reading %s from cache %s', path, cache_fn)
+            return anndata.read_h5ad(cache_fn)
+
+    X = read_mtx(matrix_fn, n_threads=n_threads)
+    genes = pd.read_csv(genes_fn, header=None, sep='\t')
+    if var_names == 'gene_symbols':
+        index = pd.Index(genes[1].values)
+        if make_unique:
+            index = anndata.utils.make_index_unique(index)
+        var = pd.DataFrame({'gene_ids': genes[0].values}, index=index)
+    else:
+        var = pd.DataFrame({'gene_symbols': genes[1].values}, index=genes[0].values)
+    if not legacy:
+        var['feature_types'] = genes[2].values
+    obs = pd.DataFrame(
+        index=pd.read_csv(barcodes_fn, header=None)[0].values.astype(str))
+    if not legacy and gex_only:
+        k_gex = var['feature_types'].values == 'Gene Expression'
+        if not k_gex.all():
+            X = X[:, k_gex]
+            var = var.loc[k_gex, :]
+    adata = anndata.AnnData(X=X, obs=obs, var=var)
+
+    if cache_fn:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_fn = cache_fn + f'.{os.getpid()}.tmp.h5ad'
+        adata.write(tmp_fn)
+        os.replace(tmp_fn, cache_fn)
+    return adata
+
+
+def _hash_files(fnames, salt=''):
+    digest = hashlib.blake2b(salt.encode(), digest_size=20)
+    for fname in fnames:
+        with open(fname, 'rb') as fh:
+            for block in iter(lambda: fh.read(_HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+    return digest.hexdigest()
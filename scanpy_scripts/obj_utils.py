@@ -2,35 +2,247 @@
 Provide helper functions for constructing sub-commands
 """
 
+import gzip
+import numpy as np
 import scanpy as sc
 import pandas as pd
 
+EXPORT_FORMATS = ('tsv', 'tsv.gz', 'npy', 'parquet', 'feather')
+
+_EXPORT_CHUNK_ROWS = 50000
+
+
 def write_cluster(adata, keys, cluster_fn, sep='\t'):
-    """Export cell clustering as a text table
+    """Export cell clustering as a table, in a format chosen by the extension
+    of `cluster_fn`, one of `EXPORT_FORMATS`
     """
     if not isinstance(keys, (list, tuple)):
         keys = [keys]
     for key in keys:
         if key not in adata.obs.keys():
             raise KeyError(f'{key} is not a valid `.uns` key')
-    adata.obs[keys].reset_index(level=0).rename(columns={'index': 'cells'}).to_csv(
-        cluster_fn, sep=sep, header=True, index=False)
+    fmt = _export_format(cluster_fn)
+    names = ['cells'] + list(keys)
+    if fmt in ('parquet', 'feather'):
+        df = adata.obs[keys].reset_index(level=0)
+        df.columns = names
+        _write_dataframe(df, cluster_fn, fmt)
+    elif fmt == 'npy':
+        columns = [adata.obs_names] + [adata.obs[key] for key in keys]
+        np.save(cluster_fn, np.rec.fromarrays(
+            [_to_str_array(col) for col in columns], names=names))
+    else:
+        columns = [adata.obs_names] + [adata.obs[key] for key in keys]
+        _write_tsv(
+            cluster_fn, [_to_str_array(col) for col in columns],
+            header=names, sep=sep)
 
 
 def write_embedding(adata, key, embed_fn, n_comp=None, sep='\t', key_added=None):
-    """Export cell embeddings as a txt table
+    """Export cell embeddings as a table, in a format chosen by the extension
+    of `embed_fn`, one of `EXPORT_FORMATS`
+
+    `key` can also be a list of `.obsm` keys, e.g. the embeddings of a
+    multi-seed run, which are then written side by side into a single file
+    with a header row. Embeddings are read through views of their first
+    `n_comp` columns and written in row chunks, never copied as a whole.
     """
+    keys = key if isinstance(key, (list, tuple)) else [key]
     if key_added:
-        if embed_fn.endswith('.tsv'):
-            embed_fn = embed_fn[0:-4]
-        embed_fn = f'{embed_fn}_{key_added}.tsv'
-    if key not in adata.obsm.keys():
-        raise KeyError(f'{key} is not a valid `.obsm` key')
-    mat = adata.obsm[key].copy()
-    if n_comp is not None and mat.shape[1] >= n_comp:
-        mat = mat[:, 0:n_comp]
-    pd.DataFrame(mat, index=adata.obs_names).to_csv(
-        embed_fn, sep=sep, header=False, index=True)
+        embed_fn = _add_fname_suffix(embed_fn, key_added)
+    columns, names = [], []
+    for k in keys:
+        if k not in adata.obsm.keys():
+            raise KeyError(f'{k} is not a valid `.obsm` key')
+        mat = adata.obsm[k]
+        if n_comp is not None and mat.shape[1] >= n_comp:
+            mat = mat[:, 0:n_comp]
+        basis = k[2:] if k.startswith('X_') else k
+        columns.extend(mat[:, i] for i in range(mat.shape[1]))
+        names.extend(f'{basis}_{i + 1}' for i in range(mat.shape[1]))
+
+    fmt = _export_format(embed_fn)
+    if fmt == 'npy':
+        _write_npy(embed_fn, columns)
+    elif fmt in ('parquet', 'feather'):
+        _write_arrow(
+            embed_fn, [adata.obs_names.values] + columns, ['cells'] + names, fmt)
+    else:
+        header = ['cells'] + names if len(keys) > 1 else None
+        _write_tsv(
+            embed_fn, [_to_str_array(adata.obs_names)] + columns,
+            header=header, sep=sep)
+
+
+def write_lite(adata, fname, sep='\t'):
+    """Export cell names, `.obs` columns and `.obsm` embeddings side by side
+    as a table, in a format chosen by the extension of `fname`, one of
+    `EXPORT_FORMATS`
+    """
+    columns, names = [adata.obs_names.values], ['cells']
+    for key in adata.obs.columns:
+        columns.append(adata.obs[key])
+        names.append(key)
+    for key in adata.obsm.keys():
+        mat = adata.obsm[key]
+        if getattr(mat, 'ndim', 0) != 2:
+            continue
+        basis = key[2:] if key.startswith('X_') else key
+        columns.extend(mat[:, i] for i in range(mat.shape[1]))
+        names.extend(f'{basis}_{i + 1}' for i in range(mat.shape[1]))
+
+    fmt = _export_format(fname)
+    if fmt in ('parquet', 'feather'):
+        # categorical columns stay categorical, as dictionary-encoded columns
+        df = pd.DataFrame({
+            name: col.values if isinstance(col, pd.Series) else col
+            for name, col in zip(names, columns)})
+        _write_dataframe(df, fname, fmt)
+    elif fmt == 'npy':
+        np.save(fname, np.rec.fromarrays(
+            [_to_str_array(col) if _is_text(col) else np.asarray(col)
+             for col in columns], names=names))
+    else:
+        _write_tsv(fname, columns, header=names, sep=sep)
+
+
+def _is_text(values):
+    dtype = getattr(values, 'dtype', None)
+    return (isinstance(dtype, pd.api.types.CategoricalDtype) or
+            np.asarray(values).dtype.kind in 'OSU')
+
+
+def _export_format(fname):
+    for fmt in EXPORT_FORMATS[1:]:
+        if fname.endswith('.' + fmt):
+            return fmt
+    if fname.endswith('.gz'):
+        return 'tsv.gz'
+    return 'tsv'
+
+
+def _add_fname_suffix(fname, suffix):
+    fmt = _export_format(fname)
+    ext = '.' + fmt
+    if fname.endswith(ext):
+        fname = fname[0:-len(ext)]
+    elif fmt == 'tsv.gz':
+        fname, ext = fname[0:-3], '.gz'
+    return f'{fname}_{suffix}{ext}'
+
+
+def _write_dataframe(df, fname, fmt):
+    if fmt == 'parquet':
+        df.to_parquet(fname, index=False)
+    else:
+        df.to_feather(fname)
+
+
+def _write_npy(fname, columns):
+    """Write equal-length numeric columns as a 2-D .npy array in row chunks
+    """
+    n_row = len(columns[0])
+    out = np.lib.format.open_memmap(
+        fname, mode='w+', dtype=np.result_type(*columns),
+        shape=(n_row, len(columns)))
+    for start in range(0, n_row, _EXPORT_CHUNK_ROWS):
+        end = min(start + _EXPORT_CHUNK_ROWS, n_row)
+        out[start:end] = np.column_stack([col[start:end] for col in columns])
+    out.flush()
+    del out
+
+
+def _write_arrow(fname, columns, names, fmt):
+    """Write equal-length columns as parquet row groups or feather record
+    batches in row chunks
+    """
+    import pyarrow as pa
+
+    def batches():
+        for start in range(0, len(columns[0]), _EXPORT_CHUNK_ROWS):
+            end = start + _EXPORT_CHUNK_ROWS
+            yield pa.RecordBatch.from_arrays(
+                [pa.array(col[start:end]) for col in columns], names=names)
+
+    _write_arrow_batches(fname, batches(), fmt)
+
+
+def _write_arrow_batches(fname, batches, fmt):
+    """Write an iterable of record batches sharing one schema as parquet row
+    groups or feather record batches
+    """
+    import pyarrow as pa
+
+    writer = None
+    try:
+        for batch in batches:
+            if writer is None:
+                if fmt == 'parquet':
+                    import pyarrow.parquet as pq
+                    writer = pq.ParquetWriter(fname, batch.schema)
+                else:
+                    writer = pa.ipc.new_file(fname, batch.schema)
+            if fmt == 'parquet':
+                writer.write_table(pa.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _to_str_array(values):
+    """Format a column as a numpy string array without going through python
+    objects element by element
+    """
+    if isinstance(getattr(values, 'dtype', None), pd.api.types.CategoricalDtype):
+        values = pd.Categorical(values)
+        # code -1 (missing) picks the trailing empty string
+        categories = np.append(np.asarray(values.categories).astype(str), '')
+        return categories[values.codes]
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        # missing values as empty fields, same as pandas
+        formatted = values.astype(str)
+        formatted[np.isnan(values)] = ''
+        return formatted
+    return values.astype(str)
+
+
+def _write_tsv(fname, columns, header=None, sep='\t'):
+    """Write equal-length columns as a delimited text table, gzip-compressed if
+    `fname` ends with '.gz'
+
+    Columns are formatted and joined with vectorised numpy string operations
+    in blocks of `_EXPORT_CHUNK_ROWS` rows.
+    """
+    with _open_tsv(fname, header=header, sep=sep) as fh:
+        _write_tsv_rows(fh, columns, sep=sep)
+
+
+def _open_tsv(fname, header=None, sep='\t'):
+    """Open a delimited text table for writing, gzip-compressed if `fname`
+    ends with '.gz', and write its header
+    """
+    opener = gzip.open if fname.endswith('.gz') else open
+    fh = opener(fname, 'wt')
+    if header:
+        fh.write(sep.join(header) + '\n')
+    return fh
+
+
+def _write_tsv_rows(fh, columns, sep='\t'):
+    """Append equal-length columns as rows to an open delimited text table
+    """
+    n_row = len(columns[0])
+    for start in range(0, n_row, _EXPORT_CHUNK_ROWS):
+        end = min(start + _EXPORT_CHUNK_ROWS, n_row)
+        lines = _to_str_array(columns[0][start:end])
+        for col in columns[1:]:
+            lines = np.char.add(
+                np.char.add(lines, sep), _to_str_array(col[start:end]))
+        fh.write('\n'.join(lines.tolist()))
+        fh.write('\n')
 
 
 # The functions below handles slot key.
@@ -0,0 +1,132 @@
+"""profile_utils
+
+Measure wall time, CPU time and peak resident memory of the steps of a
+sub-command, i.e. reading the input object, running the command and writing
+the output object.
+
+CPU time includes threads and waited-for child processes. Peak RSS is reset
+before each step where the kernel allows it (Linux `/proc/self/clear_refs`),
+otherwise it is the peak of the whole process so far.
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+RUNS_KEY = 'scanpy_scripts_runs'
+
+_RUN_FIELDS = ('run', 'command', 'step', 'started', 'wall_time', 'cpu_time', 'peak_rss')
+
+
+def _to_str(value):
+    # string fields may come back as bytes from h5ad
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _cpu_time():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    """Peak resident set size in bytes"""
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class StepProfiler:
+    """Collect timings of the steps of one sub-command run
+
+    * Parameters
+        + cmd_name : str
+        Name of the sub-command
+        + enabled : bool
+        When False, `step()` does nothing and no records are kept
+    """
+
+    def __init__(self, cmd_name, enabled=True):
+        self.cmd_name = cmd_name
+        self.enabled = enabled
+        self.records = []
+
+    @contextmanager
+    def step(self, name):
+        """Context manager measuring the enclosed block as step `name`
+        """
+        if not self.enabled:
+            yield
+            return
+        started = datetime.now().isoformat(timespec='seconds')
+        _reset_peak_rss()
+        wall0, cpu0 = time.perf_counter(), _cpu_time()
+        try:
+            yield
+        finally:
+            self.records.append({
+                'command': self.cmd_name,
+                'step': name,
+                'started': started,
+                'wall_time': round(time.perf_counter() - wall0, 6),
+                'cpu_time': round(_cpu_time() - cpu0, 6),
+                'peak_rss': _peak_rss(),
+            })
+            logging.debug('%s', self.records[-1])
+
+    def store(self, adata):
+        """Append the steps recorded so far to `adata.uns[RUNS_KEY]`, a record
+        array of one row per step numbered by `run` across a pipeline
+        """
+        if not self.enabled or not self.records:
+            return
+        import numpy as np
+        previous = adata.uns.get(RUNS_KEY, None)
+        rows = []
+        run = 0
+        if previous is not None and len(previous) > 0:
+            rows = [dict(zip(_RUN_FIELDS, row)) for row in
+                    zip(*[np.asarray(previous[field]) for field in _RUN_FIELDS])]
+            run = int(max(row['run'] for row in rows)) + 1
+        rows.extend(dict(record, run=run) for record in self.records)
+        adata.uns[RUNS_KEY] = np.rec.fromarrays(
+            [np.array([row['run'] for row in rows], dtype=np.int64),
+             *[np.array([_to_str(row[field]) for row in rows])
+               for field in ('command', 'step', 'started')],
+             *[np.array([row[field] for row in rows], dtype=np.float64)
+               for field in ('wall_time', 'cpu_time')],
+             np.array([row['peak_rss'] for row in rows], dtype=np.int64)],
+            names=_RUN_FIELDS)
+
+    def emit(self, destination):
+        """Write the recorded steps as JSON lines, appended to file
+        `destination` or to standard error if it is 'stderr'
+        """
+        if not self.enabled or not self.records:
+            return
+        lines = ''.join(json.dumps(record) + '\n' for record in self.records)
+        if destination == 'stderr':
+            sys.stderr.write(lines)
+        else:
+            with open(destination, 'a') as fh:
+                fh.write(lines)
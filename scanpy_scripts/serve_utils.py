@@ -0,0 +1,209 @@
+"""serve_utils
+
+Run sub-commands in a long-running server process.
+
+`scanpy-cli serve` imports scanpy once, then listens on a Unix socket for
+command lines sent by `scanpy-cli --connect SOCKET ...`, runs them one at a
+time through the same click commands, and sends back their output and exit
+status. Objects read or written as h5ad by a command are kept in an in-memory
+LRU cache keyed by path, modification time and size, so that the next command
+reading the same file gets a copy of the object without deserialising it.
+"""
+
+import contextlib
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import traceback
+from collections import OrderedDict
+
+import click
+
+DEFAULT_SOCKET = os.environ.get(
+    'SCANPY_SCRIPTS_SOCKET',
+    os.path.join(os.path.expanduser('~'), '.cache', 'scanpy-scripts',
+                 'serve.sock'),
+)
+
+DEFAULT_MAX_OBJECTS = 4
+
+# Set in the server process only
+object_cache = None
+
+
+class _ServerStop(BaseException):
+    """Raised by signal handlers to stop the server, past the exception
+    handling of click and of the commands
+    """
+
+
+def _stop_server(signum, frame):
+    raise _ServerStop()
+
+
+class ObjectCache:
+    """In-memory LRU cache of AnnData objects keyed by file
+    """
+
+    def __init__(self, max_objects=DEFAULT_MAX_OBJECTS):
+        self.max_objects = max_objects
+        self._objects = OrderedDict()
+
+    @staticmethod
+    def _key(path, input_format):
+        stat = os.stat(path)
+        return (os.path.realpath(path), input_format, stat.st_mtime_ns,
+                stat.st_size)
+
+    def get(self, path, input_format):
+        """Return a copy of the cached object of `path` if it has not changed
+        since, else None
+        """
+        try:
+            key = self._key(path, input_format)
+        except OSError:
+            return None
+        adata = self._objects.get(key)
+        if adata is None:
+            return None
+        self._objects.move_to_end(key)
+        logging.info('Object of %s found in server memory', path)
+        return adata.copy()
+
+    def put(self, path, input_format, adata):
+        """Keep `adata` as the content of `path`, which must not be modified
+        afterwards
+        """
+        key = self._key(path, input_format)
+        for old_key in [k for k in self._objects if k[:2] == key[:2]]:
+            del self._objects[old_key]
+        self._objects[key] = adata
+        while len(self._objects) > self.max_objects:
+            self._objects.popitem(last=False)
+
+
+def run_remote(socket_path, argv):
+    """Run the command line `argv` on the server at `socket_path`, relay its
+    output and return its exit status
+    """
+    request = {'argv': list(argv), 'cwd': os.getcwd()}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            with sock.makefile('rwb') as fh:
+                fh.write(json.dumps(request).encode() + b'\n')
+                fh.flush()
+                reply = fh.readline()
+    except OSError as err:
+        raise click.ClickException(
+            f'Cannot reach the server at {socket_path}: {err}')
+    if not reply:
+        raise click.ClickException(
+            f'The server at {socket_path} closed the connection')
+    reply = json.loads(reply)
+    sys.stdout.write(reply['stdout'])
+    sys.stderr.write(reply['stderr'])
+    return reply['exit_code']
+
+
+def serve(cli, socket_path=DEFAULT_SOCKET, max_objects=DEFAULT_MAX_OBJECTS):
+    """Serve command lines of `cli` on `socket_path` until interrupted
+    """
+    global object_cache
+    import scanpy  # noqa: F401, imported once for all commands
+
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            if sock.connect_ex(socket_path) == 0:
+                raise click.ClickException(
+                    f'A server is already listening on {socket_path}')
+        os.unlink(socket_path)
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+
+    object_cache = ObjectCache(max_objects)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # only the owner may connect, as commands run with the server's rights
+    umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(umask)
+    server.listen()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, _stop_server)
+    logging.info('Serving on %s', socket_path)
+    try:
+        while True:
+            conn, _ = server.accept()
+            # a bad request or a client gone before the reply must not stop
+            # the server
+            try:
+                with conn, conn.makefile('rwb') as fh:
+                    line = fh.readline()
+                    if not line:
+                        continue
+                    reply = _run_request(cli, json.loads(line))
+                    fh.write(json.dumps(reply).encode() + b'\n')
+                    fh.flush()
+            except (OSError, ValueError, KeyError, TypeError) as err:
+                logging.error('Dropped request: %s', err)
+    except _ServerStop:
+        pass
+    finally:
+        logging.info('Server stopped')
+        server.close()
+        os.unlink(socket_path)
+        object_cache = None
+    return 0
+
+
+def _run_request(cli, request):
+    """Run one command line in the client's working directory, capturing its
+    output
+    """
+    import scanpy as sc
+    from .thread_utils import restored_thread_budget
+
+    stdout, stderr = io.StringIO(), io.StringIO()
+    cwd = os.getcwd()
+    # --verbosity and --threads of one command must not carry over to the next
+    verbosity = sc.settings.verbosity
+    logging.info('Running %s', ' '.join(request['argv']))
+    try:
+        os.chdir(request['cwd'])
+        with restored_thread_budget(), \
+                contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(stderr):
+            exit_code = _invoke(cli, request['argv'])
+    except OSError as err:
+        stderr.write(f'Error: {err}\n')
+        exit_code = 1
+    finally:
+        os.chdir(cwd)
+        sc.settings.verbosity = verbosity
+    return {
+        'stdout': stdout.getvalue(),
+        'stderr': stderr.getvalue(),
+        'exit_code': exit_code,
+    }
+
+
+def _invoke(cli, argv):
+    try:
+        rv = cli.main(args=argv, prog_name='scanpy-cli', standalone_mode=False)
+    except click.ClickException as err:
+        err.show()
+        return err.exit_code
+    except click.exceptions.Abort:
+        click.echo('Aborted!', err=True)
+        return 1
+    except SystemExit as err:
+        return err.code if isinstance(err.code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return rv if isinstance(rv, int) else 0
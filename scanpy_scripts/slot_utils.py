@@ -0,0 +1,83 @@
+"""slot_utils
+
+Select the slots of objects written by sub-commands.
+
+`--keep-slots` and `--drop-slots` take comma separated slots, e.g. `raw`,
+`layers` or `uns`, or keys of slots, e.g. `obsm:X_umap` or `uns:neighbors`.
+With `--keep-slots`, slots not listed are emptied, and only the listed keys
+are kept of slots given with keys. `--drop-slots` then removes the listed
+slots or keys. Slots are pruned in place just before the object is written,
+so the data kept is never copied.
+"""
+
+import logging
+
+SLOTS = ('obs', 'var', 'obsm', 'varm', 'uns', 'layers', 'raw')
+
+
+def parse_slots(values):
+    """Parse slot specifications into a dict of slot names mapped to a tuple
+    of keys, or to None for the whole slot
+
+    Raises ValueError on unknown slots.
+    """
+    if values is None:
+        return None
+    slots = {}
+    for value in values:
+        slot, _, key = value.partition(':')
+        if slot not in SLOTS:
+            raise ValueError(
+                f'unknown slot "{slot}", must be one of {", ".join(SLOTS)}')
+        if not key:
+            slots[slot] = None
+        elif slot == 'raw':
+            raise ValueError('slot "raw" has no keys')
+        elif slot not in slots or slots[slot] is not None:
+            slots[slot] = tuple(sorted(set(slots.get(slot) or ()) | {key}))
+    return slots
+
+
+def prune_slots(adata, keep=None, drop=None):
+    """Remove in place the slots and keys of `adata` not in `keep`, then those
+    in `drop`, both as returned by `parse_slots`
+    """
+    if keep is not None:
+        for slot in SLOTS:
+            if slot not in keep:
+                _drop_slot(adata, slot)
+            elif keep[slot] is not None:
+                for key in list(_slot_keys(adata, slot)):
+                    if key not in keep[slot]:
+                        _drop_key(adata, slot, key)
+    if drop is not None:
+        for slot, keys in drop.items():
+            if keys is None:
+                _drop_slot(adata, slot)
+                continue
+            existing = set(_slot_keys(adata, slot))
+            for key in keys:
+                if key in existing:
+                    _drop_key(adata, slot, key)
+    return adata
+
+
+def _slot_keys(adata, slot):
+    if slot in ('obs', 'var'):
+        return getattr(adata, slot).columns
+    return getattr(adata, slot).keys()
+
+
+def _drop_key(adata, slot, key):
+    logging.debug('dropping %s["%s"]', slot, key)
+    del getattr(adata, slot)[key]
+
+
+def _drop_slot(adata, slot):
+    if slot == 'raw':
+        if adata.raw is not None:
+            logging.debug('dropping raw')
+            adata.raw = None
+        return
+    for key in list(_slot_keys(adata, slot)):
+        _drop_key(adata, slot, key)
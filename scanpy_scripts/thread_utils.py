@@ -0,0 +1,110 @@
+"""thread_utils
+
+Keep all steps within one CPU budget set by `scanpy-cli --threads`.
+
+The budget is first exported through the environment variables read by
+OpenMP, the BLAS libraries and numba when they load, which works because
+the command line interface defers importing them until a sub-command runs.
+Once it runs, libraries already loaded are limited through threadpoolctl if
+installed, scanpy's `n_jobs` is set, and the thread and process pools of
+scanpy-scripts take their default size from the budget.
+"""
+
+import contextlib
+import logging
+import os
+import sys
+
+THREAD_ENV_VARS = (
+    'OMP_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS',
+    'NUMEXPR_NUM_THREADS',
+    'NUMBA_NUM_THREADS',
+)
+
+_thread_budget = None
+
+
+def set_thread_budget(n_threads):
+    """Limit native and Python thread pools to `n_threads`, no-op if None
+
+    Safe to call before or after numpy, numba and scanpy are imported.
+    """
+    global _thread_budget
+    if n_threads is None:
+        return
+    if n_threads < 1:
+        raise ValueError(f'Number of threads must be positive: {n_threads}')
+    _thread_budget = n_threads
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=n_threads)
+    except ImportError:
+        if 'numpy' in sys.modules:
+            logging.debug('threadpoolctl not installed, BLAS threads already '
+                          'loaded are not limited')
+    if 'numba' in sys.modules:
+        numba = sys.modules['numba']
+        if hasattr(numba, 'set_num_threads'):
+            numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+    if 'scanpy' in sys.modules:
+        sys.modules['scanpy'].settings.n_jobs = n_threads
+
+
+def default_n_threads(n_threads=None):
+    """Return `n_threads` if given, else the thread budget, else the number of
+    available CPUs
+    """
+    if n_threads is not None and n_threads >= 1:
+        return n_threads
+    return _thread_budget or os.cpu_count() or 1
+
+
+def worker_thread_budget(n_workers):
+    """Threads each of `n_workers` worker processes may use within the budget
+    """
+    return max(1, default_n_threads() // max(1, n_workers))
+
+
+@contextlib.contextmanager
+def restored_thread_budget():
+    """Restore on exit the thread budget, its environment variables, the
+    limits of loaded thread pools, numba threads and scanpy's `n_jobs` as
+    they were on entry, for a process running several commands
+    """
+    global _thread_budget
+    budget = _thread_budget
+    environ = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    limiter = None
+    try:
+        from threadpoolctl import threadpool_limits
+        # records the current limits without changing them
+        limiter = threadpool_limits(limits=None)
+    except ImportError:
+        pass
+    numba = sys.modules.get('numba')
+    numba_threads = None
+    if numba is not None and hasattr(numba, 'get_num_threads'):
+        numba_threads = numba.get_num_threads()
+    scanpy = sys.modules.get('scanpy')
+    n_jobs = scanpy.settings.n_jobs if scanpy is not None else None
+    try:
+        yield
+    finally:
+        _thread_budget = budget
+        for var, value in environ.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+        if limiter is not None:
+            getattr(limiter, 'restore_original_limits', limiter.unregister)()
+        if numba_threads is not None:
+            numba.set_num_threads(numba_threads)
+        if scanpy is not None:
+            scanpy.settings.n_jobs = n_jobs
@@ -0,0 +1,252 @@
+"""zarr_utils
+
+Read and write AnnData objects as zarr directory stores.
+
+AnnData's own zarr writer goes through the matrix one chunk at a time in a
+single thread with whatever chunk shape it is given. Here the metadata slots
+are still written by anndata, while the expression matrices (`X` and `raw.X`)
+are written by a pool of threads, each thread compressing and storing whole
+chunks of its own row block, so no two threads ever touch the same chunk.
+
+Chunk shapes default to roughly `ZARR_CHUNK_BYTES` of uncompressed data per
+chunk, derived from the matrix shape and dtype.
+
+Sparse matrices are stored densely, as the anndata zarr reader expects, and
+the original format is recorded in the array attributes so that they can be
+re-sparsified on reading. They are densified and re-sparsified one chunk at a
+time, so each thread only holds a chunk of dense values at once.
+
+When read lazily, `X` is left as a zarr array that can be streamed over in row
+chunks with `iter_row_chunks()`, and loaded on demand with
+`load_lazy_matrix()` by steps that need it in memory.
+"""
+
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import scipy.sparse as sp
+from .thread_utils import default_n_threads
+
+
+ZARR_CHUNK_BYTES = 4 * 1024 * 1024
+
+_MATRIX_KEYS = ('X', 'raw.X')
+
+
+def auto_chunks(shape, dtype, target_bytes=ZARR_CHUNK_BYTES):
+    """Choose a chunk shape holding about `target_bytes` of uncompressed data
+
+    Columns are split first so that wide matrices get roughly square chunks,
+    the remaining budget goes to rows.
+    """
+    n_elem = max(1, target_bytes // np.dtype(dtype).itemsize)
+    if len(shape) == 1:
+        return (max(1, min(shape[0], n_elem)),)
+    n_row, n_col = shape[0], shape[1]
+    n_chunk_col = max(1, min(n_col, int(np.sqrt(n_elem))))
+    n_chunk_row = max(1, min(n_row, n_elem // n_chunk_col))
+    return (n_chunk_row, n_chunk_col) + tuple(shape[2:])
+
+
+def get_compressor(name):
+    """Return a numcodecs compressor by name, one of 'blosc-lz4', 'blosc-zstd',
+    'zstd' or 'none'
+    """
+    import numcodecs
+    if name is None or name == 'none':
+        return None
+    if name.startswith('blosc-'):
+        return numcodecs.Blosc(
+            cname=name[6:], clevel=5, shuffle=numcodecs.Blosc.SHUFFLE)
+    if name == 'zstd':
+        return numcodecs.Zstd(level=3)
+    raise ValueError(f'Unsupported zarr compressor: {name}')
+
+
+def _n_threads(n_threads):
+    return default_n_threads(n_threads)
+
+
+def _row_blocks(n_row, block_size):
+    return [(start, min(start + block_size, n_row))
+            for start in range(0, n_row, block_size)]
+
+
+def _write_matrix(root, key, mat, chunks, compressor, n_threads):
+    if chunks is None:
+        chunks = auto_chunks(mat.shape, mat.dtype)
+    za = root.create_dataset(
+        key,
+        shape=mat.shape,
+        chunks=chunks,
+        dtype=mat.dtype,
+        compressor=compressor,
+        overwrite=True,
+    )
+    if sp.issparse(mat):
+        za.attrs['sparse_format'] = mat.format
+        mat = sp.csr_matrix(mat)
+
+    def write_block(block):
+        start, end = block
+        value = mat[start:end]
+        if not sp.issparse(value):
+            za[start:end] = value
+            return
+        # densify one chunk at a time rather than the whole row block
+        for c0, c1 in _row_blocks(mat.shape[1], za.chunks[1]):
+            za[start:end, c0:c1] = value[:, c0:c1].toarray()
+
+    # Row blocks are aligned to chunk boundaries and span all columns, so
+    # each thread owns complete chunks
+    blocks = _row_blocks(mat.shape[0], za.chunks[0])
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        list(pool.map(write_block, blocks))
+    logging.debug('wrote %s %s in %d chunks of %s with %d threads',
+                  key, mat.shape, za.nchunks, za.chunks, n_threads)
+
+
+def _read_matrix(za, n_threads):
+    sparse_format = za.attrs.get('sparse_format', None)
+    blocks = _row_blocks(za.shape[0], za.chunks[0])
+
+    if sparse_format:
+        def read_block(block):
+            # sparsify one chunk at a time rather than the whole row block
+            start, end = block
+            return sp.hstack([
+                sp.csr_matrix(za[start:end, c0:c1])
+                for c0, c1 in _row_blocks(za.shape[1], za.chunks[1])
+            ], format='csr')
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            mat = sp.vstack(list(pool.map(read_block, blocks)), format='csr')
+        return mat.asformat(sparse_format)
+
+    mat = np.empty(za.shape, dtype=za.dtype)
+
+    def fill_block(block):
+        mat[block[0]:block[1]] = za[block[0]:block[1]]
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        list(pool.map(fill_block, blocks))
+    return mat
+
+
+def write_zarr(
+        adata,
+        store,
+        chunks=None,
+        n_threads=None,
+        compressor='blosc-lz4',
+):
+    """Write an AnnData object to a zarr directory store
+
+    * Parameters
+        + adata : AnnData
+        An AnnData object
+        + store : str
+        Path of the output zarr directory store
+        + chunks : int or tuple
+        Chunk shape of the expression matrices, chosen from matrix shape and
+        dtype when None
+        + n_threads : int
+        Number of threads writing chunks concurrently, the --threads budget
+        or all available CPUs when None
+        + compressor : str
+        One of 'blosc-lz4', 'blosc-zstd', 'zstd' or 'none'
+    """
+    import numcodecs
+    import zarr
+    from anndata.readwrite.write import _write_key_value_to_zarr
+
+    n_threads = _n_threads(n_threads)
+    compressor = get_compressor(compressor)
+    # process-wide setting, restored for later blosc users in this process
+    blosc_threads = numcodecs.blosc.use_threads
+    if n_threads > 1:
+        # Parallelism is across chunks, avoid nested blosc threads per chunk
+        numcodecs.blosc.use_threads = False
+
+    try:
+        d = adata._to_dict_fixed_width_arrays(var_len_str=False)
+        root = zarr.open(store, mode='w')
+        for key, value in d.items():
+            if key in _MATRIX_KEYS:
+                _write_matrix(root, key, value, chunks, compressor, n_threads)
+            else:
+                _write_key_value_to_zarr(root, key, value, compressor=compressor)
+    finally:
+        numcodecs.blosc.use_threads = blosc_threads
+    return 0
+
+
+def is_lazy_matrix(mat):
+    """Whether a matrix is still on disk rather than loaded in memory
+    """
+    return mat is not None and not (
+        isinstance(mat, np.ndarray) or sp.issparse(mat))
+
+
+def iter_row_chunks(mat, chunk_size=None, n_threads=None):
+    """Iterate over row chunks of a lazy matrix
+
+    Up to `n_threads` chunks are read ahead concurrently. Yields the same
+    `(chunk, start, end)` tuples as `AnnData.chunked_X()`.
+    """
+    if chunk_size is None:
+        chunk_size = mat.chunks[0]
+    n_threads = _n_threads(n_threads)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        for start, end in _row_blocks(mat.shape[0], chunk_size):
+            pending.append(
+                (pool.submit(mat.__getitem__, slice(start, end)), start, end))
+            if len(pending) >= n_threads:
+                future, s, e = pending.popleft()
+                yield future.result(), s, e
+        while pending:
+            future, s, e = pending.popleft()
+            yield future.result(), s, e
+
+
+def load_lazy_matrix(adata, n_threads=None):
+    """Load a lazy `.X` into memory, no-op if it is already loaded
+    """
+    if is_lazy_matrix(adata.X):
+        logging.debug('loading lazy X %s into memory', adata.shape)
+        adata.X = _read_matrix(adata.X, _n_threads(n_threads))
+    return adata
+
+
+def read_zarr(store, n_threads=None, lazy=False):
+    """Read an AnnData object from a zarr directory store
+
+    * Parameters
+        + store : str
+        Path of the input zarr directory store
+        + n_threads : int
+        Number of threads reading chunks concurrently, the --threads budget
+        or all available CPUs when None
+        + lazy : bool
+        Leave `.X` on disk as a chunked zarr array, everything else is loaded
+        eagerly
+
+    * Returns
+        + adata : AnnData
+        An AnnData object
+    """
+    import anndata
+    import zarr
+    from anndata.readwrite.read import _read_key_value_from_zarr
+
+    n_threads = _n_threads(n_threads)
+    root = zarr.open(store, mode='r')
+    d = {}
+    for key in root.keys():
+        if key == 'X' and lazy:
+            d[key] = root[key]
+        elif key in _MATRIX_KEYS:
+            d[key] = _read_matrix(root[key], n_threads)
+        else:
+            _read_key_value_from_zarr(root, d, key)
+    return anndata.AnnData(*anndata.AnnData._args_from_dict(d))